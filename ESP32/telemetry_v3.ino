@@ -5,6 +5,7 @@
   - GPS (TinyGPS++)
   - WiFi + MQTT (PubSubClient)
   - Publishes telemetry JSON to: containers/<device_id>/telemetry
+    (or, built with TELEMETRY_BINARY 1, a packed 27-byte struct to: containers/<device_id>/telemetry/bin)
   - Publishes retained status to: containers/<device_id>/status (online/offline) using LWT
   - LCD (16x2 I2C) + Status LEDs (Red/Green/Yellow)
 */
@@ -28,6 +29,21 @@ LiquidCrystal_I2C lcd(0x27, 16, 2);
 unsigned long yellowBlinkTime = 0;
 bool yellowBlinkActive = false;
 
+// 1: publish packed binary telemetry (aiot_fresh/telemetry_bin.py, version 1) instead of JSON
+#define TELEMETRY_BINARY 0
+
+struct __attribute__((packed)) TelemetryPacketV1 {
+  uint8_t version;      // 1
+  uint8_t flags;        // bit 0: GPS fix
+  uint32_t timestamp;   // Unix seconds (UTC)
+  float temperature_c;  // NaN when the read failed
+  float humidity_pct;
+  float mq4_ppm;
+  int32_t lat_e6;       // microdegrees
+  int32_t lon_e6;
+  uint8_t satellites;
+};
+
 #define DHTPIN 4
 #define DHTTYPE DHT22
 DHT dht(DHTPIN, DHTTYPE);
@@ -152,6 +168,19 @@ void mqttConnectAndSetupLWT() {
 }
 
 void publishTelemetry(float temperature_c, float humidity_pct, float mq4_ppm, double lat, double lon, bool fix, int sats) {
+#if TELEMETRY_BINARY
+  String topic = String("containers/") + DEVICE_ID + "/telemetry/bin";
+  TelemetryPacketV1 packet;
+  packet.version = 1;
+  packet.flags = fix ? 0x01 : 0x00;
+  packet.timestamp = (uint32_t)time(nullptr);
+  packet.temperature_c = temperature_c;
+  packet.humidity_pct = humidity_pct;
+  packet.mq4_ppm = mq4_ppm;
+  packet.lat_e6 = fix ? (int32_t)lround(lat * 1e6) : 0;
+  packet.lon_e6 = fix ? (int32_t)lround(lon * 1e6) : 0;
+  packet.satellites = (uint8_t)sats;
+#else
   String topic = String("containers/") + DEVICE_ID + "/telemetry";
   String payload = "{";
 
@@ -166,9 +195,14 @@ void publishTelemetry(float temperature_c, float humidity_pct, float mq4_ppm, do
   payload += "\"fix\":" + String(fix ? "true" : "false") + ",";
   payload += "\"satellites\":" + String(sats);
   payload += "}}";
+#endif
 
   if (mqttClient.connected()) {
+#if TELEMETRY_BINARY
+    bool ok = mqttClient.publish(topic.c_str(), (const uint8_t*)&packet, sizeof(packet));
+#else
     bool ok = mqttClient.publish(topic.c_str(), payload.c_str());
+#endif
     if (ok) {
       Serial.print("Published telemetry to ");
       Serial.println(topic);
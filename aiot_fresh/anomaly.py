@@ -0,0 +1,227 @@
+"""
+anomaly.py
+Online anomaly detection per container, next to the threshold rules in rules.py.
+
+Fixed thresholds miss slow failures (a compressor losing ground, a gas sensor drifting
+upward) until they cross a limit. For each metric this keeps a baseline of what is
+normal for the container at that hour of the day and scores every reading against it:
+
+    baseline = slow EWMA of the readings + seasonal offset of the reading's UTC hour
+    drift    = fast EWMA of (value - baseline) / EW standard deviation of the readings
+               around that fast EWMA (the sensor noise)
+    z        = (value - baseline) / the same standard deviation
+
+A single reading with |z| >= SPIKE_Z, or a sustained shift with |drift| >= DRIFT_Z,
+raises an "anomaly" warn alert; it clears once every metric is back under half of
+those limits. Smoothing factors are derived from the time between readings, so the
+detector behaves the same at any reporting interval.
+
+State is constant per device: per metric a few floats and 24 hourly offsets.
+mqtt_listener keeps it in its container registry and primes it from the last
+PRIME_HOURS of 1-minute rollups when a container is first seen, so a restart does
+not start from an empty baseline. Priming is a batch estimate over the whole window,
+vectorized with numpy when it is installed (pure Python otherwise).
+"""
+
+import math
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional: priming falls back to pure Python
+    np = None
+
+# Telemetry field -> (label, unit, smallest standard deviation, about the sensor's resolution)
+METRICS = {
+    "temperature_c": ("Temperature", "°C", 0.2),
+    "humidity_pct": ("Humidity", "%", 1.0),
+    "mq4_ppm": ("Gas level", " ppm", 5.0),
+}
+
+FAST_TAU_S = float(os.environ.get("AIOT_ANOMALY_FAST_TAU", 600))
+SLOW_TAU_S = float(os.environ.get("AIOT_ANOMALY_SLOW_TAU", 6 * 3600))
+# Time constant of an hourly offset, counted in readings that fall in that hour of the day
+SEASON_TAU_S = float(os.environ.get("AIOT_ANOMALY_SEASON_TAU", 3600))
+SPIKE_Z = float(os.environ.get("AIOT_ANOMALY_SPIKE_Z", 5.0))
+DRIFT_Z = float(os.environ.get("AIOT_ANOMALY_DRIFT_Z", 2.5))
+# A raised anomaly clears once every score is below this fraction of its limit
+CLEAR_RATIO = 0.5
+# Seconds of history a metric needs before it is scored (a day, so the hourly offsets exist)
+WARMUP_S = float(os.environ.get("AIOT_ANOMALY_WARMUP", 24 * 3600))
+PRIME_HOURS = float(os.environ.get("AIOT_ANOMALY_PRIME_HOURS", 24))
+
+ALERT_KEY = ("anomaly", "warn")
+
+# Indexes into a metric's state list
+T, T_FIRST, MEAN, VAR, FAST, OFFSETS = range(6)
+
+
+def new_state(active=False):
+    """Per-device state: whether the anomaly alert is open, and each metric's baseline."""
+    return {"active": active, "metrics": {}}
+
+
+def _new_metric(t, value):
+    return [t, t, value, 0.0, 0.0, [0.0] * 24]
+
+
+# ---------------------------
+# Per-reading update
+# ---------------------------
+def update(metric_state, t, value, floor):
+    """
+    Scores one reading against the baseline, then folds it in.
+    Returns (z, drift) once the metric is warmed up, else None.
+    """
+    hour = int(t // 3600 % 24)
+    offsets = metric_state[OFFSETS]
+    dt = t - metric_state[T]
+    if dt <= 0:
+        # Duplicate or out-of-order reading: score it, but leave the baseline alone
+        dt = 0.0
+    else:
+        metric_state[T] = t
+
+    residual = value - metric_state[MEAN] - offsets[hour]
+    sigma = max(math.sqrt(metric_state[VAR]), floor)
+    a_fast = 1 - math.exp(-dt / FAST_TAU_S)
+    metric_state[FAST] += a_fast * (residual - metric_state[FAST])
+    scores = residual / sigma, metric_state[FAST] / sigma
+
+    a_slow = 1 - math.exp(-dt / SLOW_TAU_S)
+    metric_state[MEAN] += a_slow * residual
+    # Spread around the short-term level: reading noise only, so a drift cannot widen its own band
+    noise = residual - metric_state[FAST]
+    metric_state[VAR] = (1 - a_slow) * (metric_state[VAR] + a_slow * noise * noise)
+    a_season = 1 - math.exp(-dt / SEASON_TAU_S)
+    offsets[hour] += a_season * (value - metric_state[MEAN] - offsets[hour])
+
+    if t - metric_state[T_FIRST] < WARMUP_S:
+        return None
+    return scores
+
+
+def evaluate(state, telemetry, t):
+    """
+    Feeds one reading through the detector. Returns the alerts active after it in the
+    same shape as rules.evaluate: [] or [{"type": "anomaly", "level": "warn", "message"}].
+    """
+    worst = None
+    for field, (label, unit, floor) in METRICS.items():
+        value = telemetry.get(field)
+        if value is None:
+            continue
+        metric_state = state["metrics"].get(field)
+        if metric_state is None:
+            state["metrics"][field] = _new_metric(t, value)
+            continue
+        scores = update(metric_state, t, value, floor)
+        if scores is None:
+            continue
+        z, drift = scores
+        severity = max(abs(z) / SPIKE_Z, abs(drift) / DRIFT_Z)
+        if worst is None or severity > worst[0]:
+            worst = (severity, label, unit, value, z, drift)
+
+    if worst is None:
+        # Nothing scored in this reading: an open alert stays open
+        return [{"type": ALERT_KEY[0], "level": ALERT_KEY[1], "message": "Anomaly"}] if state["active"] else []
+    severity, label, unit, value, z, drift = worst
+    state["active"] = severity >= (CLEAR_RATIO if state["active"] else 1.0)
+    if not state["active"]:
+        return []
+    if abs(z) / SPIKE_Z >= abs(drift) / DRIFT_Z:
+        message = f"Anomaly: {label} {value}{unit} is {abs(z):.1f}σ {'above' if z > 0 else 'below'} its usual level"
+    else:
+        message = f"Anomaly: {label} drifting {'up' if drift > 0 else 'down'} ({abs(drift):.1f}σ from its usual level, now {value}{unit})"
+    return [{"type": ALERT_KEY[0], "level": ALERT_KEY[1], "message": message}]
+
+
+# ---------------------------
+# Priming from history
+# ---------------------------
+def _prime_metric_numpy(times, values):
+    t = np.asarray(times, dtype=float)
+    x = np.asarray(values, dtype=float)
+    age = t[-1] - t
+    hours = (t // 3600 % 24).astype(int)
+
+    # Hourly offsets: mean deviation of each hour of the day from the overall level
+    counts = np.bincount(hours, minlength=24)
+    offsets = np.divide(np.bincount(hours, weights=x - x.mean(), minlength=24), counts,
+                        out=np.zeros(24), where=counts > 0)
+
+    deseasoned = x - offsets[hours]
+    weights = np.exp(-age / SLOW_TAU_S)
+    mean = float(np.dot(weights, deseasoned) / weights.sum())
+    fast_weights = np.exp(-age / FAST_TAU_S)
+    fast = float(np.dot(fast_weights, deseasoned - mean) / fast_weights.sum())
+    # Noise from reading-to-reading steps, which a slow change in level hardly moves
+    steps = np.diff(deseasoned)
+    var = float(np.dot(weights[1:], steps * steps) / weights[1:].sum() / 2)
+    return [float(t[-1]), float(t[0]), mean, var, fast, offsets.tolist()]
+
+
+def _prime_metric_python(times, values):
+    """Same estimate as _prime_metric_numpy, one reading at a time."""
+    overall = sum(values) / len(values)
+    totals, counts = [0.0] * 24, [0] * 24
+    for t, value in zip(times, values):
+        hour = int(t // 3600 % 24)
+        totals[hour] += value - overall
+        counts[hour] += 1
+    offsets = [total / count if count else 0.0 for total, count in zip(totals, counts)]
+
+    deseasoned = [value - offsets[int(t // 3600 % 24)] for t, value in zip(times, values)]
+    weights = [math.exp(-(times[-1] - t) / SLOW_TAU_S) for t in times]
+    mean = sum(w * x for w, x in zip(weights, deseasoned)) / sum(weights)
+    fast_weights = [math.exp(-(times[-1] - t) / FAST_TAU_S) for t in times]
+    fast = sum(w * (x - mean) for w, x in zip(fast_weights, deseasoned)) / sum(fast_weights)
+    steps = [(b - a) ** 2 for a, b in zip(deseasoned, deseasoned[1:])]
+    var = sum(w * step for w, step in zip(weights[1:], steps)) / sum(weights[1:]) / 2
+    return [times[-1], times[0], mean, var, fast, offsets]
+
+
+def prime(state, rows):
+    """
+    Seeds the baselines from (epoch seconds, {field: (mean, spread)}) rows in time order,
+    e.g. the 1-minute rollups. spread is the bucket's max - min, which stands in for the
+    reading-to-reading noise that the bucket means average away.
+    """
+    for field in METRICS:
+        points = [(t, metrics[field]) for t, metrics in rows if metrics.get(field) is not None]
+        if len(points) < 2:
+            continue
+        times = [t for t, _ in points]
+        values = [mean for _, (mean, _) in points]
+        if np is not None:
+            metric_state = _prime_metric_numpy(times, values)
+        else:
+            metric_state = _prime_metric_python(times, values)
+        # max - min of ~12 normal readings spans about 3.3 standard deviations
+        within = sum((spread / 3.3) ** 2 for _, (_, spread) in points) / len(points)
+        metric_state[VAR] += within
+        state["metrics"][field] = metric_state
+    return state
+
+
+def load_history(conn, device_id, now=None):
+    """Reads the last PRIME_HOURS of 1-minute rollups for prime()."""
+    since = time.strftime("%Y-%m-%dT%H:%M:00Z", time.gmtime((now or time.time()) - PRIME_HOURS * 3600))
+    columns = ", ".join(f"{m}_sum, {m}_count, {m}_min, {m}_max" for m in METRICS)
+    rows = conn.execute(f"""
+        SELECT CAST(strftime('%s', bucket) AS INTEGER) + 30 AS t, {columns}
+        FROM telemetry_rollup_1m
+        WHERE device_id = ? AND bucket >= ?
+        ORDER BY bucket
+    """, (device_id, since)).fetchall()
+    history = []
+    for row in rows:
+        metrics = {}
+        for i, field in enumerate(METRICS):
+            total, count, low, high = row[1 + 4 * i:5 + 4 * i]
+            if count:
+                metrics[field] = (total / count, high - low)
+        history.append((row[0], metrics))
+    return history
@@ -1,34 +1,83 @@
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify
+from flask import Flask, Response, g, render_template, request, redirect, session, url_for, jsonify
 from auth import verify_login, require_auth
-from functools import wraps
-import sqlite3
+from functools import wraps, lru_cache
 import os
 import json
-from datetime import datetime, timezone
+import math
+import queue
+import base64
+import gzip
+import hashlib
+import time
+from datetime import datetime, timezone, timedelta
 import paho.mqtt.publish as publish
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import is_resource_modified
+import codec
+import database
+import outbox
+import rollups
+import events
+import metrics
+import profiling
+import thresholds
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """jsonify() and request.get_json() through codec.py (orjson when installed), with Flask's output."""
+
+    def dumps(self, obj, **kwargs):
+        return codec.dumps(obj, default=self.default, sort_keys=self.sort_keys, indent=bool(kwargs.get("indent")))
+
+    def loads(self, s, **kwargs):
+        return codec.loads(s)
 
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
 app.secret_key = os.environ.get('PORTAL_SECRET', 'change_me')
 
 # Use a local path for development to avoid permission issues
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiot.db")
+DB_PATH = database.DB_PATH
 MQTT_HOST = "localhost"
 
 # ---------------------------
 # DB Helpers
 # ---------------------------
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # Shared per-thread connection; returned to the pool (not closed) at the end of each request
+    return database.get_connection()
+
+def get_read_db():
+    return database.get_readonly_connection()
+
+@app.teardown_request
+def release_db(exc):
+    # The threaded server runs every request on a new thread; the next one reuses these
+    database.return_connections()
 
 def add_to_outbox(conn, kind, target_path, payload):
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO outbox (kind, target_path, payload, created_at)
-        VALUES (?, ?, ?, ?)
-    """, (kind, target_path, json.dumps(payload), datetime.utcnow().isoformat()))
+    outbox.add_to_outbox(conn, kind, target_path, payload)
     conn.commit()
+    outbox.notify_outbox()
+
+def expire_listener_state(device_ids):
+    """
+    Makes the listener reload these containers' cached state (thresholds, active alerts) on
+    their next reading, after a committed change to their alerts. Published on the config
+    topic without retain, so the retained config stays. Best effort: the listener's registry
+    expires on its own after AIOT_REGISTRY_TTL.
+    """
+    messages = [{"topic": f"containers/{device_id}/config", "payload": json.dumps({"device_id": device_id, "alerts_changed": True})}
+                for device_id in sorted(set(device_ids))]
+    if not messages:
+        return
+    try:
+        publish.multiple(messages, hostname=MQTT_HOST)
+    except Exception as e:
+        print(f"Could not notify the listener of changed alerts: {e}")
+
+def alert_containers(conn, where="", params=()):
+    """Containers with rows in alerts (matching `where`), read before the portal changes them."""
+    return [row[0] for row in conn.execute(f"SELECT DISTINCT container_id FROM alerts {where}", params)]
 
 # ---------------------------
 # Authentication decorator for APIs
@@ -41,6 +90,91 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# ---------------------------
+# Response helpers: conditional GET, field projection, compression
+# ---------------------------
+class BadRequest(ValueError):
+    pass
+
+# Bodies smaller than this are sent as is; gzip would save next to nothing
+GZIP_MIN_SIZE = 500
+GZIP_MIMETYPES = {"application/json", "text/html", "text/css", "text/javascript", "application/javascript", "text/plain"}
+
+def parse_fields(allowed):
+    """Parses ?fields=a,b into a tuple of keys to return, or None for everything."""
+    raw = request.args.get("fields")
+    if not raw:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in raw.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def project(record, fields):
+    return record if fields is None else {key: record[key] for key in fields if key in record}
+
+def parse_db_time(value):
+    """Parses the naive UTC isoformat() timestamps the services store."""
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc) if value else None
+    except ValueError:
+        return None
+
+def conditional_json(watermark, last_modified, build_body):
+    """
+    Answers 304 when the client's ETag (or Last-Modified) still matches. `watermark` is a
+    cheap summary of everything the body depends on, so the body is only built and
+    serialized, by build_body(), when it has actually changed.
+    """
+    etag = hashlib.sha1(json.dumps([watermark, request.args.get("fields")], default=str).encode()).hexdigest()
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = jsonify(build_body())
+    else:
+        response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Clients must revalidate every time, which now costs a 304 instead of the full body
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# ---------------------------
+# Request metrics (see GET /metrics)
+# ---------------------------
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "aiot_http_request_seconds", "Portal request latency by route, method and status.", ("route", "method", "status"))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# Registered before compress_response, so it runs after it and the timing includes gzip
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        # The route pattern, not the path, so device ids do not each become a series
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                     route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in GZIP_MIMETYPES or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if not request.accept_encodings["gzip"]:
+        return response
+    data = response.get_data()
+    if len(data) >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
 # ---------------------------
 # Login / Logout
 # ---------------------------
@@ -77,6 +211,100 @@ def dashboard():
 def admin_db():
     return render_template('admin_db.html')
 
+# ---------------------------
+# Device state helpers
+# ---------------------------
+# A device is online if it reported within this many seconds
+ONLINE_TIMEOUT_S = 30
+
+ONLINE_EXPR = f"(julianday('now') - julianday(c.last_seen)) * 86400 < {ONLINE_TIMEOUT_S}"
+
+# One indexed query: containers joined with the latest-reading table the listener maintains.
+# Online status is computed in SQL so last_seen is never parsed in Python.
+DEVICE_STATE_QUERY = f"""
+    SELECT c.device_id, c.selected_food_type, c.last_seen, c.threshold_overrides,
+           {ONLINE_EXPR} AS is_online,
+           s.telemetry_id, s.temperature_c, s.humidity_pct, s.mq4_ppm,
+           s.lat, s.lon, s.fix, s.satellites,
+           s.shelf_life_food_type, s.shelf_life_started, s.shelf_life_consumed, s.shelf_life_remaining_h
+    FROM containers c
+    LEFT JOIN container_state s ON s.device_id = c.device_id
+"""
+
+# Everything DEVICE_STATE_QUERY's output depends on, in one aggregate row (the ETag watermark).
+# A device going offline changes nothing but the clock, so it counts as changed at last_seen + timeout.
+# Food type edits change the inherited thresholds and shelf life, and shelf_life.py --recompute
+# the shelf life. changed_at (Last-Modified) covers everything the ETag does, so clients that
+# only send If-Modified-Since see those changes too.
+DEVICE_WATERMARK_QUERY = f"""
+    SELECT count(*) AS devices, sum(is_online) AS online, max(last_seen) AS last_seen,
+           max(last_modified) AS last_modified, max(received_at) AS received_at,
+           total(shelf_life_consumed) AS shelf_life,
+           max(shelf_life_recomputed_at) AS shelf_life_recomputed_at,
+           (SELECT max(last_modified) FROM food_types) AS food_types_modified,
+           max(max(coalesce(changed_at, '')), max(coalesce(last_modified, '')), max(coalesce(received_at, '')),
+               max(coalesce(shelf_life_recomputed_at, '')),
+               coalesce((SELECT max(last_modified) FROM food_types), '')) AS changed_at
+    FROM (
+        SELECT c.last_seen, c.last_modified, s.received_at, s.shelf_life_consumed, s.shelf_life_recomputed_at,
+               {ONLINE_EXPR} AS is_online,
+               CASE WHEN {ONLINE_EXPR} THEN c.last_seen
+                    ELSE strftime('%Y-%m-%dT%H:%M:%f', c.last_seen, '+{ONLINE_TIMEOUT_S} seconds') END AS changed_at
+        FROM containers c
+        LEFT JOIN container_state s ON s.device_id = c.device_id
+        {{where}}
+    )
+"""
+
+DEVICE_FIELDS = ("device_id", "selected_food_type", "last_seen", "threshold_overrides", "status", "last_telemetry")
+ALERT_FIELDS = ("id", "container_id", "alert_type", "level", "message", "timestamp", "resolved", "pushed")
+
+def device_watermark(conn, device_id=None):
+    if device_id is None:
+        row = conn.execute(DEVICE_WATERMARK_QUERY.format(where="")).fetchone()
+    else:
+        row = conn.execute(DEVICE_WATERMARK_QUERY.format(where="WHERE c.device_id=?"), (device_id,)).fetchone()
+    return tuple(row), parse_db_time(row["changed_at"])
+
+@lru_cache(maxsize=1024)
+def parse_overrides(raw):
+    # Overrides rarely change, so the same JSON text is decoded once, not on every poll
+    return json.loads(raw) if raw else {}
+
+def shelf_life_from_row(row):
+    if row["shelf_life_consumed"] is None:
+        return None
+    return {
+        "food_type": row["shelf_life_food_type"],
+        "started": row["shelf_life_started"],
+        "consumed_pct": round(row["shelf_life_consumed"] * 100, 1),
+        # At the current temperature
+        "remaining_hours": round(row["shelf_life_remaining_h"], 1),
+    }
+
+def device_from_row(row):
+    device = {
+        "device_id": row["device_id"],
+        "selected_food_type": row["selected_food_type"],
+        "last_seen": row["last_seen"],
+        "threshold_overrides": parse_overrides(row["threshold_overrides"]),
+        "status": "online" if row["is_online"] else "offline",
+        "last_telemetry": {}
+    }
+    if row["telemetry_id"] is not None:
+        device["last_telemetry"] = {
+            "temperature_c": row["temperature_c"],
+            "humidity_pct": row["humidity_pct"],
+            "mq4_ppm": row["mq4_ppm"],
+            "gps": {
+                "lat": row["lat"],
+                "lon": row["lon"],
+                "fix": row["fix"],
+                "satellites": row["satellites"]
+            }
+        }
+    return device
+
 # ---------------------------
 # /api/devices
 # ---------------------------
@@ -86,55 +314,21 @@ def get_devices():
     if not os.path.exists(DB_PATH):
         return jsonify({"error": "DB not found"}), 500
 
-    devices = []
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        fields = parse_fields(DEVICE_FIELDS)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), 400
 
-        cursor.execute("SELECT * FROM containers")
-        rows = cursor.fetchall()
+    try:
+        conn = get_read_db()
+        watermark, last_modified = device_watermark(conn)
 
-        for row in rows:
-            is_online = False
-            if row["last_seen"]:
-                try:
-                    last_seen_dt = datetime.fromisoformat(row["last_seen"])
-                    if (datetime.utcnow() - last_seen_dt).total_seconds() < 30:
-                        is_online = True
-                except (ValueError, TypeError):
-                    is_online = False
-
-            device = {
-                "device_id": row["device_id"],
-                "selected_food_type": row["selected_food_type"],
-                "last_seen": row["last_seen"],
-                "threshold_overrides": json.loads(row["threshold_overrides"]) if row["threshold_overrides"] else {},
-                "status": "online" if is_online else "offline",
-                "last_telemetry": {}
-            }
+        def build_body():
+            cursor = conn.cursor()
+            cursor.execute(DEVICE_STATE_QUERY)
+            return {"devices": [project(device_from_row(row), fields) for row in cursor.fetchall()]}
 
-            cursor.execute(
-                "SELECT * FROM telemetry WHERE device_id=? ORDER BY timestamp DESC LIMIT 1",
-                (row["device_id"],)
-            )
-            telemetry_row = cursor.fetchone()
-            if telemetry_row:
-                device["last_telemetry"] = {
-                    "temperature_c": telemetry_row["temperature_c"],
-                    "humidity_pct": telemetry_row["humidity_pct"],
-                    "mq4_ppm": telemetry_row["mq4_ppm"],
-                    "gps": {
-                        "lat": telemetry_row["lat"],
-                        "lon": telemetry_row["lon"],
-                        "fix": telemetry_row["fix"],
-                        "satellites": telemetry_row["satellites"]
-                    }
-                }
-
-            devices.append(device)
-
-        conn.close()
-        return jsonify({"devices": devices})
+        return conditional_json(watermark, last_modified, build_body)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -149,57 +343,191 @@ def get_device_detail(device_id):
         return jsonify({"error": "DB not found"}), 500
 
     try:
-        conn = get_db()
-        cursor = conn.cursor()
+        fields = parse_fields(DEVICE_FIELDS + ("thresholds", "shelf_life"))
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), 400
 
-        cursor.execute("SELECT * FROM containers WHERE device_id=?", (device_id,))
-        row = cursor.fetchone()
-        if not row:
-            conn.close()
+    try:
+        conn = get_read_db()
+        watermark, last_modified = device_watermark(conn, device_id)
+        if not watermark[0]:
             return jsonify({"error": "Device not found"}), 404
 
-        is_online = False
-        if row["last_seen"]:
-            try:
-                last_seen_dt = datetime.fromisoformat(row["last_seen"])
-                if (datetime.utcnow() - last_seen_dt).total_seconds() < 30:
-                    is_online = True
-            except (ValueError, TypeError):
-                is_online = False
-
-        container = {
-            "device_id": row["device_id"],
-            "selected_food_type": row["selected_food_type"],
-            "last_seen": row["last_seen"],
-            "threshold_overrides": json.loads(row["threshold_overrides"]) if row["threshold_overrides"] else {},
-            "status": "online" if is_online else "offline",
-            "last_telemetry": {}
-        }
+        def build_body():
+            cursor = conn.cursor()
+            cursor.execute(DEVICE_STATE_QUERY + " WHERE c.device_id=?", (device_id,))
+            row = cursor.fetchone()
+            container = device_from_row(row)
 
-        cursor.execute(
-            "SELECT * FROM telemetry WHERE device_id=? ORDER BY timestamp DESC LIMIT 1",
-            (device_id,)
+            # Effective thresholds: the food type's, with the container's overrides on top
+            container["thresholds"] = thresholds.load(conn, device_id)[0]
+            container["shelf_life"] = shelf_life_from_row(row)
+
+            return {"device": project(container, fields)}
+
+        return conditional_json(watermark, last_modified, build_body)
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------------------------
+# Telemetry history helpers
+# ---------------------------
+# Device timestamps are UTC in this format (see getIsoTimestamp in the firmware), so they compare as strings
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+HISTORY_DEFAULT_SPAN = timedelta(hours=24)
+HISTORY_PAGE_SIZE = 500
+# Upper bound for both `limit` and `max_points`
+HISTORY_MAX_POINTS = 5000
+
+def parse_time_arg(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        # fromisoformat only accepts a trailing "Z" from Python 3.11
+        parsed = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an ISO 8601 timestamp")
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_int_arg(name, default, minimum):
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer")
+    if not minimum <= number <= HISTORY_MAX_POINTS:
+        raise BadRequest(f"'{name}' must be between {minimum} and {HISTORY_MAX_POINTS}")
+    return number
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row["timestamp"], row["id"]]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(timestamp), int(row_id)
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid cursor")
+
+def query_raw_telemetry(conn, device_id, start, end, limit, cursor=None):
+    """
+    One page of raw readings in (timestamp, id) order. Keyset pagination: the cursor is the
+    last row of the previous page, so every page is an index range scan on idx_telemetry_device_ts.
+    """
+    sql = """
+        SELECT id, timestamp, temperature_c, humidity_pct, mq4_ppm FROM telemetry
+        WHERE device_id = ? AND timestamp >= ? AND timestamp < ?
+    """
+    params = [device_id, start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT)]
+    if cursor:
+        sql += " AND (timestamp, id) > (?, ?)"
+        params.extend(decode_cursor(cursor))
+    sql += " ORDER BY timestamp, id LIMIT ?"
+    # One extra row tells us whether there is a next page
+    rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    points = [{key: row[key] for key in ("timestamp", *rollups.METRICS)} for row in rows[:limit]]
+    return points, next_cursor
+
+def count_raw_telemetry(conn, device_id, start, end, at_most):
+    """Readings in [start, end), counting no further than at_most (an index range scan of that length)."""
+    return conn.execute("""
+        SELECT count(*) FROM (
+            SELECT 1 FROM telemetry WHERE device_id = ? AND timestamp >= ? AND timestamp < ? LIMIT ?
         )
-        telemetry_row = cursor.fetchone()
-        if telemetry_row:
-            container["last_telemetry"] = {
-                "temperature_c": telemetry_row["temperature_c"],
-                "humidity_pct": telemetry_row["humidity_pct"],
-                "mq4_ppm": telemetry_row["mq4_ppm"],
-                "gps": {
-                    "lat": telemetry_row["lat"],
-                    "lon": telemetry_row["lon"],
-                    "fix": telemetry_row["fix"],
-                    "satellites": telemetry_row["satellites"]
-                }
-            }
-        
-        # Simplified threshold logic: only use the overrides
-        container["thresholds"] = container["threshold_overrides"]
+    """, (device_id, start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT), at_most)).fetchone()[0]
+
+def query_downsampled_telemetry(conn, device_id, start, end, resolution, step):
+    """
+    Aggregates rollup rows into buckets of `step` seconds (a multiple of the rollup resolution).
+    Each point carries the mean, min and max of every metric, so spikes survive downsampling.
+    """
+    table, bucket_format, resolution_s = rollups.ROLLUPS[resolution]
+    # Buckets are counted from the start of the range (rounded down to the rollup resolution)
+    origin = int(start.replace(tzinfo=timezone.utc).timestamp()) // resolution_s * resolution_s
+    aggregates = ", ".join(
+        f"sum({m}_sum) / nullif(sum({m}_count), 0) AS {m}, min({m}_min) AS {m}_min, max({m}_max) AS {m}_max"
+        for m in rollups.METRICS
+    )
+    rows = conn.execute(f"""
+        SELECT strftime('{TIMESTAMP_FORMAT}', :origin + (strftime('%s', bucket) - :origin) / :step * :step, 'unixepoch') AS timestamp,
+               sum(count) AS count, {aggregates}
+        FROM {table}
+        WHERE device_id = :device_id AND bucket >= :start AND bucket < :end
+        GROUP BY 1 ORDER BY 1
+    """, {
+        "origin": origin,
+        "step": step,
+        "device_id": device_id,
+        "start": start.strftime(bucket_format),
+        "end": end.strftime(TIMESTAMP_FORMAT),
+    }).fetchall()
+    return [dict(row) for row in rows]
+
+# ---------------------------
+# /api/devices/<id>/telemetry
+# ---------------------------
+@app.route("/api/devices/<device_id>/telemetry", methods=["GET"])
+@login_required
+def get_device_telemetry(device_id):
+    """
+    Telemetry history for charts. Query parameters:
+      start, end  ISO 8601 range (default: the last 24 hours)
+      max_points  downsample to at most this many points, aggregated from the rollup tables
+      limit       page size for raw readings (default 500)
+      cursor      next_cursor from the previous raw page
+    Raw readings are returned when max_points is absent or the range holds no more than
+    max_points readings; otherwise the whole range is aggregated into at most max_points buckets.
+    """
+    if not os.path.exists(DB_PATH):
+        return jsonify({"error": "DB not found"}), 500
 
-        conn.close()
-        return jsonify({"device": container})
+    try:
+        end = parse_time_arg("end", datetime.utcnow())
+        start = parse_time_arg("start", end - HISTORY_DEFAULT_SPAN)
+        if start >= end:
+            raise BadRequest("'start' must be before 'end'")
+        max_points = parse_int_arg("max_points", None, 2)
+        limit = parse_int_arg("limit", HISTORY_PAGE_SIZE, 1)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), 400
 
+    try:
+        conn = get_read_db()
+        if not conn.execute("SELECT 1 FROM containers WHERE device_id=?", (device_id,)).fetchone():
+            return jsonify({"error": "Device not found"}), 404
+
+        result = {"device_id": device_id, "start": start.strftime(TIMESTAMP_FORMAT), "end": end.strftime(TIMESTAMP_FORMAT)}
+        step = math.ceil((end - start).total_seconds() / max_points) if max_points else 0
+        if max_points and step < rollups.ROLLUPS["1m"][2] and \
+                count_raw_telemetry(conn, device_id, start, end, max_points + 1) > max_points:
+            # Too many readings for max_points, but the range is too short for that many
+            # one-minute buckets: one-minute buckets then still fit in max_points
+            step = rollups.ROLLUPS["1m"][2]
+        if step >= rollups.ROLLUPS["1m"][2]:
+            resolution = "1h" if step >= rollups.ROLLUPS["1h"][2] else "1m"
+            resolution_s = rollups.ROLLUPS[resolution][2]
+            step = math.ceil(step / resolution_s) * resolution_s
+            result.update(mode="downsampled", bucket_seconds=step,
+                          points=query_downsampled_telemetry(conn, device_id, start, end, resolution, step))
+        else:
+            if max_points:
+                # The range holds at most max_points readings: all of them, in one response
+                points, next_cursor = query_raw_telemetry(conn, device_id, start, end, max_points)
+            else:
+                points, next_cursor = query_raw_telemetry(conn, device_id, start, end, limit,
+                                                          request.args.get("cursor"))
+            result.update(mode="raw", points=points, next_cursor=next_cursor)
+        return jsonify(result)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -256,8 +584,6 @@ def update_thresholds(device_id):
 
         # 4. Queue for cloud sync
         add_to_outbox(conn, "config", f"containers/{device_id}", config_payload)
-        
-        conn.close()
 
         return jsonify({
             "status": "success",
@@ -267,24 +593,81 @@ def update_thresholds(device_id):
         })
 
     except Exception as e:
-        if conn:
-            conn.close()
+        return jsonify({"error": str(e)}), 500
+
+# ---------------------------
+# Food types
+# ---------------------------
+FOOD_TYPE_JSON_FIELDS = ("thresholds", "shelf_life")
+
+def food_type_from_row(row):
+    food_type = dict(row)
+    for key in FOOD_TYPE_JSON_FIELDS:
+        food_type[key] = json.loads(food_type[key]) if food_type[key] else None
+    return food_type
+
+@app.route("/api/food-types", methods=["GET"])
+@login_required
+def get_food_types():
+    try:
+        conn = get_read_db()
+        rows = conn.execute("SELECT * FROM food_types ORDER BY id").fetchall()
+        return jsonify({"food_types": [food_type_from_row(row) for row in rows]})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/food-types/<food_type_id>", methods=["POST"])
+@login_required
+def update_food_type(food_type_id):
+    """Creates or updates a food type; the given fields replace the stored ones."""
+    data = request.json
+    if not isinstance(data, dict):
+        return jsonify({"error": "Missing JSON body"}), 400
+    for key in FOOD_TYPE_JSON_FIELDS:
+        if key in data and data[key] is not None and not isinstance(data[key], dict):
+            return jsonify({"error": f"'{key}' must be a JSON object"}), 400
+
+    try:
+        conn = get_db()
+        row = conn.execute("SELECT * FROM food_types WHERE id=?", (food_type_id,)).fetchone()
+        food_type = food_type_from_row(row) if row else {"id": food_type_id, "display_name": food_type_id,
+                                                         "thresholds": {}, "shelf_life": None, "notes": None}
+        food_type.update((key, data[key]) for key in ("display_name", "thresholds", "shelf_life", "notes") if key in data)
+        food_type["last_modified"] = datetime.utcnow().isoformat()
+
+        conn.execute("""
+            INSERT OR REPLACE INTO food_types (id, display_name, thresholds, shelf_life, notes, last_modified)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (food_type_id, food_type["display_name"], json.dumps(food_type["thresholds"] or {}),
+              json.dumps(food_type["shelf_life"]) if food_type["shelf_life"] else None,
+              food_type["notes"], food_type["last_modified"]))
+        conn.commit()
+
+        # Every container inheriting from this food type reloads its thresholds on its next reading
+        publish.single(f"food_types/{food_type_id}/config", payload=json.dumps(food_type), hostname=MQTT_HOST, retain=True)
+        add_to_outbox(conn, "food_type", f"food_types/{food_type_id}", food_type)
+
+        return jsonify({"status": "success", "food_type": food_type})
+    except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # ---------------------------
 # DB Admin APIs
 # ---------------------------
+def displayable_row(row):
+    """A row as a dict for the admin views; BLOBs (msgpack outbox payloads) become JSON text."""
+    return {key: codec.payload_text(value) if isinstance(value, bytes) else value for key, value in dict(row).items()}
+
 @app.route("/api/admin/tables", methods=["GET"])
 @login_required
 def get_tables():
     if not os.path.exists(DB_PATH):
         return jsonify({"error": "DB not found"}), 500
     try:
-        conn = get_db()
+        conn = get_read_db()
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
         tables = [row[0] for row in cursor.fetchall()]
-        conn.close()
         return jsonify({"tables": tables})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -295,12 +678,11 @@ def get_table_content(table_name):
     if not os.path.exists(DB_PATH):
         return jsonify({"error": "DB not found"}), 500
     try:
-        conn = get_db()
+        conn = get_read_db()
         cursor = conn.cursor()
         # Verify table name to prevent SQL injection
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
         if not cursor.fetchone():
-             conn.close()
              return jsonify({"error": "Invalid table name"}), 400
 
         # Fetch column names
@@ -311,9 +693,8 @@ def get_table_content(table_name):
         # Fetch last 100 rows
         order_clause = f"ORDER BY {pk_column} DESC" if pk_column else ""
         cursor.execute(f"SELECT * FROM {table_name} {order_clause} LIMIT 100")
-        rows = [dict(row) for row in cursor.fetchall()]
+        rows = [displayable_row(row) for row in cursor.fetchall()]
         
-        conn.close()
         return jsonify({"columns": columns, "rows": rows, "pk": pk_column})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -330,7 +711,6 @@ def delete_table_row(table_name, row_id):
         # Verify table exists
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
         if not cursor.fetchone():
-             conn.close()
              return jsonify({"error": "Invalid table name"}), 400
              
         # Determine PK
@@ -339,12 +719,12 @@ def delete_table_row(table_name, row_id):
         pk_column = next((info[1] for info in columns_info if info[5] == 1), columns_info[0][1] if columns_info else None)
 
         if not pk_column:
-             conn.close()
              return jsonify({"error": "Table has no primary key"}), 400
 
+        changed = alert_containers(conn, f"WHERE {pk_column}=?", (row_id,)) if table_name == "alerts" else []
         cursor.execute(f"DELETE FROM {table_name} WHERE {pk_column}=?", (row_id,))
         conn.commit()
-        conn.close()
+        expire_listener_state(changed)
         return jsonify({"status": "success", "message": f"Deleted row {row_id} from {table_name}"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -361,12 +741,12 @@ def clear_table(table_name):
         # Verify table
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (table_name,))
         if not cursor.fetchone():
-             conn.close()
              return jsonify({"error": "Invalid table name"}), 400
 
+        changed = alert_containers(conn) if table_name == "alerts" else []
         cursor.execute(f"DELETE FROM {table_name}")
         conn.commit()
-        conn.close()
+        expire_listener_state(changed)
         return jsonify({"status": "success", "message": f"Cleared all data from {table_name}"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -390,12 +770,24 @@ def get_device_alerts(device_id):
         return jsonify({"error": "DB not found"}), 500
     
     try:
-        conn = get_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM alerts WHERE container_id=? ORDER BY timestamp DESC LIMIT 50", (device_id,))
-        alerts = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"alerts": alerts})
+        fields = parse_fields(ALERT_FIELDS)
+    except BadRequest as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        conn = get_read_db()
+        # Covered by idx_alerts_container_resolved. New, resolved and cleared alerts all change it;
+        # none of those leaves a reliable timestamp, so these responses carry an ETag only.
+        watermark = tuple(conn.execute(
+            "SELECT count(*), max(id), sum(resolved) FROM alerts WHERE container_id=?", (device_id,)
+        ).fetchone())
+
+        def build_body():
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM alerts WHERE container_id=? ORDER BY timestamp DESC LIMIT 50", (device_id,))
+            return {"alerts": [project(dict(row), fields) for row in cursor.fetchall()]}
+
+        return conditional_json(watermark, None, build_body)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -413,7 +805,8 @@ def delete_device_alerts(device_id):
         cursor = conn.cursor()
         cursor.execute("DELETE FROM alerts WHERE container_id=?", (device_id,))
         conn.commit()
-        conn.close()
+        # The listener would otherwise treat the cleared alerts as still active and not raise them again
+        expire_listener_state([device_id])
         return jsonify({"status": "success", "message": f"Alerts for device {device_id} have been cleared."})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -439,11 +832,8 @@ def post_test_alert(device_id):
         alert_payload = {**alert_info, "id": alert_id, "device_id": device_id, "timestamp": datetime.utcnow().isoformat()}
         add_to_outbox(conn, "alert", f"testalerts/{device_id}/alerts", alert_payload)
         
-        conn.close()
         return jsonify({"status": "success", "message": "Test alert created and queued for sync."})
     except Exception as e:
-        if conn:
-            conn.close()
         return jsonify({"error": str(e)}), 500
 
 # ---------------------------
@@ -456,18 +846,154 @@ def get_sync_status():
         return jsonify({"pending_items": -1, "error": "DB not found"}), 500
     
     try:
-        conn = get_db()
+        conn = get_read_db()
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM outbox")
-        count = cursor.fetchone()[0]
-        conn.close()
-        return jsonify({"pending_items": count})
+        # outbox_counts is kept by triggers, so this does not count the backlog on every poll
+        cursor.execute("SELECT coalesce(sum(pending), 0), coalesce(sum(dead), 0) FROM outbox_counts")
+        count, dead_count = cursor.fetchone()
+        return jsonify({"pending_items": count, "dead_letter_items": dead_count})
     except Exception as e:
         return jsonify({"pending_items": -1, "error": str(e)}), 500
 
+# ---------------------------
+# GET /metrics (Prometheus)
+# ---------------------------
+# Scrapers cannot log in; when set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("AIOT_METRICS_TOKEN", "")
+
+def outbox_metrics(conn):
+    """
+    Outbox gauges, read from the database at scrape time rather than kept by any one service.
+    Counts come from outbox_counts (kept by triggers) and each kind's oldest item is one
+    idx_outbox_kind_id lookup, so a scrape costs the same however deep the backlog is.
+    """
+    depth = metrics.Gauge("aiot_outbox_items", "Outbox items waiting for cloud_sync, by kind.", ("kind",))
+    oldest = metrics.Gauge("aiot_outbox_oldest_item_age_seconds",
+                           "Age of the oldest pending outbox item, by kind.", ("kind",))
+    dead = metrics.Gauge("aiot_outbox_dead_items", "Items in the dead-letter table (outbox_dead).")
+    now = datetime.now(timezone.utc)
+    dead_total = 0
+    for kind, pending, dead_items in conn.execute("SELECT kind, pending, dead FROM outbox_counts").fetchall():
+        dead_total += dead_items
+        depth.set(pending, kind=kind)
+        if not pending:
+            continue
+        row = conn.execute("SELECT created_at FROM outbox WHERE kind = ? ORDER BY id LIMIT 1", (kind,)).fetchone()
+        created_at = parse_db_time(row[0]) if row else None
+        if created_at is not None:
+            oldest.set(max(0.0, (now - created_at).total_seconds()), kind=kind)
+    dead.set(dead_total)
+    return [depth, oldest, dead]
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("Unauthorized\n", status=401, mimetype="text/plain")
+    extra = []
+    if os.path.exists(DB_PATH):
+        try:
+            extra = outbox_metrics(get_read_db())
+        except Exception as e:
+            print(f"Could not read outbox metrics: {e}")
+    return Response(metrics.exposition(extra), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ---------------------------
+# POST /api/admin/profile (sampling profiler, see profiling.py)
+# ---------------------------
+PROFILE_MAX_SECONDS = 120
+
+@app.route("/api/admin/profile", methods=["POST"])
+@login_required
+def profile_portal():
+    """
+    Samples this portal process for ?seconds= (default AIOT_PROFILE_SECONDS) and returns
+    the folded stacks. The listener and cloud_sync are profiled with `kill -USR1 <pid>`.
+    """
+    try:
+        seconds = float(request.args.get("seconds", profiling.PROFILE_SECONDS))
+    except ValueError:
+        return jsonify({"error": "'seconds' must be a number"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"'seconds' must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+    result = profiling.profile("portal", seconds)
+    if result is None:
+        return jsonify({"error": "A profile is already running in this process"}), 409
+    path, counts = result
+    return Response(profiling.folded(counts), mimetype="text/plain",
+                    headers={"Content-Disposition": f"attachment; filename={os.path.basename(path)}"})
+
+# ---------------------------
+# Dead-letter queue (outbox items that exhausted their retries)
+# ---------------------------
+@app.route("/api/sync/dead-letter", methods=["GET"])
+@login_required
+def get_dead_letter():
+    if not os.path.exists(DB_PATH):
+        return jsonify({"error": "DB not found"}), 500
+
+    try:
+        conn = get_read_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM outbox_dead ORDER BY id DESC LIMIT 100")
+        items = [displayable_row(row) for row in cursor.fetchall()]
+        return jsonify({"items": items})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/sync/dead-letter/replay", methods=["POST"])
+@app.route("/api/sync/dead-letter/<int:item_id>/replay", methods=["POST"])
+@login_required
+def replay_dead_letter(item_id=None):
+    if not os.path.exists(DB_PATH):
+        return jsonify({"error": "DB not found"}), 500
+
+    try:
+        conn = get_db()
+        replayed, dropped = outbox.replay_dead_letter(conn, item_id)
+        conn.commit()
+        if replayed:
+            outbox.notify_outbox()
+        if item_id is not None and replayed + dropped == 0:
+            return jsonify({"error": "Item not found"}), 404
+        return jsonify({"status": "success", "replayed": replayed, "superseded": dropped})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+# ---------------------------
+# GET /api/stream (Server-Sent Events)
+# ---------------------------
+# Seconds between keep-alive comments, so proxies do not close an idle stream
+STREAM_KEEPALIVE_S = 15
+
+@app.route("/api/stream", methods=["GET"])
+@login_required
+def stream_events():
+    events.start_event_subscriber(MQTT_HOST)
+    stream = events.open_stream()
+
+    def generate():
+        try:
+            # Tell EventSource how long to wait before reconnecting
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = stream.get(timeout=STREAM_KEEPALIVE_S)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {codec.dumps(event)}\n\n"
+        finally:
+            # Runs when the client disconnects and the server closes the generator
+            events.close_stream(stream)
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 # ---------------------------
 # Run Flask
 # ---------------------------
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # threaded: each open /api/stream holds a worker thread
+    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
@@ -1,20 +1,17 @@
-import sqlite3
 import bcrypt
 from flask import session, redirect, url_for
-import os
+import database
 
-# Use a local path for development to avoid permission issues
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiot.db")
+DB_PATH = database.DB_PATH
 
 def get_db():
-    return sqlite3.connect(DB_PATH)
+    return database.get_readonly_connection()
 
 def verify_login(username, password):
     conn = get_db()
     cur = conn.cursor()
     cur.execute("SELECT password_hash FROM users WHERE username = ?", (username,))
     row = cur.fetchone()
-    conn.close()
     if row is None:
         return False
     stored_hash = row[0]
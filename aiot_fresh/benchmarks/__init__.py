@@ -0,0 +1,5 @@
+"""
+Benchmarks for the AIoT Fresh edge services.
+Run them from the aiot_fresh/ directory, e.g. `python -m benchmarks.sync_drain`.
+Each benchmark works on a scratch database in a temporary directory, never on aiot.db.
+"""
@@ -0,0 +1,153 @@
+"""
+Local stand-in for the Mosquitto broker, so benchmarks can run the listener's real
+paho client end to end without a broker installed.
+
+Speaks just enough MQTT 3.1.1 for the services: CONNECT, SUBSCRIBE with + and #
+filters, PUBLISH (delivered at QoS 0; QoS 1 publishes are acknowledged), PINGREQ
+and DISCONNECT. No retained messages, sessions or authentication. Every client gets
+a thread, and a slow subscriber blocks its publishers through TCP, as with a real broker.
+"""
+
+import socket
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(levels) or (level != "+" and level != levels[i]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+class Client:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.filters = []
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def read_packet(self):
+        header = self.file.read(1)
+        if not header:
+            return None, None
+        length, multiplier = 0, 1
+        while True:
+            byte = self.file.read(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header[0], self.file.read(length)
+
+
+class StandInBroker:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = socket.create_server((host, port))
+        self.host, self.port = self.server.getsockname()[:2]
+        self.clients = []
+        self.lock = threading.Lock()
+        self.published = 0
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, name="broker-accept", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.close()
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.sock.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Client(sock)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self._serve, args=(client,), name="broker-client", daemon=True).start()
+
+    def _serve(self, client):
+        try:
+            while True:
+                header, body = client.read_packet()
+                if header is None:
+                    break
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    client.send(bytes([CONNACK << 4, 2, 0, 0]))
+                elif packet_type == PUBLISH:
+                    self._publish(client, header, body)
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(client, body)
+                elif packet_type == PINGREQ:
+                    client.send(bytes([PINGRESP << 4, 0]))
+                elif packet_type == DISCONNECT:
+                    break
+        except (OSError, IndexError):
+            pass
+        finally:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            client.sock.close()
+
+    def _subscribe(self, client, body):
+        packet_id = body[:2]
+        granted = bytearray()
+        offset = 2
+        while offset < len(body):
+            (length,) = struct.unpack_from("!H", body, offset)
+            client.filters.append(body[offset + 2:offset + 2 + length].decode())
+            offset += 2 + length + 1
+            granted.append(0)
+        client.send(bytes([SUBACK << 4]) + encode_length(2 + len(granted)) + packet_id + bytes(granted))
+
+    def _publish(self, client, header, body):
+        qos = (header >> 1) & 3
+        (length,) = struct.unpack_from("!H", body)
+        topic = body[2:2 + length].decode()
+        offset = 2 + length
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            client.send(bytes([PUBACK << 4, 2]) + packet_id)
+        # Forward at QoS 0 with the same topic and payload
+        packet = bytes([PUBLISH << 4]) + encode_length(len(body) - offset + 2 + length) + body[:2 + length] + body[offset:]
+        with self.lock:
+            subscribers = [c for c in self.clients if any(topic_matches(f, topic) for f in c.filters)]
+            self.published += 1
+        for subscriber in subscribers:
+            try:
+                subscriber.send(packet)
+            except OSError:
+                pass
@@ -0,0 +1,123 @@
+"""
+Serialization cost per telemetry message and per API response, stdlib json vs. codec.py.
+
+Uses firmware-format readings from benchmarks/fleet.py and times the serialization work
+each one causes on the gateway:
+ - listener: decode the message, encode the telemetry and container_summary outbox payloads
+ - cloud_sync: decode both payloads again
+ - portal: encode a /api/devices body (sorted keys, as jsonify does)
+
+for the previous path (json.loads, json.dumps twice) and for each available codec
+configuration (orjson and msgpack are optional; missing ones are skipped).
+
+    python -m benchmarks.codecs --messages 5000 --devices 500
+"""
+
+import argparse
+import json
+import time
+
+from benchmarks.fleet import make_fleet, schedule
+
+
+def summary(payload):
+    # Same document as mqtt_listener.update_container_summary_in_outbox
+    return {
+        "last_seen": payload.get("timestamp"),
+        "status": {"state": "online", "last_update": payload.get("timestamp")},
+        "latest_telemetry": payload,
+    }
+
+
+def stdlib_listener(raws):
+    stored = []
+    for raw in raws:
+        payload = json.loads(raw)
+        stored.append(json.dumps(payload))
+        stored.append(json.dumps(summary(payload)))
+    return stored
+
+
+def codec_listener(codec, raws):
+    """The listener's path in mqtt_listener.flush_batch/process_telemetry, for codec's configuration."""
+    stored = []
+    for raw in raws:
+        text = raw.decode("utf-8")
+        payload = codec.loads(text)
+        if codec.OUTBOX_STORES_JSON:
+            stored.append(text)
+            head = {key: value for key, value in summary(payload).items() if key != "latest_telemetry"}
+            stored.append(f'{codec.dumps(head)[:-1]},"latest_telemetry":{text}}}')
+        else:
+            stored.append(codec.encode_payload(payload))
+            stored.append(codec.encode_payload(summary(payload)))
+    return stored
+
+
+def devices_body(raws, devices):
+    body = []
+    for raw in raws[:devices]:
+        payload = json.loads(raw)
+        body.append({"device_id": payload["device_id"], "selected_food_type": "chicken",
+                     "last_seen": payload["timestamp"], "threshold_overrides": {}, "status": "online",
+                     "last_telemetry": {key: payload[key] for key in ("temperature_c", "humidity_pct", "mq4_ppm", "gps")}})
+    return {"devices": body}
+
+
+def timed(function, *args, repeat=5):
+    """Best of `repeat` runs, in seconds, and the last result."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def configurations():
+    """(label, codec module configured that way) for every combination installed here."""
+    import importlib
+    import os
+    import codec
+
+    backends = ["stdlib"] + (["orjson"] if codec.orjson else [])
+    outbox_codecs = ["json"] + (["msgpack"] if codec.msgpack else [])
+    for backend in backends:
+        for outbox_codec in outbox_codecs:
+            os.environ["AIOT_JSON_BACKEND"], os.environ["AIOT_OUTBOX_CODEC"] = backend, outbox_codec
+            yield f"{backend}+{outbox_codec}", importlib.reload(codec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=500, help="devices in the /api/devices body")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    fleet = make_fleet(max(1, args.messages // 10), seed=args.seed, fault_rate=0.0)
+    raws = [payload for _, payload in schedule(fleet, 10, 5.0)][:args.messages]
+    body = devices_body(raws, args.devices)
+    n = len(raws)
+
+    print(f"{n} messages ({sum(map(len, raws)) / n:.0f} B each), /api/devices body with {len(body['devices'])} devices")
+    print(f"{'path':>16} {'listener us/msg':>16} {'sync us/msg':>12} {'outbox B/msg':>13} {'api ms/body':>12} {'speedup':>8}")
+
+    listener_s, stored = timed(stdlib_listener, raws)
+    sync_s, _ = timed(lambda: [json.loads(value) for value in stored])
+    api_s, _ = timed(lambda: json.dumps(body, sort_keys=True, separators=(",", ":")))
+    baseline = listener_s + sync_s
+    print(f"{'current':>16} {listener_s / n * 1e6:>16.1f} {sync_s / n * 1e6:>12.1f} "
+          f"{sum(map(len, stored)) / n:>13.0f} {api_s * 1000:>12.2f} {1.0:>7.1f}x")
+
+    for label, codec in configurations():
+        listener_s, stored = timed(codec_listener, codec, raws)
+        sync_s, decoded = timed(lambda: [codec.decode_payload(value) for value in stored])
+        api_s, _ = timed(lambda: codec.dumps(body, sort_keys=True))
+        assert decoded[1]["latest_telemetry"] == json.loads(raws[0])
+        print(f"{label:>16} {listener_s / n * 1e6:>16.1f} {sync_s / n * 1e6:>12.1f} "
+              f"{sum(map(len, stored)) / n:>13.0f} {api_s * 1000:>12.2f} {baseline / (listener_s + sync_s):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Virtual container fleet: telemetry in the exact format telemetry_v3.ino publishes.
+
+Each container holds its food type's setpoint with sensor noise and drives a GPS track.
+A share of the fleet misbehaves the way real loads do, so the alert paths get exercised:
+ - compressor failure: temperature climbs steadily until it crosses the thresholds
+ - door openings: short warm excursions
+ - spoilage: the MQ-4 reading creeps upward
+ - GPS dropouts: fix lost, coordinates 0.0, few satellites
+ - sensor faults: a failed DHT read is published as `nan`, which is not valid JSON
+
+With binary_share, that share of the fleet runs TELEMETRY_BINARY firmware and publishes
+packed readings (telemetry_bin.py) on containers/<id>/telemetry/bin instead.
+
+Readings are spaced `interval` simulated seconds apart (the firmware's telemetry
+period), however fast the benchmark sends them.
+"""
+
+import math
+import random
+from datetime import datetime, timedelta, timezone
+import telemetry_bin
+
+# Food type (as seeded by init_db) -> (temperature setpoint °C, humidity setpoint %)
+PROFILES = {
+    "chicken": (2.0, 85.0),
+    "bananas": (13.5, 90.0),
+}
+START_TIME = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class VirtualContainer:
+    def __init__(self, index, rng, food_type, compressor_failure=False, spoiling=False, fault_rate=0.0, binary=False):
+        self.device_id = f"sim-{index:05d}"
+        self.binary = binary
+        self.topic = f"containers/{self.device_id}/telemetry" + ("/bin" if binary else "")
+        self.food_type = food_type
+        self.rng = rng
+        self.setpoint, self.humidity = PROFILES[food_type]
+        self.compressor_failure = compressor_failure
+        self.spoiling = spoiling
+        self.fault_rate = fault_rate
+        self.mq4_base = rng.uniform(80, 140)
+        # Truck route: start somewhere around Kuala Lumpur, drive at 40-90 km/h on a fixed heading
+        self.lat = 3.139 + rng.uniform(-0.5, 0.5)
+        self.lon = 101.687 + rng.uniform(-0.5, 0.5)
+        self.heading = rng.uniform(0, 2 * math.pi)
+        self.speed_kmh = rng.uniform(40, 90)
+        self.door_open_until = -1
+        self.reading = 0
+
+    def next_payload(self, interval):
+        """The next reading as the firmware's JSON bytes (or packed bytes, for a binary container)."""
+        rng = self.rng
+        k = self.reading
+        self.reading += 1
+
+        temperature = self.setpoint + rng.gauss(0, 0.15)
+        if self.compressor_failure and k > 3:
+            temperature += 0.4 * (k - 3)
+        if k < self.door_open_until:
+            temperature += 6.0
+        elif rng.random() < 0.01:
+            self.door_open_until = k + 3
+        humidity = min(100.0, self.humidity + rng.gauss(0, 1.5))
+        mq4 = self.mq4_base + rng.gauss(0, 4) + (25.0 * k if self.spoiling else 0.0)
+
+        # Advance along the heading; 1 degree of latitude is about 111 km
+        step_km = self.speed_kmh * interval / 3600
+        self.lat += step_km / 111 * math.cos(self.heading)
+        self.lon += step_km / (111 * math.cos(math.radians(self.lat))) * math.sin(self.heading)
+        fix = rng.random() > 0.05
+        satellites = rng.randint(5, 11) if fix else rng.randint(0, 3)
+
+        time = START_TIME + timedelta(seconds=k * interval)
+        fault = rng.random() < self.fault_rate
+        if self.binary:
+            return telemetry_bin.encode(time.timestamp(), None if fault else temperature, humidity, mq4,
+                                        self.lat if fix else 0.0, self.lon if fix else 0.0, fix, satellites)
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        temperature_text = "nan" if fault else f"{temperature:.2f}"
+        # Same field order and precision as publishTelemetry() in telemetry_v3.ino
+        return (
+            f'{{"device_id":"{self.device_id}","timestamp":"{timestamp}",'
+            f'"temperature_c":{temperature_text},"humidity_pct":{humidity:.2f},"mq4_ppm":{mq4:.2f},'
+            f'"gps":{{"lat":{self.lat if fix else 0.0:.6f},"lon":{self.lon if fix else 0.0:.6f},'
+            f'"fix":{"true" if fix else "false"},"satellites":{satellites}}}}}'
+        ).encode()
+
+
+def make_fleet(containers, seed=1, failing=0.05, spoiling=0.02, fault_rate=0.001, binary_share=0.0):
+    """
+    A reproducible fleet; `failing` and `spoiling` are the shares of misbehaving containers,
+    `binary_share` the share publishing packed binary telemetry.
+    """
+    rng = random.Random(seed)
+    food_types = sorted(PROFILES)
+    return [
+        VirtualContainer(i, random.Random(rng.random()), food_types[i % len(food_types)],
+                         compressor_failure=rng.random() < failing,
+                         spoiling=rng.random() < spoiling,
+                         fault_rate=fault_rate,
+                         binary=i < containers * binary_share)
+        for i in range(containers)
+    ]
+
+
+def register_fleet(conn, fleet):
+    """Registers the containers with their food types, so the fleet runs against real thresholds."""
+    conn.executemany("""
+        INSERT OR IGNORE INTO containers (device_id, selected_food_type, last_seen, threshold_overrides)
+        VALUES (?, ?, ?, '{}')
+    """, [(c.device_id, c.food_type, START_TIME.isoformat()) for c in fleet])
+    conn.commit()
+
+
+def schedule(fleet, readings, interval):
+    """(topic, payload) for every reading, round-robin over the fleet like a real reporting period."""
+    for _ in range(readings):
+        for container in fleet:
+            yield container.topic, container.next_payload(interval)
@@ -0,0 +1,216 @@
+"""
+End-to-end ingestion benchmark with a simulated fleet (see benchmarks/fleet.py).
+
+Sends firmware-format telemetry for thousands of virtual containers, with drift,
+threshold crossings, GPS tracks and the odd malformed reading, into mqtt_listener:
+
+ - direct: calls on_message the way paho's network thread does (no broker)
+ - broker: publishes through a local MQTT broker stand-in (benchmarks/broker.py) to
+   the listener's own paho client, so the network path is included
+
+and reports throughput, end-to-end latency (send -> committed), commits per message,
+database growth and the outbox depth left for cloud_sync. Each mode runs on a fresh
+scratch database, with the containers registered under seeded food types so the real
+threshold rules fire.
+
+    python -m benchmarks.ingest_fleet --containers 2000 --readings 10 --rate 1000
+
+--rate is the offered load in messages per second (0 sends as fast as the listener
+takes them; latency then mostly measures queueing). Latency is measured in the
+in-process writer, so this runs the listener with a single ingest worker.
+--binary 0.5 has half the fleet publish packed binary telemetry (telemetry_bin.py).
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks.fleet import make_fleet, register_fleet, schedule
+from benchmarks.ingest_shards import Message, quiet_stdout
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] if values else float("nan")
+
+
+def db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+
+class Tracker:
+    """Wraps mqtt_listener.flush_batch to time each message from send to commit."""
+
+    def __init__(self, mqtt_listener):
+        self.listener = mqtt_listener
+        self.flush_batch = mqtt_listener.flush_batch
+        self.sent = {}
+        self.latencies = []
+        self.commits = 0
+        self.done = 0
+        self.lock = threading.Lock()
+        self.all_done = threading.Event()
+        self.expected = None
+
+    def send_time(self, topic, payload):
+        self.sent[(topic, payload)] = time.perf_counter()
+
+    def tracked_flush_batch(self, batch):
+        if not self.flush_batch(batch):
+            return False
+        committed = time.perf_counter()
+        with self.lock:
+            self.commits += 1
+            for topic, payload, _ in batch:
+                sent = self.sent.pop((topic, bytes(payload)), None)
+                if sent is not None:
+                    self.latencies.append(committed - sent)
+            self.done += len(batch)
+            if self.expected is not None and self.done >= self.expected:
+                self.all_done.set()
+        return True
+
+    def expect(self, count):
+        with self.lock:
+            self.expected = count
+            if self.done >= count:
+                self.all_done.set()
+
+
+def pace(messages, rate, send):
+    """Calls send(topic, payload) for each message, `rate` per second (0 = no pacing)."""
+    started = time.perf_counter()
+    for i, (topic, payload) in enumerate(messages):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        send(topic, payload)
+
+
+def run_direct(mqtt_listener, tracker, messages, rate):
+    def send(topic, payload):
+        tracker.send_time(topic, payload)
+        mqtt_listener.on_message(None, None, Message(topic, payload))
+
+    pace(messages, rate, send)
+
+
+def run_broker(mqtt_listener, tracker, messages, rate, publishers):
+    import paho.mqtt.client as mqtt
+    from benchmarks.broker import StandInBroker
+
+    broker = StandInBroker().start()
+    mqtt_listener.MQTT_HOST, mqtt_listener.MQTT_PORT = broker.host, broker.port
+    threading.Thread(target=mqtt_listener._run_mqtt_client, name="listener-mqtt", daemon=True).start()
+    while not broker.clients or not any(c.filters for c in broker.clients):
+        time.sleep(0.05)
+
+    def publisher(share):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.connect(broker.host, broker.port, 60)
+        client.loop_start()
+
+        def send(topic, payload):
+            tracker.send_time(topic, payload)
+            client.publish(topic, payload, qos=0)
+
+        pace(share, rate / publishers, send)
+        client.loop_stop()
+        client.disconnect()
+
+    # Each publisher takes a share of the containers, like several gateways
+    shares = [messages[i::publishers] for i in range(publishers)]
+    threads = [threading.Thread(target=publisher, args=(share,)) for share in shares]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return broker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--containers", type=int, default=2000)
+    parser.add_argument("--readings", type=int, default=10, help="readings per container")
+    parser.add_argument("--interval", type=float, default=5.0, help="simulated seconds between a container's readings")
+    parser.add_argument("--rate", type=float, default=1000.0, help="offered messages per second (0 = unpaced)")
+    parser.add_argument("--modes", default="direct,broker", help="comma-separated: direct, broker")
+    parser.add_argument("--publishers", type=int, default=4, help="MQTT clients publishing in broker mode")
+    parser.add_argument("--binary", type=float, default=0.0, help="share of the fleet publishing binary telemetry")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="aiot-bench-")
+    # Point the services at a scratch DB before they are imported
+    os.environ["AIOT_DB_PATH"] = os.path.join(scratch, "aiot.db")
+    os.environ["AIOT_OUTBOX_SOCKET"] = os.path.join(scratch, "outbox.sock")
+    os.environ["AIOT_METRICS_DIR"] = os.path.join(scratch, "metrics")
+    import database
+    import init_db
+    import mqtt_listener
+
+    total = args.containers * args.readings
+    print(f"{total} messages from {args.containers} containers, offered at "
+          f"{f'{args.rate:.0f} msg/s' if args.rate else 'full speed'}")
+    print(f"{'mode':>7} {'msg/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'commits/msg':>12} "
+          f"{'failed':>7} {'alerts':>7} {'DB growth':>12} {'B/msg':>7}  outbox depth")
+    for run, mode in enumerate(args.modes.split(",")):
+        database.close_connections()
+        database.DB_PATH = os.environ["AIOT_DB_PATH"] = os.path.join(scratch, f"aiot-{run}.db")
+        fleet = make_fleet(args.containers, seed=args.seed, binary_share=args.binary)
+        messages = list(schedule(fleet, args.readings, args.interval))
+        mqtt_listener.invalidate_container()
+        mqtt_listener._stats[:] = [0.0] * len(mqtt_listener.STAT_FIELDS)
+
+        with quiet_stdout():
+            conn = database.get_connection()
+            init_db.migrate(conn)
+            init_db.seed_defaults(conn)
+            register_fleet(conn, fleet)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            size_before = db_size(database.DB_PATH)
+
+            tracker = Tracker(mqtt_listener)
+            mqtt_listener.flush_batch = tracker.tracked_flush_batch
+            mqtt_listener.start_ingest_writer(1)
+            broker = None
+            started = time.perf_counter()
+            try:
+                if mode == "direct":
+                    run_direct(mqtt_listener, tracker, messages, args.rate)
+                elif mode == "broker":
+                    broker = run_broker(mqtt_listener, tracker, messages, args.rate, args.publishers)
+                else:
+                    raise SystemExit(f"unknown mode {mode!r}")
+                # Malformed readings are dropped by flush_batch too, so every message ends up in a batch
+                tracker.expect(total)
+                if not tracker.all_done.wait(timeout=600):
+                    raise SystemExit(f"only {tracker.done} of {total} messages arrived")
+                elapsed = time.perf_counter() - started
+            finally:
+                mqtt_listener.stop_ingest_writer()
+                mqtt_listener.flush_batch = tracker.flush_batch
+                if broker is not None:
+                    # The listener's client would keep reconnecting to the stopped broker
+                    mqtt_listener.RECONNECT_DELAY = 3600
+                    broker.stop()
+                    time.sleep(0.2)
+
+        conn = database.get_connection()
+        # Growth of the database proper, not of the WAL that happens to be pending
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        stored = conn.execute("SELECT COUNT(*) FROM telemetry").fetchone()[0]
+        alerts = conn.execute("SELECT COUNT(*) FROM alerts").fetchone()[0]
+        depth = conn.execute("SELECT kind, COUNT(*) FROM outbox GROUP BY kind ORDER BY kind").fetchall()
+        growth = db_size(database.DB_PATH) - size_before
+        latencies = sorted(tracker.latencies)
+        print(f"{mode:>7} {stored / elapsed:>8.0f} {percentile(latencies, 0.5) * 1000:>8.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.1f} {tracker.commits / total:>12.4f} "
+              f"{total - stored:>7} {alerts:>7} {growth / 1e6:>10.1f}MB {growth / max(stored, 1):>7.0f}  "
+              + ", ".join(f"{kind}={count}" for kind, count in depth))
+
+
+if __name__ == "__main__":
+    main()
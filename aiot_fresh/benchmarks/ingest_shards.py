@@ -0,0 +1,114 @@
+"""
+Listener ingest throughput vs. number of ingest worker processes.
+
+Feeds pre-encoded telemetry for many containers straight into mqtt_listener.on_message
+(no broker needed) and times how long the writer thread (1 worker) or the sharded
+worker processes take to commit all of it. Each run uses a fresh scratch database.
+
+    python -m benchmarks.ingest_shards --messages 20000 --containers 200 --workers 1,2,4
+
+All workers share one SQLite database, and SQLite allows one writer at a time: decoding,
+rule evaluation and payload encoding (prepare_telemetry) run in parallel, but the writes of
+each batch are serialized on the write lock. The per-worker columns show how much of the
+run each worker spent in flush_batch, waiting for the write lock and holding it. busy / held
+of a single worker bounds the speedup more workers can reach, given as many CPU cores.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_messages(count, containers):
+    messages = []
+    for i in range(count):
+        device_id = f"bench-{i % containers:04d}"
+        payload = {
+            "timestamp": f"2025-01-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}Z",
+            "temperature_c": 4.0 + i % 7 * 0.1,
+            "humidity_pct": 85.0,
+            "mq4_ppm": 120.0,
+            "gps": {"lat": 3.1, "lon": 101.6, "fix": True, "satellites": 7},
+        }
+        messages.append(Message(f"containers/{device_id}/telemetry", json.dumps(payload).encode()))
+    return messages
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    """Silences the per-batch log lines, including those of the worker processes."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--containers", type=int, default=200)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="aiot-bench-")
+    # Point the services (and the workers they spawn) at a scratch DB before they are imported
+    os.environ["AIOT_DB_PATH"] = os.path.join(scratch, "aiot.db")
+    os.environ["AIOT_OUTBOX_SOCKET"] = os.path.join(scratch, "outbox.sock")
+    os.environ["AIOT_METRICS_DIR"] = os.path.join(scratch, "metrics")
+    import database
+    import init_db
+    import mqtt_listener
+
+    messages = make_messages(args.messages, args.containers)
+    print(f"{args.messages} messages over {args.containers} containers")
+    print(f"{os.cpu_count()} CPU cores")
+    print(f"{'workers':>8} {'seconds':>9} {'msg/s':>10} {'speedup':>8}  per-worker messages / busy / lock wait / lock held")
+    baseline = None
+    for run, workers in enumerate(int(w) for w in args.workers.split(",")):
+        # Fresh database per run, so every run starts from the same table sizes
+        database.close_connections()
+        database.DB_PATH = os.environ["AIOT_DB_PATH"] = os.path.join(scratch, f"aiot-{run}.db")
+
+        with quiet_stdout():
+            init_db.migrate(database.get_connection())
+            mqtt_listener.start_ingest_writer(workers)
+            # Let the worker processes finish starting up before the clock starts
+            time.sleep(2 if workers > 1 else 0)
+            started = time.perf_counter()
+            for message in messages:
+                mqtt_listener.on_message(None, None, message)
+            metrics_source = list(mqtt_listener._shards)
+            mqtt_listener.stop_ingest_writer()
+            elapsed = time.perf_counter() - started
+
+        stored = database.get_connection().execute("SELECT COUNT(*) FROM telemetry").fetchone()[0]
+        if stored != args.messages:
+            raise SystemExit(f"only {stored} of {args.messages} messages were stored")
+        per_worker = [shard["stats"] for shard in metrics_source] or [mqtt_listener._stats]
+        rate = args.messages / elapsed
+        baseline = baseline or rate
+        detail = ", ".join(f"{int(stats[0])}/{stats[3] / elapsed:.0%}/{stats[4] / elapsed:.0%}/{stats[5] / elapsed:.0%}"
+                           for stats in per_worker)
+        print(f"{workers:>8} {elapsed:>9.2f} {rate:>10.0f} {rate / baseline:>7.1f}x  {detail}")
+        mqtt_listener._stats[:] = [0.0] * len(mqtt_listener.STAT_FIELDS)
+
+
+if __name__ == "__main__":
+    main()
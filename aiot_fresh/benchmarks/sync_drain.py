@@ -0,0 +1,134 @@
+"""
+Outbox drain throughput vs. number of sync workers.
+
+Fills a scratch database with outbox items spread over many containers and drains
+it through cloud_sync.drain_outbox, using a stand-in Firestore client that
+adds a fixed round-trip latency to every commit. Prints items/s per worker count.
+
+    python -m benchmarks.sync_drain --items 5000 --containers 200 --latency-ms 80
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def set(self, data, merge=False):
+        self.client.round_trip(1)
+
+    def update(self, data):
+        self.client.round_trip(1)
+
+
+class FakeCollection:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def document(self, doc_id):
+        return FakeDocument(self.client, f"{self.path}/{doc_id}")
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = 0
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes += 1
+
+    def update(self, doc_ref, data):
+        self.writes += 1
+
+    def commit(self):
+        self.client.round_trip(self.writes)
+
+
+class FakeFirestore:
+    """Stands in for firestore.client(): every commit costs one network round trip."""
+
+    def __init__(self, latency_s):
+        self.latency_s = latency_s
+        self.commits = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+
+    def round_trip(self, writes):
+        time.sleep(self.latency_s)
+        with self._lock:
+            self.commits += 1
+            self.writes += writes
+
+    def collection(self, path):
+        return FakeCollection(self, path)
+
+    def document(self, path):
+        return FakeDocument(self, path)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def fill_outbox(conn, items, containers):
+    rows = []
+    for i in range(items):
+        device_id = f"bench-{i % containers:04d}"
+        payload = {"device_id": device_id, "timestamp": f"2025-01-01T00:00:{i:09d}Z", "temperature_c": 4.0}
+        created_at = f"2025-01-01T00:00:00.{i:06d}"
+        rows.append(("telemetry", f"containers/{device_id}/telemetry", json.dumps(payload), created_at, created_at))
+    conn.executemany("""
+        INSERT INTO outbox (kind, target_path, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--containers", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=80.0, help="simulated Firestore round trip")
+    parser.add_argument("--workers", default="1,2,4,8,16", help="comma-separated worker counts")
+    args = parser.parse_args()
+
+    # Point the services at a scratch DB before they are imported
+    scratch = tempfile.mkdtemp(prefix="aiot-bench-")
+    os.environ["AIOT_DB_PATH"] = os.path.join(scratch, "aiot.db")
+    os.environ["AIOT_METRICS_DIR"] = os.path.join(scratch, "metrics")
+    import cloud_sync
+    import database
+    import init_db
+
+    conn = database.get_connection()
+    init_db.migrate(conn)
+
+    print(f"{args.items} items over {args.containers} containers, {args.latency_ms:.0f} ms per Firestore commit")
+    print(f"{'workers':>8} {'seconds':>9} {'items/s':>10} {'commits':>8} {'speedup':>8}")
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        fake = FakeFirestore(args.latency_ms / 1000)
+        cloud_sync.db = fake
+        cloud_sync.SYNC_WORKERS = workers
+        fill_outbox(conn, args.items, args.containers)
+
+        started = time.perf_counter()
+        cloud_sync.drain_outbox(conn)
+        elapsed = time.perf_counter() - started
+
+        left = conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if left:
+            raise SystemExit(f"{left} items were not drained")
+        rate = args.items / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>8} {elapsed:>9.2f} {rate:>10.0f} {fake.commits:>8} {rate / baseline:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,19 @@ import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
 import sqlite3
-import json
 import time
 import os
-from datetime import datetime
+import random
+import select
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import codec
+import database
+import init_db
+import metrics
+import outbox
+import profiling
 
 # --- Configuration ---
 # Path to your Firebase service account key
@@ -14,12 +23,41 @@ SERVICE_ACCOUNT_KEY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__
 FIREBASE_PROJECT_ID = "aiot-fresh-monitor" 
 
 # SQLite DB Path
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiot.db")
+DB_PATH = database.DB_PATH
 
-# Sync interval in seconds
+# Poll interval in seconds when the wakeup socket is unavailable
 SYNC_INTERVAL = 10 
-# Max retries for each outbox item before giving up (or marking for manual review)
-MAX_RETRIES = 5
+# With the wakeup socket, enqueuers wake us up; this is only a safety-net poll
+IDLE_WAKEUP_INTERVAL = 60
+# Max retries for each outbox item before it is moved to the outbox_dead table for manual review
+MAX_RETRIES = 10
+# Per-item exponential backoff: RETRY_BASE_DELAY * 2^(attempts-1) seconds, capped, with jitter
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 3600
+# Outbox rows read per query; bounds memory no matter how large the backlog is
+OUTBOX_CHUNK_SIZE = 500
+# Firestore accepts at most 500 writes per WriteBatch commit
+FIRESTORE_BATCH_LIMIT = 500
+# Number of containers synced in parallel. Each container's items are still sent in order.
+SYNC_WORKERS = int(os.environ.get("AIOT_SYNC_WORKERS", 4))
+
+_sync_executor = None
+_sync_executor_workers = 0
+
+# --- Metrics (served by app.py at /metrics, see metrics.py) ---
+FIRESTORE_WRITE_SECONDS = metrics.histogram(
+    "aiot_firestore_write_seconds", "Firestore write latency: batch commits and single-item retries.", ("op",))
+FIRESTORE_WRITE_FAILURES = metrics.counter("aiot_firestore_write_failures_total", "Failed Firestore writes.", ("op",))
+SYNC_ITEMS = metrics.counter(
+    "aiot_sync_items_total",
+    "Outbox items by kind and result: synced, failed (every failed attempt) or dead (moved to outbox_dead).",
+    ("kind", "result"))
+# Items wait out their backoff in the outbox, so this goes up to hours
+SYNC_QUEUE_TO_CLOUD_SECONDS = metrics.histogram(
+    "aiot_sync_queue_to_cloud_seconds", "Time from an item being queued to Firestore acknowledging it.", ("kind",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0))
+SQLITE_LOCK_WAIT_SECONDS = metrics.histogram(
+    "aiot_sqlite_lock_wait_seconds", "Time spent waiting for the SQLite write lock.", ("service",))
 
 # --- Firebase Initialization ---
 try:
@@ -38,33 +76,101 @@ except Exception as e:
 def get_db_connection():
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = database.get_connection()
     except sqlite3.Error as e:
         print(f"Database connection error: {e}")
     return conn
 
-def get_outbox_items(conn):
+def get_outbox_items(conn, now, after=None, limit=OUTBOX_CHUNK_SIZE):
+    """
+    Returns the next page of items due at `now`, in id (queueing) order, so a retried item
+    still comes before its container's newer ones. `after` is the id of the last item of the
+    previous page (keyset pagination on the primary key), so each page costs the same however
+    deep the backlog is; the rows skipped for not being due are only the backed-off few.
+    """
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM outbox WHERE attempts < ? ORDER BY created_at ASC", (MAX_RETRIES,))
+    cursor.execute("""
+        SELECT * FROM outbox WHERE next_attempt_at <= ? AND id > ?
+        ORDER BY id LIMIT ?
+    """, (now, 0 if after is None else after, limit))
     return cursor.fetchall()
 
-def delete_outbox_item(conn, item_id):
+def get_held_containers(conn, now):
+    """
+    Containers with an item backed off past `now`, mapped to the oldest such item's id.
+    Their newer items must wait for it, so they are not sent in this pass.
+    """
+    held = {}
+    for target_path, item_id in conn.execute(
+            "SELECT target_path, min(id) FROM outbox WHERE next_attempt_at > ? GROUP BY target_path", (now,)):
+        key = outbox_partition_key({"target_path": target_path})
+        held[key] = min(item_id, held.get(key, item_id))
+    return held
+
+def delete_outbox_items(conn, item_ids):
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
-    conn.commit()
+    cursor.executemany("DELETE FROM outbox WHERE id = ?", [(item_id,) for item_id in item_ids])
 
-def update_outbox_item_on_failure(conn, item_id, error_message):
+def mark_telemetry_synced(conn, acked_items):
+    """Flags the telemetry rows behind acked items as uploaded, so retention may purge them."""
     cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE outbox
-        SET attempts = attempts + 1, last_error = ?
-        WHERE id = ?
-    """, (error_message, item_id))
-    conn.commit()
+    cursor.executemany("UPDATE telemetry SET synced = 1 WHERE id = ?", [
+        (item["ref_id"],) for item in acked_items
+        if item["kind"] == "telemetry" and item["ref_id"] is not None
+    ])
+
+def retry_delay(attempts):
+    """Seconds before the next attempt: exponential in attempts, capped, with equal jitter."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return random.uniform(delay / 2, delay)
+
+def update_outbox_items_on_failure(conn, failures, attempts_by_id, kind_by_id=None):
+    """
+    failures: list of (item_id, error_message); attempts_by_id: attempts before this failure.
+    kind_by_id: item kinds, for the metrics.
+    Schedules a backed-off retry, or moves the item to outbox_dead once MAX_RETRIES is reached.
+    """
+    cursor = conn.cursor()
+    now = datetime.utcnow()
+    kind_by_id = kind_by_id or {}
+    dead = 0
+    for item_id, error_message in failures:
+        attempts = attempts_by_id[item_id] + 1
+        if attempts >= MAX_RETRIES:
+            SYNC_ITEMS.inc(kind=kind_by_id.get(item_id, "unknown"), result="dead")
+            cursor.execute("""
+                INSERT INTO outbox_dead (id, kind, target_path, payload, ref_id, attempts, last_error, created_at, failed_at)
+                SELECT id, kind, target_path, payload, ref_id, ?, ?, created_at, ? FROM outbox WHERE id = ?
+            """, (attempts, error_message, now.isoformat(), item_id))
+            cursor.execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+            dead += 1
+        else:
+            next_attempt_at = (now + timedelta(seconds=retry_delay(attempts))).isoformat()
+            cursor.execute("""
+                UPDATE outbox
+                SET attempts = ?, last_error = ?, next_attempt_at = ?
+                WHERE id = ?
+            """, (attempts, error_message, next_attempt_at, item_id))
+    if dead:
+        print(f"Moved {dead} outbox items to outbox_dead after {MAX_RETRIES} failed attempts.")
 
 # --- Sync Logic ---
-def sync_telemetry(payload, target_path):
+# Each sync_* function writes one outbox item. With a WriteBatch the write is only
+# staged and goes out when the batch is committed; without one it is sent immediately.
+# Calls are timed (aiot_span_seconds) and those slower than AIOT_SLOW_SYNC_MS are logged.
+def write_document(doc_ref, data, batch=None, merge=False, update=False):
+    if batch is None:
+        if update:
+            doc_ref.update(data)
+        else:
+            doc_ref.set(data, merge=merge)
+    elif update:
+        batch.update(doc_ref, data)
+    else:
+        batch.set(doc_ref, data, merge=merge)
+
+@profiling.timed("sync_telemetry", profiling.SLOW_SYNC_S)
+def sync_telemetry(payload, target_path, batch=None):
     if not db:
         raise Exception("Firebase not initialized.")
     
@@ -76,10 +182,12 @@ def sync_telemetry(payload, target_path):
         
     # The collection path is the target_path from the outbox
     doc_ref = db.collection(target_path).document(doc_id)
-    doc_ref.set(payload)
-    print(f"Synced telemetry to {doc_ref.path}")
+    write_document(doc_ref, payload, batch)
+    if batch is None:
+        print(f"Synced telemetry to {doc_ref.path}")
 
-def sync_alert(payload, target_path):
+@profiling.timed("sync_alert", profiling.SLOW_SYNC_S)
+def sync_alert(payload, target_path, batch=None):
     if not db:
         raise Exception("Firebase not initialized.")
     
@@ -91,10 +199,12 @@ def sync_alert(payload, target_path):
 
     # The collection path is the target_path from the outbox
     doc_ref = db.collection(target_path).document(doc_id)
-    doc_ref.set(payload)
-    print(f"Synced alert to {doc_ref.path}")
+    write_document(doc_ref, payload, batch)
+    if batch is None:
+        print(f"Synced alert to {doc_ref.path}")
 
-def sync_config(payload, target_path):
+@profiling.timed("sync_config", profiling.SLOW_SYNC_S)
+def sync_config(payload, target_path, batch=None):
     if not db:
         raise Exception("Firebase not initialized.")
     
@@ -114,54 +224,284 @@ def sync_config(payload, target_path):
         "source": payload.get("source"),
         # Potentially other container metadata if decided later
     }
-    doc_ref.set(update_data, merge=True) # Use merge=True to only update specified fields
-    print(f"Synced config for {container_id} to {doc_ref.path}")
+    write_document(doc_ref, update_data, batch, merge=True) # Use merge=True to only update specified fields
+    if batch is None:
+        print(f"Synced config for {container_id} to {doc_ref.path}")
 
-def sync_container_summary(payload, target_path):
+@profiling.timed("sync_container_summary", profiling.SLOW_SYNC_S)
+def sync_container_summary(payload, target_path, batch=None):
     """Handles the 'container_summary' kind to update the main container doc."""
     if not db:
         raise Exception("Firebase not initialized.")
     
     # target_path will be "containers/{container_id}"
     doc_ref = db.document(target_path)
-    doc_ref.update(payload) # Use update to merge the new summary data
-    print(f"Synced container summary to {doc_ref.path}")
+    write_document(doc_ref, payload, batch, update=True) # Use update to merge the new summary data
+    if batch is None:
+        print(f"Synced container summary to {doc_ref.path}")
+
+@profiling.timed("sync_food_type", profiling.SLOW_SYNC_S)
+def sync_food_type(payload, target_path, batch=None):
+    """Handles the 'food_type' kind: the Pi's food type editor is authoritative for food_types/{id}."""
+    if not db:
+        raise Exception("Firebase not initialized.")
+
+    doc_ref = db.document(target_path)
+    write_document(doc_ref, payload, batch, merge=True)
+    if batch is None:
+        print(f"Synced food type to {doc_ref.path}")
 
-def process_outbox_item(conn, item):
-    item_id = item["id"]
-    kind = item["kind"]
-    target_path = item["target_path"]
-    payload = json.loads(item["payload"])
+SYNC_HANDLERS = {
+    "telemetry": sync_telemetry,
+    "alert": sync_alert,
+    "config": sync_config,
+    "container_summary": sync_container_summary,
+    "food_type": sync_food_type,
+}
 
-    try:
-        if kind == "telemetry":
-            sync_telemetry(payload, target_path)
-        elif kind == "alert":
-            sync_alert(payload, target_path)
-        elif kind == "config":
-            sync_config(payload, target_path)
-        elif kind == "container_summary":
-            sync_container_summary(payload, target_path)
-        else:
-            print(f"Unknown item kind in outbox: {kind}. Deleting item {item_id}.")
-            delete_outbox_item(conn, item_id)
-            return
+@profiling.timed("firestore_batch_commit", profiling.SLOW_SYNC_S)
+def commit_batch(batch):
+    batch.commit()
 
-        delete_outbox_item(conn, item_id)
-        print(f"Successfully synced and removed outbox item {item_id} ({kind})")
+def sync_outbox_chunk(items):
+    """
+    Sends up to FIRESTORE_BATCH_LIMIT outbox items (all for one container, oldest first)
+    in one WriteBatch commit. Returns (acked_ids, failures) where failures is a list of
+    (item_id, error_message).
 
+    A WriteBatch is all-or-nothing, so when the commit fails its items are retried one
+    by one; attempts/last_error then only grow for the item that actually fails.
+    Nothing after the first failing item is sent, so a container's writes never
+    overtake an earlier one that has not been synced yet.
+    """
+    acked_ids = []
+    staging_failure = None
+    batch = db.batch()
+    staged = []
+    for item in items:
+        item_id, kind = item["id"], item["kind"]
+        handler = SYNC_HANDLERS.get(kind)
+        if handler is None:
+            print(f"Unknown item kind in outbox: {kind}. Deleting item {item_id}.")
+            acked_ids.append(item_id)
+            continue
+        try:
+            handler(codec.decode_payload(item["payload"]), item["target_path"], batch)
+            staged.append((item, handler))
+        except Exception as e:
+            # Bad payloads fail here, before anything is sent
+            staging_failure = (item_id, str(e))
+            print(f"Failed to sync outbox item {item_id} ({kind}): {e}")
+            break
+
+    failures = [staging_failure] if staging_failure else []
+    if not staged:
+        return acked_ids, failures
+    try:
+        with FIRESTORE_WRITE_SECONDS.time(op="batch"):
+            commit_batch(batch)
+        acked_ids.extend(item["id"] for item, _ in staged)
     except Exception as e:
-        error_message = str(e)
-        print(f"Failed to sync outbox item {item_id} ({kind}): {error_message}")
-        update_outbox_item_on_failure(conn, item_id, error_message)
-        if db is None: # If Firebase is not initialized, assume no connectivity
-            print("Firebase is not initialized. Assuming no internet connectivity.")
-            # Re-raise to ensure the main loop doesn't try to sync other items if there's a fundamental issue
-            raise e 
+        FIRESTORE_WRITE_FAILURES.inc(op="batch")
+        print(f"Batch commit of {len(staged)} items failed ({e}); retrying items individually.")
+        for item, handler in staged:
+            try:
+                with FIRESTORE_WRITE_SECONDS.time(op="single"):
+                    handler(codec.decode_payload(item["payload"]), item["target_path"])
+                acked_ids.append(item["id"])
+            except Exception as item_error:
+                FIRESTORE_WRITE_FAILURES.inc(op="single")
+                # Later items (including any staging failure) wait for the next pass
+                failures = [(item["id"], str(item_error))]
+                print(f"Failed to sync outbox item {item['id']} ({item['kind']}): {item_error}")
+                break
+    return acked_ids, failures
+
+def outbox_partition_key(item):
+    """Container an outbox item belongs to; target_path is '<collection>/<container_id>[/...]'."""
+    parts = item["target_path"].split("/")
+    return parts[1] if len(parts) > 1 else item["target_path"]
+
+def sync_partition(items):
+    """Worker: syncs one container's items in order, stopping at the first failure."""
+    acked_ids = []
+    failures = []
+    for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        chunk_acked, chunk_failures = sync_outbox_chunk(items[start:start + FIRESTORE_BATCH_LIMIT])
+        acked_ids.extend(chunk_acked)
+        failures.extend(chunk_failures)
+        if chunk_failures:
+            break
+    return acked_ids, failures
+
+def get_sync_executor():
+    global _sync_executor, _sync_executor_workers
+    if _sync_executor is None or _sync_executor_workers != SYNC_WORKERS:
+        if _sync_executor is not None:
+            _sync_executor.shutdown(wait=True)
+        _sync_executor = ThreadPoolExecutor(max_workers=max(1, SYNC_WORKERS), thread_name_prefix="sync")
+        _sync_executor_workers = SYNC_WORKERS
+    return _sync_executor
+
+def process_outbox_items(conn, items, held=None):
+    """
+    Partitions outbox items by container and syncs up to SYNC_WORKERS containers in
+    parallel. Workers only talk to Firestore; this thread applies each partition's result
+    (delete acked rows, mark their telemetry synced, record failures) in a single local transaction.
+
+    `held` maps containers to the id of an item of theirs that is backed off (see
+    get_held_containers) or failed earlier in this pass; their newer items are skipped so
+    they cannot overtake it. Containers failing now are added. Returns the number of items sent.
+    """
+    if not db:
+        raise Exception("Firebase not initialized.")
+    if held is None:
+        held = {}
+
+    partitions = {}
+    for item in items:
+        key = outbox_partition_key(item)
+        if item["id"] < held.get(key, float("inf")):
+            partitions.setdefault(key, []).append(item)
+    attempts_by_id = {item["id"]: item["attempts"] for item in items}
+    items_by_id = {item["id"]: item for item in items}
+    kind_by_id = {item["id"]: item["kind"] for item in items}
+
+    executor = get_sync_executor()
+    futures = {executor.submit(sync_partition, partition): key for key, partition in partitions.items()}
+    synced = failed = 0
+    for future in as_completed(futures):
+        acked_ids, failures = future.result()
+        if failures:
+            key = futures[future]
+            held[key] = min(held.get(key, float("inf")), *(item_id for item_id, _ in failures))
+        acked_items = [items_by_id[item_id] for item_id in acked_ids]
+        begin_write(conn)
+        delete_outbox_items(conn, acked_ids)
+        mark_telemetry_synced(conn, acked_items)
+        update_outbox_items_on_failure(conn, failures, attempts_by_id, kind_by_id)
+        conn.commit()
+        report_sync_latency(acked_items)
+        for item_id, _ in failures:
+            SYNC_ITEMS.inc(kind=kind_by_id[item_id], result="failed")
+        synced += len(acked_ids)
+        failed += len(failures)
+    print(f"Synced and removed {synced} outbox items across {len(partitions)} containers; {failed} failed.")
+    return sum(len(partition) for partition in partitions.values())
+
+def begin_write(conn):
+    """Takes the write lock up front, like the listener, so the wait shows up in the metrics."""
+    if conn.in_transaction:
+        return
+    lock_requested = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    finally:
+        SQLITE_LOCK_WAIT_SECONDS.observe(time.perf_counter() - lock_requested, service="cloud_sync")
+
+def sync_latency(item, now=None):
+    """Seconds between an item being queued and Firestore acknowledging it."""
+    try:
+        queued_at = datetime.fromisoformat(item["created_at"])
+    except (TypeError, ValueError):
+        return None
+    return ((now or datetime.utcnow()) - queued_at).total_seconds()
+
+def report_sync_latency(acked_items):
+    now = datetime.utcnow()
+    latencies = []
+    for item in acked_items:
+        SYNC_ITEMS.inc(kind=item["kind"], result="synced")
+        latency = sync_latency(item, now)
+        if latency is None:
+            continue
+        SYNC_QUEUE_TO_CLOUD_SECONDS.observe(latency, kind=item["kind"])
+        # Alerts are the latency-sensitive kind: they must reach the phones quickly
+        if item["kind"] == "alert":
+            latencies.append(latency)
+    if latencies:
+        print(f"Alert queue-to-cloud latency: max {max(latencies):.2f}s over {len(latencies)} alerts")
+
+def drain_outbox(conn, resume=None):
+    """
+    Syncs every item due now, OUTBOX_CHUNK_SIZE rows at a time. Returns (items sent, resume);
+    due items held back behind a backed-off one are not counted, so the loop then waits.
+
+    After a pass that sent nothing, resume records what it read: passed to the next call,
+    the items up to `after` are skipped while the same containers are held, as they are all
+    still waiting. Otherwise every enqueue poke would re-read a held container's whole backlog.
+    """
+    now = datetime.utcnow().isoformat()
+    held = get_held_containers(conn, now)
+    after = None
+    if resume is not None and resume["held"] == held:
+        after = resume["after"]
+    held_at_start = dict(held)
+    sent = 0
+    while True:
+        items = get_outbox_items(conn, now, after)
+        if not items:
+            break
+        print(f"Found {len(items)} due items in outbox to sync.")
+        sent += process_outbox_items(conn, items, held)
+        after = items[-1]["id"]
+    if sent:
+        return sent, None
+    return sent, {"held": held_at_start, "after": after, "now": now}
+
+# --- Wakeup ---
+def open_wakeup_socket():
+    """Binds outbox.NOTIFY_SOCKET so enqueuers can wake the loop. Returns None if unavailable."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        try:
+            os.unlink(outbox.NOTIFY_SOCKET)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(outbox.NOTIFY_SOCKET)
+        sock.setblocking(False)
+        return sock
+    except OSError as e:
+        print(f"Could not open outbox wakeup socket ({e}); polling every {SYNC_INTERVAL}s instead.")
+        return None
+
+def seconds_until_next_due(conn, now):
+    """
+    Time from `now` until the earliest backed-off item becomes due, or None if there is none.
+    Items already due at `now` that were not sent are held behind one of these, so they do not count.
+    """
+    row = conn.execute("SELECT min(next_attempt_at) FROM outbox WHERE next_attempt_at > ?", (now,)).fetchone()
+    if row[0] is None:
+        return None
+    try:
+        due = datetime.fromisoformat(row[0])
+    except ValueError:
+        return 0
+    return max(0.0, (due - datetime.utcnow()).total_seconds())
+
+def wait_for_work(sock, timeout):
+    """Sleeps until an enqueuer pokes the socket or `timeout` seconds pass."""
+    if sock is None:
+        time.sleep(timeout)
+        return
+    ready, _, _ = select.select([sock], [], [], timeout)
+    if ready:
+        # Several commits may have poked us; one drain covers them all
+        while True:
+            try:
+                sock.recv(64)
+            except OSError:
+                break
 
 def main_sync_loop():
+    wakeup_socket = open_wakeup_socket()
+    idle_timeout = IDLE_WAKEUP_INTERVAL if wakeup_socket else SYNC_INTERVAL
+    resume = None
     while True:
         conn = None
+        timeout = idle_timeout
         try:
             conn = get_db_connection()
             if not conn:
@@ -169,28 +509,34 @@ def main_sync_loop():
                 time.sleep(SYNC_INTERVAL)
                 continue
 
-            items = get_outbox_items(conn)
-            if items:
-                print(f"Found {len(items)} items in outbox to sync.")
-                for item in items:
-                    process_outbox_item(conn, item)
-            else:
-                print("Outbox is empty. Waiting for new items...")
+            sent, resume = drain_outbox(conn, resume)
+            if sent:
+                # There was work; go straight back in case more arrived while we were syncing
+                continue
+            print("No outbox items due. Waiting for new items...")
+            next_due = seconds_until_next_due(conn, resume["now"])
+            if next_due is not None:
+                timeout = min(timeout, next_due)
 
         except Exception as e:
             print(f"Main sync loop error: {e}")
+            resume = None
             # If a sync failure indicates broader connectivity issues (e.g., Firebase init failed),
             # wait longer before retrying to avoid spamming logs/retries.
             if "Firebase not initialized" in str(e):
                 time.sleep(SYNC_INTERVAL * 5) # Longer wait if Firebase is down
             else:
                 time.sleep(SYNC_INTERVAL)
+            continue
         finally:
             if conn:
-                conn.close()
-        
-        time.sleep(SYNC_INTERVAL)
+                database.release_connections()
+
+        wait_for_work(wakeup_socket, timeout)
 
 if __name__ == "__main__":
     print("Starting Cloud Sync Service...")
+    # kill -USR1 <pid> writes a sampling profile (see profiling.py)
+    profiling.install_signal_handler("cloud_sync")
+    init_db.migrate(database.get_connection())
     main_sync_loop()
@@ -0,0 +1,102 @@
+"""
+codec.py
+Serialization on the hot paths: decoding telemetry in the listener, outbox payloads
+(written by the listener and portal, read by cloud_sync), dashboard events and the
+portal's JSON responses.
+
+JSON goes through orjson when it is installed (optional, like numpy for anomaly.py)
+and through the stdlib json module otherwise. AIOT_JSON_BACKEND=stdlib forces the
+latter.
+
+outbox.payload holds JSON text by default. With AIOT_OUTBOX_CODEC=msgpack (and msgpack
+installed) new payloads are written as msgpack BLOBs instead, which are smaller and
+quicker to decode. decode_payload reads both, so rows written before a switch in
+either direction, and dead-lettered items, stay readable:
+ - TEXT, or a BLOB starting with "{": JSON
+ - any other BLOB: msgpack (payloads are always objects, and a msgpack map never starts with "{")
+"""
+
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is optional: the stdlib json module is used instead
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # msgpack is optional: outbox payloads stay JSON
+    msgpack = None
+
+JSON_BACKEND = os.environ.get("AIOT_JSON_BACKEND", "auto")
+OUTBOX_CODEC = os.environ.get("AIOT_OUTBOX_CODEC", "json")
+
+if JSON_BACKEND == "stdlib" or orjson is None:
+    if JSON_BACKEND == "orjson":
+        print("AIOT_JSON_BACKEND=orjson but orjson is not installed; using the json module.")
+    JSON_BACKEND = "stdlib"
+else:
+    JSON_BACKEND = "orjson"
+
+if OUTBOX_CODEC == "msgpack" and msgpack is None:
+    print("AIOT_OUTBOX_CODEC=msgpack but msgpack is not installed; writing JSON outbox payloads.")
+    OUTBOX_CODEC = "json"
+# The listener stores telemetry in the outbox as received when this is set
+OUTBOX_STORES_JSON = OUTBOX_CODEC != "msgpack"
+
+
+# ---------------------------
+# JSON
+# ---------------------------
+if JSON_BACKEND == "orjson":
+    loads = orjson.loads
+
+    def dumps(obj, default=None, sort_keys=False, indent=False):
+        """JSON text for obj. default() is called for types the encoder does not know."""
+        # Leave dates and dataclasses to default() (a TypeError without one), so output
+        # matches the stdlib path and a payload never depends on which backend wrote it
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option).decode()
+else:
+    loads = json.loads
+
+    def dumps(obj, default=None, sort_keys=False, indent=False):
+        """JSON text for obj. default() is called for types the encoder does not know."""
+        if indent:
+            return json.dumps(obj, default=default, sort_keys=sort_keys, indent=2)
+        return json.dumps(obj, default=default, sort_keys=sort_keys, separators=(",", ":"))
+
+
+# ---------------------------
+# Outbox payloads
+# ---------------------------
+def encode_payload(payload):
+    """The outbox.payload value for a payload: JSON text, or a msgpack BLOB."""
+    if OUTBOX_CODEC == "msgpack":
+        return msgpack.packb(payload, use_bin_type=True)
+    return dumps(payload)
+
+
+def decode_payload(value):
+    """Reads an outbox.payload value in any of the formats it may have been written in."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        if value[:1] != b"{":
+            if msgpack is None:
+                raise ValueError("Outbox payload is msgpack, but msgpack is not installed.")
+            return msgpack.unpackb(value, raw=False)
+    return loads(value)
+
+
+def payload_text(value):
+    """An outbox.payload value as JSON text, for the portal's admin views."""
+    if isinstance(value, str) or value is None:
+        return value
+    try:
+        return dumps(decode_payload(value))
+    except ValueError:
+        return bytes(value).hex()
@@ -3,12 +3,12 @@ import sqlite3
 import bcrypt
 import getpass
 import os
+import database
 
 # This script will clear the users table and create a new user.
 # Ideal for resetting credentials in a development environment.
 
-DB_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(DB_DIR, "aiot.db")
+DB_PATH = database.DB_PATH
 
 def main():
     """
@@ -19,8 +19,9 @@ def main():
         print("Please run `python3 init_db.py` first.")
         return
 
+    conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = database.connect()
         cursor = conn.cursor()
 
         # 1. Clear the entire users table
@@ -0,0 +1,148 @@
+"""
+database.py
+Shared SQLite access layer for the AIoT Fresh services (app, auth, mqtt_listener, cloud_sync).
+
+All services open aiot.db through here so they agree on the journal mode and
+locking behaviour:
+ - WAL journal, so the portal can read while the listener and sync loop write
+ - busy_timeout, so a writer waits for the lock instead of failing with "database is locked"
+ - synchronous=NORMAL (safe with WAL, one fsync per checkpoint instead of per commit)
+ - mmap and page cache sizes tuned for the Pi
+ - incremental auto_vacuum on new databases, so retention.py can hand freed pages back to the SD card
+
+Connections are reused per thread (and per process, so forked gunicorn workers
+never share a parent's handle). The portal's threaded server runs each request on
+a new thread, so it hands its connections back to a small shared pool at the end
+of each request (return_connections) rather than opening new ones every time.
+"""
+
+import os
+import sqlite3
+import threading
+
+DB_PATH = os.environ.get(
+    "AIOT_DB_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiot.db"),
+)
+
+BUSY_TIMEOUT_MS = int(os.environ.get("AIOT_DB_BUSY_TIMEOUT_MS", 10000))
+SYNCHRONOUS = os.environ.get("AIOT_DB_SYNCHRONOUS", "NORMAL")
+MMAP_SIZE = int(os.environ.get("AIOT_DB_MMAP_SIZE", 64 * 1024 * 1024))
+# Negative values are KiB, as in PRAGMA cache_size
+CACHE_SIZE = int(os.environ.get("AIOT_DB_CACHE_SIZE", -8000))
+
+# Idle connections kept for the next request thread (per kind: read-write and read-only)
+POOL_SIZE = int(os.environ.get("AIOT_DB_POOL_SIZE", 4))
+
+_local = threading.local()
+_pool = {"rw": [], "ro": []}
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _apply_pragmas(conn, readonly=False):
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    if not readonly:
+        # Only takes effect when the file is created (existing databases are converted
+        # with `retention.py --enable-incremental-vacuum`), so it must precede journal_mode.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # journal_mode is persistent in the file, but setting it is cheap and
+        # upgrades databases created before WAL was enabled.
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+    if readonly:
+        conn.execute("PRAGMA query_only = 1")
+
+
+def connect(readonly=False, **kwargs):
+    """Opens a new tuned connection. Callers own it and must close it."""
+    if readonly:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True,
+                               timeout=BUSY_TIMEOUT_MS / 1000, **kwargs)
+    else:
+        conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, **kwargs)
+    conn.row_factory = sqlite3.Row
+    _apply_pragmas(conn, readonly)
+    return conn
+
+
+def _pooled(name, pid):
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != pid:
+            # Inherited from the parent process: not ours to use (or close)
+            _pool["rw"], _pool["ro"] = [], []
+            _pool_pid = pid
+        return _pool[name].pop() if _pool[name] else None
+
+
+def _cached(name, readonly):
+    pid = os.getpid()
+    conn = getattr(_local, name, None)
+    if conn is not None and getattr(_local, "pid", None) == pid:
+        return conn
+    conn = _pooled(name, pid)
+    if conn is None:
+        # Owned by one thread at a time, but may move to another through the pool
+        conn = connect(readonly=readonly, check_same_thread=False)
+    setattr(_local, name, conn)
+    _local.pid = pid
+    return conn
+
+
+def get_connection():
+    """Returns this thread's shared read-write connection. Do not close it."""
+    return _cached("rw", readonly=False)
+
+
+def get_readonly_connection():
+    """Returns this thread's shared read-only connection (for the Flask API). Do not close it."""
+    return _cached("ro", readonly=True)
+
+
+def release_connections():
+    """
+    Rolls back anything a failed request or message left open on this thread's
+    connections, so the next user of the connection starts clean.
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        return
+    for name in ("rw", "ro"):
+        conn = getattr(_local, name, None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+
+
+def return_connections():
+    """
+    Releases this thread's connections and hands them to the shared pool, for the next
+    request thread to reuse (past POOL_SIZE idle ones they are closed). For servers that
+    run each request on a new thread; long-lived threads keep theirs with release_connections().
+    """
+    release_connections()
+    pid = os.getpid()
+    if getattr(_local, "pid", None) != pid:
+        return
+    for name in ("rw", "ro"):
+        conn = getattr(_local, name, None)
+        if conn is None:
+            continue
+        setattr(_local, name, None)
+        with _pool_lock:
+            pooled = _pool_pid == pid and len(_pool[name]) < POOL_SIZE
+            if pooled:
+                _pool[name].append(conn)
+        if not pooled:
+            conn.close()
+
+
+def close_connections():
+    """Closes this thread's shared connections."""
+    for name in ("rw", "ro"):
+        conn = getattr(_local, name, None)
+        if conn is not None:
+            if getattr(_local, "pid", None) == os.getpid():
+                conn.close()
+            setattr(_local, name, None)
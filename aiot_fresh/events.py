@@ -0,0 +1,110 @@
+"""
+events.py
+Live change feed behind the dashboard's /api/stream (Server-Sent Events).
+
+mqtt_listener publishes the events of each committed batch as one message on
+EVENTS_TOPIC. Every portal process runs a single subscriber thread that fans the
+events out to one bounded queue per open stream, so the number of dashboards
+adds no database load.
+
+Event types:
+ - telemetry: {"device_id", "last_seen", "last_telemetry"} (same shape as /api/devices)
+ - alert: {"device_id", "alert"} for a newly raised alert
+ - alerts_resolved: {"device_id", "alerts": [[alert_type, level], ...]}
+ - resync: the stream fell behind and dropped events; the client should reload
+"""
+
+import queue
+import threading
+import time
+import paho.mqtt.client as mqtt
+import codec
+
+EVENTS_TOPIC = "aiot/events"
+# Events buffered per stream before a slow client is told to resync
+STREAM_QUEUE_SIZE = 256
+RECONNECT_DELAY = 5
+
+_streams = set()
+_streams_lock = threading.Lock()
+_subscriber_thread = None
+
+
+# ---------------------------
+# Publishing (mqtt_listener)
+# ---------------------------
+def publish_events(client, events):
+    """Publishes one batch of events. QoS 0: a dashboard that misses one catches up on reconnect."""
+    if client is not None and events:
+        client.publish(EVENTS_TOPIC, codec.dumps({"events": events}), qos=0)
+
+
+# ---------------------------
+# Fan-out (portal)
+# ---------------------------
+def open_stream():
+    stream = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    with _streams_lock:
+        _streams.add(stream)
+    return stream
+
+
+def close_stream(stream):
+    with _streams_lock:
+        _streams.discard(stream)
+
+
+def dispatch(events):
+    with _streams_lock:
+        streams = list(_streams)
+    for stream in streams:
+        for event in events:
+            try:
+                stream.put_nowait(event)
+            except queue.Full:
+                # Drop the backlog rather than block the subscriber on one slow client
+                while True:
+                    try:
+                        stream.get_nowait()
+                    except queue.Empty:
+                        break
+                stream.put_nowait({"type": "resync"})
+                break
+
+
+def _on_connect(client, userdata, flags, rc):
+    client.subscribe(EVENTS_TOPIC, qos=0)
+    # Anything published while we were disconnected is lost; have open dashboards reload
+    dispatch([{"type": "resync"}])
+
+
+def _on_message(client, userdata, msg):
+    try:
+        dispatch(codec.loads(msg.payload)["events"])
+    except Exception as e:
+        print("Error dispatching events:", e)
+
+
+def _run_subscriber(host, port, username, password):
+    while True:
+        try:
+            client = mqtt.Client()
+            if username:
+                client.username_pw_set(username, password)
+            client.on_connect = _on_connect
+            client.on_message = _on_message
+            client.connect(host, port, 60)
+            client.loop_forever()
+        except Exception as e:
+            print("Event subscriber connection error:", e)
+            time.sleep(RECONNECT_DELAY)
+
+
+def start_event_subscriber(host, port=1883, username="", password=""):
+    """Starts this process's subscriber thread (once)."""
+    global _subscriber_thread
+    with _streams_lock:
+        if _subscriber_thread is None or not _subscriber_thread.is_alive():
+            _subscriber_thread = threading.Thread(target=_run_subscriber, args=(host, port, username, password),
+                                                  name="event-subscriber", daemon=True)
+            _subscriber_thread.start()
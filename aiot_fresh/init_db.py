@@ -10,6 +10,8 @@ Creates tables:
  - change_log
  - outbox
  - users
+Then applies versioned migrations (indexes and later schema changes) tracked
+in PRAGMA user_version, so deployed databases are upgraded in place.
 Idempotent: safe to run multiple times.
 """
 
@@ -17,22 +19,23 @@ import os
 import sqlite3
 import json
 from datetime import datetime
+import database
 
-# Use a local path for development to avoid permission issues
-DB_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(DB_DIR, "aiot.db")
+DB_PATH = database.DB_PATH
+DB_DIR = os.path.dirname(DB_PATH)
 
 def ensure_dir():
-    # Directory is guaranteed to exist since it's the current script's directory
-    pass
+    # AIOT_DB_PATH may point outside the source tree (e.g. /var/lib/aiot_fresh)
+    os.makedirs(DB_DIR, exist_ok=True)
 
 def connect():
-    return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    return database.connect(detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
 
 def init_schema(conn):
     cur = conn.cursor()
 
     # food_types table: id TEXT PRIMARY KEY, display_name, thresholds JSON, notes
+    # (migrations 7 and 8 add shelf_life JSON and last_modified)
     cur.execute("""
     CREATE TABLE IF NOT EXISTS food_types (
         id TEXT PRIMARY KEY,
@@ -124,6 +127,271 @@ def init_schema(conn):
 
     conn.commit()
 
+# ---------------------------
+# Versioned migrations
+# ---------------------------
+def mark_existing_telemetry_synced(conn):
+    """
+    Older items carry no ref_id, so infer which history already reached Firestore: a reading
+    received well before the device's oldest pending or dead-lettered telemetry item was
+    queued has been uploaded. The hour of margin covers the gap between a message arriving
+    and its batch being committed.
+    """
+    cutoffs = conn.execute("""
+        SELECT target_path, strftime('%Y-%m-%dT%H:%M:%f', min(created_at), '-1 hour') AS cutoff
+        FROM (SELECT target_path, created_at FROM outbox WHERE kind = 'telemetry'
+              UNION ALL
+              SELECT target_path, created_at FROM outbox_dead WHERE kind = 'telemetry')
+        GROUP BY target_path
+    """).fetchall()
+    conn.execute("CREATE TEMP TABLE telemetry_sync_cutoff (target_path TEXT PRIMARY KEY, cutoff TEXT)")
+    conn.executemany("INSERT INTO telemetry_sync_cutoff VALUES (?, ?)", cutoffs)
+    conn.execute("""
+        UPDATE telemetry SET synced = 1
+        WHERE synced = 0 AND received_at < coalesce(
+            (SELECT cutoff FROM telemetry_sync_cutoff WHERE target_path = 'containers/' || telemetry.device_id || '/telemetry'), '9999')
+    """)
+    conn.execute("DROP TABLE telemetry_sync_cutoff")
+
+# Q10 shelf-life models of the sample food types (see shelf_life.py)
+SHELF_LIFE_DEFAULTS = {
+    "bananas": {"ref_temp_c": 13.0, "ref_hours": 336, "q10": 2.5},
+    "chicken": {"ref_temp_c": 4.0, "ref_hours": 120, "q10": 3.0},
+}
+
+def seed_shelf_life_models(conn):
+    for food_type, model in SHELF_LIFE_DEFAULTS.items():
+        conn.execute("UPDATE food_types SET shelf_life = ? WHERE id = ? AND shelf_life IS NULL",
+                     (json.dumps(model), food_type))
+
+# Each entry is (version, description, steps). A step is either an SQL string
+# or a callable taking the connection. Migrations run in order, each in its own
+# transaction, and PRAGMA user_version records the last one applied. Never edit
+# a released migration; append a new one instead.
+MIGRATIONS = [
+    (1, "hot-path indexes for telemetry, alerts and outbox", [
+        # latest reading per device: WHERE device_id=? ORDER BY timestamp DESC LIMIT 1
+        "CREATE INDEX IF NOT EXISTS idx_telemetry_device_ts ON telemetry (device_id, timestamp)",
+        # active alerts per container: WHERE container_id=? AND resolved=0
+        "CREATE INDEX IF NOT EXISTS idx_alerts_container_resolved ON alerts (container_id, resolved)",
+        # outbox drain: WHERE attempts < ? ORDER BY created_at
+        "CREATE INDEX IF NOT EXISTS idx_outbox_attempts_created ON outbox (attempts, created_at)",
+    ]),
+    (2, "container_state table holding the latest reading per device", [
+        """
+        CREATE TABLE IF NOT EXISTS container_state (
+            device_id TEXT PRIMARY KEY,
+            telemetry_id INTEGER,
+            timestamp TEXT,
+            temperature_c REAL,
+            humidity_pct REAL,
+            mq4_ppm REAL,
+            lat REAL,
+            lon REAL,
+            fix INTEGER,
+            satellites INTEGER,
+            received_at TEXT
+        )
+        """,
+        # Backfill from history; one index lookup per device via idx_telemetry_device_ts
+        """
+        INSERT OR REPLACE INTO container_state
+            (device_id, telemetry_id, timestamp, temperature_c, humidity_pct, mq4_ppm,
+             lat, lon, fix, satellites, received_at)
+        SELECT t.device_id, t.id, t.timestamp, t.temperature_c, t.humidity_pct, t.mq4_ppm,
+               t.lat, t.lon, t.fix, t.satellites, t.received_at
+        FROM (SELECT DISTINCT device_id FROM telemetry) d
+        JOIN telemetry t ON t.id = (
+            SELECT id FROM telemetry WHERE device_id = d.device_id ORDER BY timestamp DESC LIMIT 1
+        )
+        """,
+    ]),
+    (3, "coalesce last-writer-wins outbox items", [
+        "CREATE INDEX IF NOT EXISTS idx_outbox_kind_target ON outbox (kind, target_path)",
+        # Drop the stale summaries/configs already queued; only the newest per target matters
+        """
+        DELETE FROM outbox
+        WHERE kind IN ('container_summary', 'config')
+          AND id NOT IN (
+              SELECT max(id) FROM outbox
+              WHERE kind IN ('container_summary', 'config')
+              GROUP BY kind, target_path
+          )
+        """,
+    ]),
+    (4, "outbox retry backoff, keyset drain index and dead-letter table", [
+        "ALTER TABLE outbox ADD COLUMN next_attempt_at TEXT",
+        "UPDATE outbox SET next_attempt_at = coalesce(created_at, '')",
+        # cloud_sync pages through due items by (next_attempt_at, id)
+        "CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox (next_attempt_at, id)",
+        "DROP INDEX IF EXISTS idx_outbox_attempts_created",
+        """
+        CREATE TABLE IF NOT EXISTS outbox_dead (
+            id INTEGER PRIMARY KEY,
+            kind TEXT,
+            target_path TEXT,
+            payload TEXT,
+            attempts INTEGER,
+            last_error TEXT,
+            created_at TEXT,
+            failed_at TEXT
+        )
+        """,
+        # Items that already used up the old 5-attempt budget were stuck forever; dead-letter them
+        """
+        INSERT INTO outbox_dead (id, kind, target_path, payload, attempts, last_error, created_at, failed_at)
+        SELECT id, kind, target_path, payload, attempts, last_error, created_at, strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        FROM outbox WHERE attempts >= 5
+        """,
+        "DELETE FROM outbox WHERE attempts >= 5",
+    ]),
+    (5, "1-minute and 1-hour telemetry rollup tables", [
+        # Maintained by mqtt_listener; history is rebuilt with `python3 rollups.py --backfill`.
+        # WITHOUT ROWID stores rows in (device_id, bucket) order, so a range read is one contiguous scan.
+        """
+        CREATE TABLE IF NOT EXISTS telemetry_rollup_1m (
+            device_id TEXT NOT NULL,
+            bucket TEXT NOT NULL, -- bucket start, UTC
+            count INTEGER NOT NULL,
+            temperature_c_min REAL, temperature_c_max REAL,
+            temperature_c_sum REAL NOT NULL DEFAULT 0, temperature_c_count INTEGER NOT NULL DEFAULT 0,
+            humidity_pct_min REAL, humidity_pct_max REAL,
+            humidity_pct_sum REAL NOT NULL DEFAULT 0, humidity_pct_count INTEGER NOT NULL DEFAULT 0,
+            mq4_ppm_min REAL, mq4_ppm_max REAL,
+            mq4_ppm_sum REAL NOT NULL DEFAULT 0, mq4_ppm_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (device_id, bucket)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS telemetry_rollup_1h (
+            device_id TEXT NOT NULL,
+            bucket TEXT NOT NULL, -- bucket start, UTC
+            count INTEGER NOT NULL,
+            temperature_c_min REAL, temperature_c_max REAL,
+            temperature_c_sum REAL NOT NULL DEFAULT 0, temperature_c_count INTEGER NOT NULL DEFAULT 0,
+            humidity_pct_min REAL, humidity_pct_max REAL,
+            humidity_pct_sum REAL NOT NULL DEFAULT 0, humidity_pct_count INTEGER NOT NULL DEFAULT 0,
+            mq4_ppm_min REAL, mq4_ppm_max REAL,
+            mq4_ppm_sum REAL NOT NULL DEFAULT 0, mq4_ppm_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (device_id, bucket)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    (6, "telemetry sync tracking and retention index", [
+        # Outbox items remember the row they upload, so cloud_sync can set telemetry.synced on ack
+        "ALTER TABLE outbox ADD COLUMN ref_id INTEGER",
+        "ALTER TABLE outbox_dead ADD COLUMN ref_id INTEGER",
+        # retention.py deletes WHERE synced = 1 AND received_at < cutoff
+        "CREATE INDEX IF NOT EXISTS idx_telemetry_synced_received ON telemetry (received_at) WHERE synced = 1",
+        mark_existing_telemetry_synced,
+    ]),
+    (7, "per-food shelf-life models and remaining shelf life per container", [
+        "ALTER TABLE food_types ADD COLUMN shelf_life TEXT",  # JSON string
+        seed_shelf_life_models,
+        # Food type the consumption was accumulated for; a different food type restarts it
+        "ALTER TABLE container_state ADD COLUMN shelf_life_food_type TEXT",
+        "ALTER TABLE container_state ADD COLUMN shelf_life_started TEXT",
+        "ALTER TABLE container_state ADD COLUMN shelf_life_consumed REAL",
+        "ALTER TABLE container_state ADD COLUMN shelf_life_remaining_h REAL",
+    ]),
+    (8, "food type edit timestamps", [
+        # Containers inherit thresholds from their food type, so its edits change the device ETags
+        "ALTER TABLE food_types ADD COLUMN last_modified TEXT",
+    ]),
+    (9, "shelf-life recompute timestamps", [
+        # Set by shelf_life.py --recompute/--reset, which change no other timestamp (see Last-Modified in app.py)
+        "ALTER TABLE container_state ADD COLUMN shelf_life_recomputed_at TEXT",
+    ]),
+    (10, "outbox item counts and per-kind oldest item index, for /metrics", [
+        # Kept by triggers so every writer (listener, portal, cloud_sync, replays) counts;
+        # a scrape reads a few rows instead of counting the whole backlog
+        """
+        CREATE TABLE IF NOT EXISTS outbox_counts (
+            kind TEXT PRIMARY KEY,
+            pending INTEGER NOT NULL DEFAULT 0,
+            dead INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT INTO outbox_counts (kind, pending)
+        SELECT kind, count(*) FROM outbox WHERE kind IS NOT NULL GROUP BY kind
+        """,
+        """
+        INSERT INTO outbox_counts (kind, dead)
+        SELECT kind, count(*) FROM outbox_dead WHERE kind IS NOT NULL GROUP BY kind
+        ON CONFLICT (kind) DO UPDATE SET dead = excluded.dead
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS outbox_counts_insert AFTER INSERT ON outbox BEGIN
+            INSERT INTO outbox_counts (kind, pending) VALUES (NEW.kind, 1)
+            ON CONFLICT (kind) DO UPDATE SET pending = pending + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS outbox_counts_delete AFTER DELETE ON outbox BEGIN
+            UPDATE outbox_counts SET pending = pending - 1 WHERE kind = OLD.kind;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS outbox_dead_counts_insert AFTER INSERT ON outbox_dead BEGIN
+            INSERT INTO outbox_counts (kind, dead) VALUES (NEW.kind, 1)
+            ON CONFLICT (kind) DO UPDATE SET dead = dead + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS outbox_dead_counts_delete AFTER DELETE ON outbox_dead BEGIN
+            UPDATE outbox_counts SET dead = dead - 1 WHERE kind = OLD.kind;
+        END
+        """,
+        # oldest pending item per kind: WHERE kind = ? ORDER BY id LIMIT 1
+        "CREATE INDEX IF NOT EXISTS idx_outbox_kind_id ON outbox (kind, id)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """
+    Brings the schema up to SCHEMA_VERSION. Cheap when already current (one PRAGMA read),
+    so services call it at startup. Safe to run while the other services are live:
+    readers keep working under WAL, and writers wait on busy_timeout while a migration
+    holds the write lock. Returns the number of migrations applied.
+    """
+    if get_schema_version(conn) >= SCHEMA_VERSION:
+        return 0
+
+    init_schema(conn)
+    applied = 0
+    for version, description, steps in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock in case another process migrated first
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied += 1
+
+    if applied:
+        # Refresh planner statistics; analysis_limit keeps this fast on large tables
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("ANALYZE")
+        conn.commit()
+    return applied
+
 def seed_defaults(conn):
     cur = conn.cursor()
 
@@ -139,6 +407,7 @@ def seed_defaults(conn):
                     "temperature": {"warn": 13.0, "critical": 20.0},
                     "humidity": {"warn_low": 50.0, "warn_high": 95.0}
                 },
+                "shelf_life": SHELF_LIFE_DEFAULTS["bananas"],
                 "notes": "Example thresholds for bananas"
             },
             {
@@ -148,14 +417,16 @@ def seed_defaults(conn):
                     "temperature": {"warn": 2.0, "critical": 4.0},
                     "humidity": {"warn_low": 60.0, "warn_high": 95.0}
                 },
+                "shelf_life": SHELF_LIFE_DEFAULTS["chicken"],
                 "notes": "Perishable meat"
             }
         ]
         for item in sample:
             cur.execute("""
-            INSERT OR IGNORE INTO food_types (id, display_name, thresholds, notes)
-            VALUES (?, ?, ?, ?)
-            """, (item["id"], item["display_name"], json.dumps(item["thresholds"]), item["notes"]))
+            INSERT OR IGNORE INTO food_types (id, display_name, thresholds, shelf_life, notes)
+            VALUES (?, ?, ?, ?, ?)
+            """, (item["id"], item["display_name"], json.dumps(item["thresholds"]),
+                  json.dumps(item["shelf_life"]), item["notes"]))
         conn.commit()
         print("Seeded sample food_types")
     else:
@@ -166,6 +437,7 @@ def main():
     ensure_dir()
     conn = connect()
     init_schema(conn)
+    migrate(conn)
     seed_defaults(conn)
     conn.close()
     print("Initialization complete.")
@@ -0,0 +1,324 @@
+"""
+metrics.py
+Counters, gauges and histograms for the AIoT Fresh services, exposed by the portal
+at /metrics in the Prometheus text format.
+
+Each process (the listener and its ingest workers, cloud_sync, every portal worker)
+keeps its own registry and writes it as a JSON snapshot to METRICS_DIR every
+METRICS_FLUSH_INTERVAL seconds. A scrape merges the snapshots: samples with the
+same name and labels are summed across processes. A process removes its file when
+it exits, and a scrape removes the files of processes that died without doing so
+(their pid is gone, or the file has not been rewritten for STALE_AFTER seconds).
+Totals then drop, which Prometheus handles as a counter reset.
+
+    INGESTED = metrics.counter("aiot_ingest_messages_total", "Messages ingested.", ("result",))
+    INGESTED.inc(result="committed")
+    with STAGE_SECONDS.time(stage="decode"):
+        ...
+
+Recording only takes a lock and a dict update; nothing is written on the hot path.
+"""
+
+import atexit
+import bisect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# Shared by every service, like AIOT_DB_PATH and AIOT_OUTBOX_SOCKET
+METRICS_DIR = os.environ.get("AIOT_METRICS_DIR", os.path.join(tempfile.gettempdir(), "aiot_metrics"))
+METRICS_FLUSH_INTERVAL = float(os.environ.get("AIOT_METRICS_FLUSH_INTERVAL", 10))
+# A live process rewrites its snapshot every METRICS_FLUSH_INTERVAL; older ones are from dead processes
+STALE_AFTER = 5 * METRICS_FLUSH_INTERVAL
+# Seconds, from 1 ms (a SQLite statement) to a minute (a Firestore retry storm)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}
+_collectors = []
+_lock = threading.Lock()
+_flusher_pid = None
+
+
+# ---------------------------
+# Metric types
+# ---------------------------
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        # label values (in labelnames order) -> value
+        self.values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def to_json(self):
+        with _lock:
+            samples = [[list(key), value] for key, value in self.values.items()]
+        return {"type": self.kind, "help": self.help, "labels": list(self.labelnames), "samples": samples}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+        _ensure_flusher()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = float(value)
+        _ensure_flusher()
+
+    def clear(self):
+        with _lock:
+            self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        self._observe(self._key(labels), value)
+
+    def bind(self, **labels):
+        """observe() with the labels resolved once, for hot paths: bind(stage="x")(seconds)."""
+        key = self._key(labels)
+        return lambda value: self._observe(key, value)
+
+    def _observe(self, key, value):
+        # Per-bucket (not cumulative) counts, then +Inf, sum and count
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+        _ensure_flusher()
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def to_json(self):
+        data = super().to_json()
+        data["buckets"] = list(self.buckets)
+        return data
+
+
+def _register(cls, name, *args, **kwargs):
+    with _lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, *args, **kwargs)
+    return metric
+
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter, name, help_text, labelnames)
+
+
+def gauge(name, help_text, labelnames=()):
+    return _register(Gauge, name, help_text, labelnames)
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help_text, labelnames, buckets)
+
+
+def register_collector(collect):
+    """collect() runs before every snapshot, to set gauges that are read rather than recorded."""
+    _collectors.append(collect)
+
+
+# ---------------------------
+# Snapshots (one file per process)
+# ---------------------------
+def snapshot():
+    for collect in list(_collectors):
+        try:
+            collect()
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+    return {"pid": os.getpid(), "written_at": time.time(),
+            "metrics": {name: metric.to_json() for name, metric in list(_registry.items())}}
+
+
+def snapshot_path(pid=None):
+    return os.path.join(METRICS_DIR, f"{os.getpid() if pid is None else pid}.json")
+
+
+def write_snapshot():
+    path = snapshot_path()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshot(), f)
+        # Readers never see a half-written file
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Could not write metrics snapshot {path}: {e}")
+
+
+def remove_snapshot(path=None):
+    try:
+        os.remove(path or snapshot_path())
+    except OSError:
+        pass
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        write_snapshot()
+
+
+def _ensure_flusher():
+    """Starts this process's snapshot thread on its first recorded sample."""
+    global _flusher_pid
+    if _flusher_pid is not None:
+        return
+    with _lock:
+        if _flusher_pid is not None:
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+    atexit.register(remove_snapshot)
+
+
+def _reset_after_fork():
+    # A forked child (e.g. a gunicorn worker of a preloaded app) must not report the parent's samples as its own
+    global _flusher_pid, _lock
+    _lock = threading.Lock()
+    _flusher_pid = None
+    for metric in _registry.values():
+        metric.values.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_snapshots():
+    """This process's live snapshot plus every other live process's last written one; dead ones are removed."""
+    snapshots = [snapshot()]
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return snapshots
+    now = time.time()
+    for name in names:
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not _pid_alive(data.get("pid", 0)) or now - data.get("written_at", 0) > STALE_AFTER:
+            # Its pid may since belong to another process, which writes its own, new file
+            remove_snapshot(path)
+            continue
+        snapshots.append(data)
+    return snapshots
+
+
+# ---------------------------
+# Exposition
+# ---------------------------
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def merge(snapshots):
+    """name -> merged family; samples with equal labels are summed across processes."""
+    families = {}
+    for data in snapshots:
+        for name, family in data.get("metrics", {}).items():
+            merged = families.setdefault(name, {**family, "samples": {}})
+            for key, value in family["samples"]:
+                key = tuple(key)
+                current = merged["samples"].get(key)
+                if current is None:
+                    merged["samples"][key] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    merged["samples"][key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged["samples"][key] = current + value
+    return families
+
+
+def exposition(extra=()):
+    """
+    Prometheus text format for every process's metrics, plus `extra` unregistered
+    metrics that the caller computed just for this scrape (e.g. from the database).
+    """
+    families = merge(read_snapshots())
+    for metric in extra:
+        families[metric.name] = merge([{"metrics": {metric.name: metric.to_json()}}])[metric.name]
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        labelnames = family["labels"]
+        for key, value in sorted(family["samples"].items()):
+            if family["type"] != "histogram":
+                lines.append(f"{name}{_labels(labelnames, key)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*family["buckets"], float("inf")], value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labelnames, key, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labelnames, key)} {_number(value[-2])}")
+            lines.append(f"{name}_count{_labels(labelnames, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
@@ -1,28 +1,101 @@
 import paho.mqtt.client as mqtt
 import sqlite3
-import json
 import time
 import os
+import queue
+import signal
+import threading
+import zlib
+import multiprocessing
 from datetime import datetime
+import database
+import init_db
+import rollups
+import events
+import rules
+import thresholds
+import anomaly
+import shelf_life
+import metrics
+import profiling
+import codec
+import telemetry_bin
+from outbox import add_to_outbox, notify_outbox, payload_value
 
 MQTT_HOST = "localhost"
 MQTT_PORT = 1883
 MQTT_USERNAME = ""
 MQTT_PASSWORD = ""
 
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aiot.db")
+DB_PATH = database.DB_PATH
 
 TOPIC = "containers/+/telemetry"
+# Packed binary telemetry from firmware built with TELEMETRY_BINARY (see telemetry_bin.py)
+BINARY_TOPIC = "containers/+/telemetry/bin"
+# Retained config published by app.update_thresholds; used to invalidate the registry
+CONFIG_TOPIC = "containers/+/config"
+# Retained food type config published by app.update_food_type; invalidates every container
+FOOD_TYPE_CONFIG_TOPIC = "food_types/+/config"
 RECONNECT_DELAY = 5
 
+# Write-behind ingestion: messages are queued by the MQTT thread and committed
+# by a single writer thread in one transaction per batch.
+INGEST_BATCH_SIZE = int(os.environ.get("AIOT_INGEST_BATCH_SIZE", 100))
+# Max seconds a message may wait in the queue before its batch is committed
+INGEST_MAX_LATENCY = float(os.environ.get("AIOT_INGEST_MAX_LATENCY", 1.0))
+# Bounded queue: when full, on_message blocks and the broker buffers for us
+INGEST_QUEUE_SIZE = int(os.environ.get("AIOT_INGEST_QUEUE_SIZE", 10000))
+# Seconds to wait before retrying a batch when the write lock is busy (e.g. during a migration)
+INGEST_RETRY_DELAY = 1.0
+
+# Sharded ingestion: with more than one worker, messages are routed by crc32(device_id) to
+# worker processes, each running the writer loop with its own queue, registry and connection.
+# A device always lands on the same worker, so its alert state is updated in order.
+INGEST_WORKERS = int(os.environ.get("AIOT_INGEST_WORKERS", 1))
+# Seconds between per-writer metric lines
+INGEST_METRICS_INTERVAL = float(os.environ.get("AIOT_INGEST_METRICS_INTERVAL", 60))
+
+# Safety net for edits that bypass the config topic (e.g. DB admin page): cached
+# container state is reloaded at most this many seconds after it was read.
+REGISTRY_TTL = float(os.environ.get("AIOT_REGISTRY_TTL", 300))
+
+_ingest_queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+_ingest_thread = None
+# Sharded mode: one {"process", "queue", "stats"} per worker
+_shards = []
+
+# Counters kept by this process's writer; shared memory in worker processes
+# lock_held_s: time holding the write lock, the part of busy_s that workers cannot overlap
+STAT_FIELDS = ("messages", "failed", "batches", "busy_s", "lock_wait_s", "lock_held_s")
+_stats = [0.0] * len(STAT_FIELDS)
+
+# In-process registry of known containers, owned by the writer thread:
+# device_id -> {"thresholds": effective thresholds (thresholds.py), "rules": compiled rules, "rule_state": their per-device state,
+#               "anomaly_state": anomaly.py baselines, "shelf_life": shelf_life.py tracker, "active_alerts": set of (type, level), "loaded_at": monotonic time}
+_registry = {}
+
+# The connected client, used by the writer thread to publish dashboard events
+_mqtt_client = None
+
+# Served by app.py at /metrics (see metrics.py); every worker process records its own
+INGEST_MESSAGES = metrics.counter("aiot_ingest_messages_total", "Telemetry messages ingested, by result.", ("result",))
+INGEST_BATCHES = metrics.counter("aiot_ingest_batches_total", "Ingest batches (transactions) handled.")
+INGEST_STAGE_SECONDS = metrics.histogram(
+    "aiot_ingest_stage_seconds",
+    "Ingest latency by stage: queue, prepare (no lock held) and write per message; decode, commit and batch per batch.",
+    ("stage",))
+SQLITE_LOCK_WAIT_SECONDS = metrics.histogram(
+    "aiot_sqlite_lock_wait_seconds", "Time spent waiting for the SQLite write lock.", ("service",))
+INGEST_QUEUE_DEPTH = metrics.gauge("aiot_ingest_queue_depth", "Messages waiting for an ingest writer.", ("worker",))
+ALERTS_RAISED = metrics.counter("aiot_alerts_raised_total", "Alerts raised by the listener.", ("type", "level"))
+
 
 # ---------------------------
 # DB Helper Functions
 # ---------------------------
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # The writer thread reuses one connection for every batch
+    return database.get_connection()
 
 
 def init_container_if_missing(conn, device_id, food_type="unknown"):
@@ -34,18 +107,71 @@ def init_container_if_missing(conn, device_id, food_type="unknown"):
             INSERT INTO containers (device_id, selected_food_type, last_seen, threshold_overrides)
             VALUES (?, ?, ?, ?)
         """, (device_id, food_type, datetime.utcnow().isoformat(), "{}"))
-        conn.commit()
 
 
-def insert_telemetry(conn, device_id, telemetry):
+INSERT_TELEMETRY = """
+    INSERT INTO telemetry (device_id, timestamp, temperature_c, humidity_pct, mq4_ppm, lat, lon, fix, satellites, received_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def insert_telemetry(conn, device_id, telemetry, received_at=None, row=None):
+    """row is the column values already unpacked (binary messages, see telemetry_bin.decode)."""
     cursor = conn.cursor()
+    if row is not None:
+        cursor.execute(INSERT_TELEMETRY, row)
+        return cursor.lastrowid
     gps_data = telemetry.get("gps", {})
+    cursor.execute(INSERT_TELEMETRY, (
+        device_id,
+        telemetry.get("timestamp", datetime.utcnow().isoformat()),
+        telemetry.get("temperature_c"),
+        telemetry.get("humidity_pct"),
+        telemetry.get("mq4_ppm"),
+        gps_data.get("lat"),
+        gps_data.get("lon"),
+        gps_data.get("fix"),
+        gps_data.get("satellites"),
+        received_at or datetime.utcnow().isoformat()
+    ))
+    return cursor.lastrowid
+
+
+def update_container_state(conn, device_id, telemetry_id, telemetry, received_at, shelf=None):
+    """
+    Upserts the latest-reading row that /api/devices reads instead of scanning telemetry.
+    shelf is shelf_life.update()'s (food_type, consumed since the previous reading,
+    remaining hours at full life); consumption is added in SQL, so a concurrent
+    `shelf_life.py --recompute` is built upon rather than overwritten.
+    """
+    cursor = conn.cursor()
+    gps_data = telemetry.get("gps", {})
+    food_type, consumed, full_life_h = shelf or (None, None, None)
     cursor.execute("""
-        INSERT INTO telemetry (device_id, timestamp, temperature_c, humidity_pct, mq4_ppm, lat, lon, fix, satellites, received_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO container_state (device_id, telemetry_id, timestamp, temperature_c, humidity_pct, mq4_ppm, lat, lon, fix, satellites, received_at,
+                                     shelf_life_food_type, shelf_life_started, shelf_life_consumed, shelf_life_remaining_h)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(device_id) DO UPDATE SET
+            telemetry_id=excluded.telemetry_id, timestamp=excluded.timestamp,
+            temperature_c=excluded.temperature_c, humidity_pct=excluded.humidity_pct, mq4_ppm=excluded.mq4_ppm,
+            lat=excluded.lat, lon=excluded.lon, fix=excluded.fix, satellites=excluded.satellites,
+            received_at=excluded.received_at,
+            shelf_life_food_type=excluded.shelf_life_food_type,
+            shelf_life_started=CASE WHEN excluded.shelf_life_food_type IS container_state.shelf_life_food_type
+                THEN coalesce(container_state.shelf_life_started, excluded.shelf_life_started)
+                ELSE excluded.shelf_life_started END,
+            shelf_life_consumed=CASE WHEN excluded.shelf_life_food_type IS container_state.shelf_life_food_type
+                THEN coalesce(container_state.shelf_life_consumed, 0) + excluded.shelf_life_consumed
+                WHEN excluded.shelf_life_food_type IS NOT NULL THEN 0 END,
+            shelf_life_remaining_h=CASE WHEN excluded.shelf_life_food_type IS container_state.shelf_life_food_type
+                THEN max(0, 1 - coalesce(container_state.shelf_life_consumed, 0) - excluded.shelf_life_consumed)
+                     * excluded.shelf_life_remaining_h
+                ELSE excluded.shelf_life_remaining_h END
+        WHERE excluded.timestamp >= container_state.timestamp OR container_state.timestamp IS NULL
     """, (
         device_id,
-        telemetry.get("timestamp", datetime.utcnow().isoformat()),
+        telemetry_id,
+        telemetry.get("timestamp", received_at),
         telemetry.get("temperature_c"),
         telemetry.get("humidity_pct"),
         telemetry.get("mq4_ppm"),
@@ -53,53 +179,19 @@ def insert_telemetry(conn, device_id, telemetry):
         gps_data.get("lon"),
         gps_data.get("fix"),
         gps_data.get("satellites"),
-        datetime.utcnow().isoformat()
+        received_at,
+        food_type,
+        telemetry.get("timestamp", received_at) if shelf else None,
+        consumed,
+        full_life_h
     ))
-    conn.commit()
 
 
 def update_container_status(conn, device_id):
     cursor = conn.cursor()
     cursor.execute("UPDATE containers SET last_seen=? WHERE device_id=?", (datetime.utcnow().isoformat(), device_id))
-    conn.commit()
 
 
-def get_merged_thresholds(conn, device_id):
-    cursor = conn.cursor()
-    cursor.execute("SELECT threshold_overrides FROM containers WHERE device_id=?", (device_id,))
-    container_row = cursor.fetchone()
-    if not container_row:
-        return {}
-
-    overrides = json.loads(container_row["threshold_overrides"]) if container_row["threshold_overrides"] else {}
-    return overrides
-
-def evaluate_telemetry(telemetry, thresholds):
-    alerts = []
-    temp = telemetry.get("temperature_c")
-    humidity = telemetry.get("humidity_pct")
-
-    if temp is not None and "temperature" in thresholds:
-        if "critical" in thresholds["temperature"] and temp > thresholds["temperature"]["critical"]:
-            alerts.append({"type": "temperature", "level": "critical", "message": f"Critical temperature: {temp}°C"})
-        elif "warn" in thresholds["temperature"] and temp > thresholds["temperature"]["warn"]:
-            alerts.append({"type": "temperature", "level": "warn", "message": f"High temperature: {temp}°C"})
-
-    if humidity is not None and "humidity" in thresholds:
-        if "warn_high" in thresholds["humidity"] and humidity > thresholds["humidity"]["warn_high"]:
-            alerts.append({"type": "humidity", "level": "warn", "message": f"High humidity: {humidity}%"})
-        if "warn_low" in thresholds["humidity"] and humidity < thresholds["humidity"]["warn_low"]:
-            alerts.append({"type": "humidity", "level": "warn", "message": f"Low humidity: {humidity}%"})
-    
-    mq4 = telemetry.get("mq4_ppm")
-    if mq4 is not None and "mq4" in thresholds:
-        if "critical" in thresholds["mq4"] and mq4 > thresholds["mq4"]["critical"]:
-            alerts.append({"type": "mq4", "level": "critical", "message": f"Critical Gas Level: {mq4} ppm"})
-        elif "warn" in thresholds["mq4"] and mq4 > thresholds["mq4"]["warn"]:
-            alerts.append({"type": "mq4", "level": "warn", "message": f"High Gas Level: {mq4} ppm"})
-
-    return alerts
-
 def create_alert(conn, device_id, alert_info):
     cursor = conn.cursor()
     ts = datetime.utcnow().isoformat() + 'Z'
@@ -107,7 +199,6 @@ def create_alert(conn, device_id, alert_info):
         INSERT INTO alerts (container_id, alert_type, level, message, timestamp)
         VALUES (?, ?, ?, ?, ?)
     """, (device_id, alert_info["type"], alert_info["level"], alert_info["message"], ts))
-    conn.commit()
     return cursor.lastrowid, ts
 
 def get_active_alerts(conn, device_id):
@@ -127,20 +218,12 @@ def resolve_alerts(conn, device_id, alerts_to_resolve):
             UPDATE alerts SET resolved = 1
             WHERE container_id = ? AND alert_type = ? AND level = ? AND resolved = 0
         """, (device_id, alert_type, level))
-    conn.commit()
 
-def add_to_outbox(conn, kind, target_path, payload):
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO outbox (kind, target_path, payload, created_at)
-        VALUES (?, ?, ?, ?)
-    """, (kind, target_path, json.dumps(payload), datetime.utcnow().isoformat()))
-    conn.commit()
-
-def update_container_summary_in_outbox(conn, device_id, telemetry_payload):
+def container_summary_value(telemetry_payload, raw=None):
     """
-    Prepares and adds a container summary update to the outbox for Firestore.
-    This includes latest telemetry, last_seen timestamp, and status.
+    The outbox payload value of a container summary update for Firestore: latest telemetry,
+    last_seen timestamp, and status. raw is the telemetry as received (JSON text), spliced
+    in rather than encoded again.
     """
     update_data = {
         "last_seen": telemetry_payload.get("timestamp", datetime.utcnow().isoformat()),
@@ -148,9 +231,85 @@ def update_container_summary_in_outbox(conn, device_id, telemetry_payload):
             "state": "online",
             "last_update": telemetry_payload.get("timestamp", datetime.utcnow().isoformat())
         },
-        "latest_telemetry": telemetry_payload
     }
-    add_to_outbox(conn, "container_summary", f"containers/{device_id}", update_data)
+    encoded = None
+    if raw is not None:
+        # '{"last_seen":...,"status":{...}}' -> '{"last_seen":...,"status":{...},"latest_telemetry":<raw>}'
+        encoded = f'{codec.dumps(update_data)[:-1]},"latest_telemetry":{raw}}}'
+    update_data["latest_telemetry"] = telemetry_payload
+    return payload_value(update_data, encoded)
+
+
+def update_container_summary_in_outbox(conn, device_id, telemetry_payload, raw=None):
+    """Adds a container summary update (see container_summary_value) to the outbox."""
+    add_to_outbox(conn, "container_summary", f"containers/{device_id}", None,
+                  value=container_summary_value(telemetry_payload, raw))
+
+
+# ---------------------------
+# Container registry
+# ---------------------------
+def get_container_state(conn, device_id, food_type="unknown"):
+    """
+    Returns the cached thresholds and active alert set for a device, loading them
+    (and registering the container) only on first sight, after invalidation or expiry, or after REGISTRY_TTL.
+    """
+    cached = _registry.get(device_id)
+    if is_cached(device_id):
+        return cached
+
+    init_container_if_missing(conn, device_id, food_type)
+    # Food type thresholds merged with the overrides, compiled once per distinct pair
+    effective, compiled = thresholds.load(conn, device_id)
+    active_alerts = get_active_alerts(conn, device_id)
+    if cached is not None and cached["rules"] is compiled:
+        # Refresh with unchanged thresholds: keep the rule timers and rate windows running
+        rule_state = cached["rule_state"]
+    else:
+        rule_state = rules.new_rule_state(compiled, active_alerts)
+    if cached is not None:
+        anomaly_state = cached["anomaly_state"]
+    else:
+        # First sight since startup: rebuild the anomaly baselines from the recent rollups
+        anomaly_state = anomaly.new_state(anomaly.ALERT_KEY in active_alerts)
+        anomaly.prime(anomaly_state, anomaly.load_history(conn, device_id))
+    state = {
+        "thresholds": effective,
+        "rules": compiled,
+        "rule_state": rule_state,
+        "anomaly_state": anomaly_state,
+        # Reloaded with the rest: the food type may have changed, and container_state holds its progress
+        "shelf_life": shelf_life.new_state(conn, device_id),
+        "active_alerts": active_alerts,
+        "loaded_at": time.monotonic(),
+    }
+    _registry[device_id] = state
+    return state
+
+
+def is_cached(device_id):
+    """True if the next get_container_state() for device_id is served from the registry without a reload."""
+    cached = _registry.get(device_id)
+    return cached is not None and time.monotonic() - cached["loaded_at"] < REGISTRY_TTL
+
+
+def invalidate_container(device_id=None):
+    """Drops cached state for one device, or for all devices when device_id is None."""
+    if device_id is None:
+        _registry.clear()
+    else:
+        _registry.pop(device_id, None)
+
+
+def expire_container(device_id=None):
+    """
+    Makes the next reading reload thresholds and alerts for one device (or all), like
+    REGISTRY_TTL running out: rule timers survive if the thresholds did not change,
+    and the anomaly baselines are kept.
+    """
+    for key in list(_registry) if device_id is None else [device_id]:
+        if key in _registry:
+            _registry[key]["loaded_at"] = float("-inf")
 
 
 # ---------------------------
@@ -158,66 +317,463 @@ def update_container_summary_in_outbox(conn, device_id, telemetry_payload):
 # ---------------------------
 def on_connect(client, userdata, flags, rc):
     print("MQTT connected with result code", rc)
-    client.subscribe(TOPIC)
+    client.subscribe([(TOPIC, 0), (BINARY_TOPIC, 0), (CONFIG_TOPIC, 0), (FOOD_TYPE_CONFIG_TOPIC, 0)])
+
+
+def shard_for(topic):
+    device_id = topic.split("/")[1]
+    return zlib.crc32(device_id.encode()) % len(_shards)
 
 
 def on_message(client, userdata, msg):
-    conn = None
+    # Runs on the paho network thread: only queue the message, the writer does the rest.
+    # put() blocks while the queue is full, which stops reading and lets the broker buffer.
     try:
-        topic_parts = msg.topic.split("/")
-        device_id = topic_parts[1]
-        payload = json.loads(msg.payload.decode())
-
-        conn = get_db()
-
-        # Step 1: Standard processing (status update, telemetry logging)
-        init_container_if_missing(conn, device_id, payload.get("selected_food_type", "unknown"))
-        update_container_status(conn, device_id) # This updates local SQLite, but Firestore needs the 'outbox'
-        insert_telemetry(conn, device_id, payload)
-        add_to_outbox(conn, "telemetry", f"containers/{device_id}/telemetry", payload)
-        
-        # Step 1.5: Update the container's summary in Firestore via outbox
-        update_container_summary_in_outbox(conn, device_id, payload)
-
-        # Step 2: Stateful Alert Evaluation
-        thresholds = get_merged_thresholds(conn, device_id)
-        
-        # Get current state from DB and new state from telemetry
-        active_db_alerts = get_active_alerts(conn, device_id)
-        evaluated_alerts_list = evaluate_telemetry(payload, thresholds)
-        evaluated_alerts_set = {(a['type'], a['level']) for a in evaluated_alerts_list}
-
-        # Compare states to find what's new and what's cleared
-        alerts_to_create = evaluated_alerts_set - active_db_alerts
-        alerts_to_resolve = active_db_alerts - evaluated_alerts_set
-
-        # Step 3: Resolve cleared alerts
-        if alerts_to_resolve:
-            resolve_alerts(conn, device_id, alerts_to_resolve)
-            print(f"[{device_id}] Resolved alerts: {alerts_to_resolve}")
-
-        # Step 4: Create new alerts
-        if alerts_to_create:
-            for alert_dict in evaluated_alerts_list:
-                if (alert_dict['type'], alert_dict['level']) in alerts_to_create:
-                    alert_id, alert_ts = create_alert(conn, device_id, alert_dict)
-                    alert_payload = {**alert_dict, "id": alert_id, "device_id": device_id, "timestamp": alert_ts}
-                    add_to_outbox(conn, "alert", f"containers/{device_id}/alerts", alert_payload)
-                    print(f"[{device_id}] New Alert: {alert_dict['message']}")
-
-        print(f"[{device_id}] Telemetry processed.")
+        item = (msg.topic, msg.payload, datetime.utcnow().isoformat())
+        if _shards and msg.topic.startswith("food_types/"):
+            # Any container may use the food type, so every worker's registry needs the news
+            for shard in _shards:
+                shard["queue"].put(item)
+        elif _shards:
+            _shards[shard_for(msg.topic)]["queue"].put(item)
+        else:
+            _ingest_queue.put(item)
+    except Exception as e:
+        print("Error queueing message:", e)
 
+
+# ---------------------------
+# Write-behind ingestion
+# ---------------------------
+def prepare_telemetry(conn, device_id, payload, received_at, trace=None, raw=None, row=None):
+    """
+    The part of one telemetry message that needs no write lock: registry lookup, shelf life,
+    rule and anomaly evaluation, and encoding the outbox payloads. Updates the registry as if
+    the message were written, and returns what write_telemetry() then writes.
+    Each step is timed on trace (profiling.Trace), when given. raw is the message as
+    received (JSON text), which the outbox stores instead of encoding payload again; row is
+    the telemetry row of a binary message, inserted as is.
+    """
+    trace = trace or profiling.Trace()
+    # Known containers, thresholds and active alerts come from the registry (no reads in steady state)
+    state = get_container_state(conn, device_id, payload.get("selected_food_type", "unknown"))
+    trace.mark("registry")
+    reading_time = rules.reading_time(payload, received_at)
+    shelf = shelf_life.update(state["shelf_life"], reading_time, payload.get("temperature_c"))
+
+    # Stateful Alert Evaluation (threshold rules, see rules.py, and anomalies, see anomaly.py)
+    # Current alert state from the registry (kept in step with our own writes) and new state from telemetry
+    active_db_alerts = state["active_alerts"]
+    evaluated_alerts_list = rules.evaluate(state["rules"], state["rule_state"], payload, reading_time)
+    trace.mark("rules")
+    evaluated_alerts_list += anomaly.evaluate(state["anomaly_state"], payload, reading_time)
+    trace.mark("anomaly")
+    evaluated_alerts_set = {(a['type'], a['level']) for a in evaluated_alerts_list}
+
+    # Compare states to find what's new and what's cleared
+    alerts_to_create = evaluated_alerts_set - active_db_alerts
+    alerts_to_resolve = active_db_alerts - evaluated_alerts_set
+    state["active_alerts"] = evaluated_alerts_set
+
+    gps_data = payload.get("gps", {})
+    prepared = {
+        "device_id": device_id,
+        "payload": payload,
+        "received_at": received_at,
+        "row": row,
+        "shelf": shelf,
+        "trace": trace,
+        "telemetry_value": payload_value(payload, raw),
+        "summary_value": container_summary_value(payload, raw),
+        "alerts_to_create": [a for a in evaluated_alerts_list if (a['type'], a['level']) in alerts_to_create],
+        "alerts_to_resolve": alerts_to_resolve,
+        "event": {
+            "type": "telemetry",
+            "device_id": device_id,
+            "last_seen": received_at,
+            "last_telemetry": {
+                "temperature_c": payload.get("temperature_c"),
+                "humidity_pct": payload.get("humidity_pct"),
+                "mq4_ppm": payload.get("mq4_ppm"),
+                "gps": {key: gps_data.get(key) for key in ("lat", "lon", "fix", "satellites")}
+            }
+        },
+    }
+    trace.mark("encode")
+    return prepared
+
+
+def write_telemetry(conn, prepared):
+    """
+    Writes a message prepared by prepare_telemetry() on the open transaction on conn (no commit).
+    Returns the dashboard events (see events.py) to publish once the batch commits.
+    """
+    device_id, payload, received_at = prepared["device_id"], prepared["payload"], prepared["received_at"]
+    trace = prepared["trace"]
+
+    # Step 1: Standard processing (status update, telemetry logging)
+    update_container_status(conn, device_id) # This updates local SQLite, but Firestore needs the 'outbox'
+    telemetry_id = insert_telemetry(conn, device_id, payload, received_at, prepared["row"])
+    trace.mark("insert_telemetry")
+    update_container_state(conn, device_id, telemetry_id, payload, received_at, prepared["shelf"])
+    trace.mark("container_state")
+    rollups.update_rollups(conn, device_id, payload, payload.get("timestamp", received_at))
+    trace.mark("rollups")
+    add_to_outbox(conn, "telemetry", f"containers/{device_id}/telemetry", payload, ref_id=telemetry_id,
+                  value=prepared["telemetry_value"])
+
+    # Step 1.5: Update the container's summary in Firestore via outbox
+    add_to_outbox(conn, "container_summary", f"containers/{device_id}", None, value=prepared["summary_value"])
+    trace.mark("outbox")
+
+    message_events = [prepared["event"]]
+
+    # Step 2: Resolve cleared alerts
+    alerts_to_resolve = prepared["alerts_to_resolve"]
+    if alerts_to_resolve:
+        resolve_alerts(conn, device_id, alerts_to_resolve)
+        message_events.append({"type": "alerts_resolved", "device_id": device_id, "alerts": sorted(alerts_to_resolve)})
+        print(f"[{device_id}] Resolved alerts: {alerts_to_resolve}")
+
+    # Step 3: Create new alerts
+    for alert_dict in prepared["alerts_to_create"]:
+        alert_id, alert_ts = create_alert(conn, device_id, alert_dict)
+        alert_payload = {**alert_dict, "id": alert_id, "device_id": device_id, "timestamp": alert_ts}
+        add_to_outbox(conn, "alert", f"containers/{device_id}/alerts", alert_payload)
+        ALERTS_RAISED.inc(type=alert_dict['type'], level=alert_dict['level'])
+        message_events.append({"type": "alert", "device_id": device_id, "alert": alert_payload})
+        print(f"[{device_id}] New Alert: {alert_dict['message']}")
+
+    trace.mark("alerts")
+    return message_events
+
+
+def process_telemetry(conn, device_id, payload, received_at, trace=None, raw=None, row=None):
+    """
+    Applies one telemetry message to the open transaction on conn (no commit): prepare_telemetry()
+    and write_telemetry() in one go. Returns the dashboard events to publish once it commits.
+    """
+    return write_telemetry(conn, prepare_telemetry(conn, device_id, payload, received_at, trace, raw, row))
+
+
+def decode_message(topic, device_id, raw_payload, received_at):
+    """(payload, text, row) of a telemetry message; text is the JSON as received, row a binary message's row."""
+    if topic.endswith("/bin"):
+        row, payload = telemetry_bin.decode(device_id, raw_payload, received_at)
+        return payload, None, row
+    text = bytes(raw_payload).decode("utf-8")
+    payload = codec.loads(text)
+    if not isinstance(payload, dict):
+        raise ValueError(f"expected a JSON object, got {type(payload).__name__}")
+    # The text is kept for the outbox, which stores telemetry as received
+    return payload, text, None
+
+
+def flush_batch(batch):
+    """
+    Commits a batch of queued (topic, payload, received_at) messages in a single transaction.
+
+    Messages are decoded and prepared (prepare_telemetry) before the write lock is taken,
+    so with several workers only the writes themselves are serialized. Each message is then
+    written inside its own savepoint, so a bad message is rolled back alone instead of
+    taking the rest of the batch with it.
+
+    A device's state reloaded from the database must include the batch's earlier writes,
+    which only exist inside the transaction. So a device that needs a reload after it already
+    has messages in the batch, or whose message failed (dropping its registry entry), has its
+    remaining messages prepared under the lock instead.
+    Returns False if the write lock could not be taken, so the caller can retry the batch.
+    """
+    started = time.perf_counter()
+    processed = failed = 0
+    decode_s = 0.0
+    conn = get_db()
+    # (args for prepare_telemetry, its result, or None to prepare under the lock)
+    messages = []
+    # Devices with messages in the batch; those whose later messages are prepared under the lock;
+    # those whose message failed under the lock (already prepared later messages are prepared again)
+    pending, deferred, failed_devices = set(), set(), set()
+    now = datetime.utcnow()
+    for topic, raw_payload, received_at in batch:
+        try:
+            INGEST_STAGE_SECONDS.observe((now - datetime.fromisoformat(received_at)).total_seconds(), stage="queue")
+        except ValueError:
+            pass
+        device_id = topic.split("/")[1]
+        if topic.startswith("food_types/"):
+            # Food type changed in the portal; reload every container on its next reading
+            expire_container()
+            continue
+        if topic.endswith("/config"):
+            # Thresholds changed in the portal; reload on the next reading
+            expire_container(device_id)
+            continue
+        trace = profiling.Trace()
+        decode_started = time.perf_counter()
+        try:
+            payload, text, row = decode_message(topic, device_id, raw_payload, received_at)
+            trace.mark("decode")
+        except ValueError as e:
+            failed += 1
+            print(f"[{device_id}] Error decoding message:", e)
+            continue
+        finally:
+            decode_s += time.perf_counter() - decode_started
+        args = (device_id, payload, received_at, trace, text, row)
+        if device_id in deferred or (device_id in pending and not is_cached(device_id)):
+            deferred.add(device_id)
+            messages.append((args, None))
+            continue
+        prepare_started = time.perf_counter()
+        try:
+            prepared = prepare_telemetry(conn, *args)
+            if conn.in_transaction:
+                # A new container was registered; keep that out of the batch's transaction
+                conn.commit()
+            messages.append((args, prepared))
+            pending.add(device_id)
+            INGEST_STAGE_SECONDS.observe(time.perf_counter() - prepare_started, stage="prepare")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            invalidate_container(device_id)
+            deferred.add(device_id)
+            failed += 1
+            print(f"[{device_id}] Error handling message:", e)
+    INGEST_STAGE_SECONDS.observe(decode_s, stage="decode")
+
+    locked_at = None
+    try:
+        if messages:
+            lock_requested = time.perf_counter()
+            try:
+                # Take the write lock up front so lock waits never fail a single message
+                conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                print("Could not lock database for telemetry batch:", e)
+                # The registry already counts these messages; the retry prepares them again
+                for args, _ in messages:
+                    invalidate_container(args[0])
+                return False
+            finally:
+                lock_wait = time.perf_counter() - lock_requested
+                _stats[4] += lock_wait
+                SQLITE_LOCK_WAIT_SECONDS.observe(lock_wait, service="mqtt_listener")
+            locked_at = time.perf_counter()
+        batch_events = []
+        for args, prepared in messages:
+            device_id, trace = args[0], args[3]
+            conn.execute("SAVEPOINT message")
+            message_started = time.perf_counter()
+            # The time spent waiting for the lock and for earlier messages is not this message's
+            trace.pause()
+            try:
+                if prepared is None or device_id in failed_devices:
+                    prepared = prepare_telemetry(conn, *args)
+                batch_events.extend(write_telemetry(conn, prepared))
+                processed += 1
+                INGEST_STAGE_SECONDS.observe(time.perf_counter() - message_started, stage="write")
+            except Exception as e:
+                conn.execute("ROLLBACK TO message")
+                # Cached state may include writes that were just rolled back
+                invalidate_container(device_id)
+                failed_devices.add(device_id)
+                failed += 1
+                print(f"[{device_id}] Error handling message:", e)
+            finally:
+                conn.execute("RELEASE message")
+        if messages:
+            with INGEST_STAGE_SECONDS.time(stage="commit"):
+                conn.commit()
+            _stats[5] += time.perf_counter() - locked_at
+            locked_at = None
+        for args, _ in messages:
+            args[3].finish(f"[{args[0]}]")
+        if processed:
+            notify_outbox()
+            publish_events(batch_events)
+        print(f"Telemetry processed: {processed} messages committed, {failed} failed.")
     except Exception as e:
-        print("Error handling message:", e)
-    finally:
-        if conn:
-            conn.close()
+        print("Error committing telemetry batch:", e)
+        if conn.in_transaction:
+            conn.rollback()
+        if locked_at is not None:
+            _stats[5] += time.perf_counter() - locked_at
+        invalidate_container()
+        failed, processed = failed + processed, 0
+    _stats[0] += processed
+    _stats[1] += failed
+    _stats[2] += 1
+    _stats[3] += time.perf_counter() - started
+    INGEST_MESSAGES.inc(processed, result="committed")
+    INGEST_MESSAGES.inc(failed, result="failed")
+    INGEST_BATCHES.inc()
+    INGEST_STAGE_SECONDS.observe(time.perf_counter() - started, stage="batch")
+    return True
+
+
+def publish_events(batch_events):
+    """Sends a committed batch's events to the dashboards, keeping only the newest reading per device."""
+    latest = {}
+    for event in batch_events:
+        if event["type"] == "telemetry":
+            latest[event["device_id"]] = event
+    batch_events = [event for event in batch_events if event["type"] != "telemetry" or latest[event["device_id"]] is event]
+    try:
+        events.publish_events(_mqtt_client, batch_events)
+    except Exception as e:
+        print("Error publishing dashboard events:", e)
+
+
+def ingest_writer_loop():
+    """Drains the ingest queue, flushing when the batch is full or INGEST_MAX_LATENCY has elapsed."""
+    while True:
+        item = _ingest_queue.get()
+        if item is None:
+            return
+        batch = [item]
+        deadline = time.monotonic() + INGEST_MAX_LATENCY
+        stop = False
+        while len(batch) < INGEST_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _ingest_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        while not flush_batch(batch):
+            time.sleep(INGEST_RETRY_DELAY)
+        if stop:
+            return
+
+
+def start_ingest_writer(workers=None):
+    """Starts the in-process writer thread, or `workers` writer processes when more than one."""
+    global _ingest_thread
+    workers = INGEST_WORKERS if workers is None else workers
+    if workers > 1:
+        if not _shards:
+            start_ingest_workers(workers)
+        return None
+    if _ingest_thread is None or not _ingest_thread.is_alive():
+        _ingest_thread = threading.Thread(target=ingest_writer_loop, name="ingest-writer", daemon=True)
+        _ingest_thread.start()
+    return _ingest_thread
+
+
+def stop_ingest_writer():
+    """Flushes whatever is still queued and stops the writer thread or worker processes."""
+    global _ingest_thread
+    if _shards:
+        for shard in _shards:
+            shard["queue"].put(None)
+        for shard in _shards:
+            shard["process"].join()
+        _shards.clear()
+    if _ingest_thread is not None and _ingest_thread.is_alive():
+        _ingest_queue.put(None)
+        _ingest_thread.join()
+    _ingest_thread = None
+
+
+# ---------------------------
+# Sharded ingestion (worker processes)
+# ---------------------------
+def start_ingest_workers(workers):
+    # spawn, not fork: workers must not inherit the parent's SQLite handles or paho threads
+    ctx = multiprocessing.get_context("spawn")
+    for shard in range(workers):
+        work_queue = ctx.Queue(maxsize=max(1, INGEST_QUEUE_SIZE // workers))
+        stats = ctx.Array("d", len(STAT_FIELDS), lock=False)
+        process = ctx.Process(target=ingest_worker_main, args=(work_queue, stats),
+                              name=f"ingest-worker-{shard}", daemon=True)
+        process.start()
+        _shards.append({"process": process, "queue": work_queue, "stats": stats})
+    print(f"Started {workers} ingest worker processes.")
+
+
+def ingest_worker_main(work_queue, stats):
+    global _ingest_queue, _stats, _mqtt_client
+    # Ctrl-C reaches the whole process group; the parent stops us with a sentinel once it has queued everything
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _ingest_queue, _stats = work_queue, stats
+    profiling.install_signal_handler("ingest_worker")
+    _mqtt_client = connect_event_publisher()
+    ingest_writer_loop()
+
+
+def connect_event_publisher():
+    """Publish-only client for a worker process; paho's loop thread connects and reconnects in the background."""
+    client = mqtt.Client()
+    if MQTT_USERNAME:
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.connect_async(MQTT_HOST, MQTT_PORT, 60)
+    client.loop_start()
+    return client
+
+
+def ingest_metrics():
+    """Counters and queue depth per writer (one entry per worker process, or one for the writer thread)."""
+    writers = [(shard["stats"], shard["queue"]) for shard in _shards] or [(_stats, _ingest_queue)]
+    metrics = []
+    for worker, (stats, work_queue) in enumerate(writers):
+        entry = {"worker": worker, **dict(zip(STAT_FIELDS, stats))}
+        try:
+            entry["queue_depth"] = work_queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues cannot report their size on macOS
+            entry["queue_depth"] = None
+        metrics.append(entry)
+    return metrics
+
+
+def collect_ingest_metrics():
+    """Queue depths for /metrics, read in the process that owns the queues."""
+    for entry in ingest_metrics():
+        if entry["queue_depth"] is not None:
+            INGEST_QUEUE_DEPTH.set(entry["queue_depth"], worker=entry["worker"])
+
+
+def ingest_metrics_loop():
+    previous = {}
+    while True:
+        time.sleep(INGEST_METRICS_INTERVAL)
+        for entry in ingest_metrics():
+            last = previous.get(entry["worker"], dict.fromkeys(STAT_FIELDS, 0.0))
+            rate = (entry["messages"] - last["messages"]) / INGEST_METRICS_INTERVAL
+            busy = (entry["busy_s"] - last["busy_s"]) / INGEST_METRICS_INTERVAL
+            lock_wait = (entry["lock_wait_s"] - last["lock_wait_s"]) / INGEST_METRICS_INTERVAL
+            lock_held = (entry["lock_held_s"] - last["lock_held_s"]) / INGEST_METRICS_INTERVAL
+            print(f"Ingest worker {entry['worker']}: {rate:.1f} msg/s, {int(entry['messages'])} messages, "
+                  f"{int(entry['failed'])} failed, {int(entry['batches'])} batches, "
+                  f"{busy:.0%} busy ({lock_wait:.0%} waiting for the write lock, {lock_held:.0%} holding it), "
+                  f"queue depth {entry['queue_depth']}")
+            previous[entry["worker"]] = entry
 
 
 # ---------------------------
 # Main loop with reconnect
 # ---------------------------
 def start_mqtt_listener():
+    init_db.migrate(get_db())
+    start_ingest_writer()
+    metrics.register_collector(collect_ingest_metrics)
+    # kill -USR1 <pid> profiles the listener and its ingest workers (see profiling.py)
+    profiling.install_signal_handler("mqtt_listener", lambda: [shard["process"].pid for shard in _shards])
+    threading.Thread(target=ingest_metrics_loop, name="ingest-metrics", daemon=True).start()
+    try:
+        _run_mqtt_client()
+    finally:
+        stop_ingest_writer()
+
+
+def _run_mqtt_client():
+    global _mqtt_client
     while True:
         try:
             client = mqtt.Client()
@@ -228,9 +784,11 @@ def start_mqtt_listener():
             client.on_message = on_message
 
             client.connect(MQTT_HOST, MQTT_PORT, 60)
+            _mqtt_client = client
             client.loop_forever()
 
         except Exception as e:
+            _mqtt_client = None
             print("MQTT connection error:", e)
             print(f"Reconnecting in {RECONNECT_DELAY} seconds...")
             time.sleep(RECONNECT_DELAY)
@@ -0,0 +1,105 @@
+"""
+outbox.py
+Enqueueing side of the local outbox (drained to Firestore by cloud_sync).
+
+Items are sent oldest-first; failed items are retried with backoff (next_attempt_at)
+and end up in the outbox_dead table after too many attempts, from where the portal
+can replay them.
+
+After committing new items, enqueuers call notify_outbox() so cloud_sync wakes up
+right away instead of waiting for its next poll.
+
+Kinds listed in COALESCED_KINDS are last-writer-wins documents: Firestore only
+needs the newest payload per target_path, so enqueueing one replaces any
+pending item for the same (kind, target_path). Telemetry and alerts keep
+their full history.
+
+Payloads are encoded by codec.encode_payload (JSON text, or msgpack with
+AIOT_OUTBOX_CODEC=msgpack) and read back with codec.decode_payload.
+"""
+
+import os
+import socket
+import tempfile
+from datetime import datetime
+import codec
+
+COALESCED_KINDS = ("container_summary", "config", "food_type")
+
+# Unix datagram socket cloud_sync listens on for "new items" pokes
+NOTIFY_SOCKET = os.environ.get("AIOT_OUTBOX_SOCKET", os.path.join(tempfile.gettempdir(), "aiot_outbox.sock"))
+
+
+def payload_value(payload, encoded=None):
+    """
+    The outbox.payload value for payload. encoded is the payload already serialized as JSON
+    text (e.g. a message as received), used as is when the outbox stores JSON.
+    """
+    return encoded if encoded is not None and codec.OUTBOX_STORES_JSON else codec.encode_payload(payload)
+
+
+def add_to_outbox(conn, kind, target_path, payload, ref_id=None, encoded=None, value=None):
+    """
+    Queues an item on conn's open transaction (the caller commits). ref_id is the local
+    row the item uploads (telemetry.id for telemetry), marked synced once Firestore acks it.
+    encoded is as for payload_value(); value is payload_value()'s result, for callers that
+    encode before taking the write lock (payload is then not used).
+    """
+    cursor = conn.cursor()
+    now = datetime.utcnow().isoformat()
+    attempts, next_attempt_at = 0, now
+    if kind in COALESCED_KINDS:
+        # The replacement inherits the pending row's retry state, so a document that keeps
+        # failing still backs off and is dead-lettered instead of being retried at once forever.
+        previous = cursor.execute("""
+            SELECT attempts, next_attempt_at FROM outbox WHERE kind = ? AND target_path = ?
+            ORDER BY id DESC LIMIT 1
+        """, (kind, target_path)).fetchone()
+        if previous is not None:
+            attempts, next_attempt_at = previous[0], previous[1]
+        # Delete-and-insert rather than update in place: if cloud_sync is sending the old
+        # row right now, its ack deletes only that row and the new payload still goes out.
+        cursor.execute("DELETE FROM outbox WHERE kind = ? AND target_path = ?", (kind, target_path))
+    cursor.execute("""
+        INSERT INTO outbox (kind, target_path, payload, ref_id, attempts, created_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (kind, target_path, payload_value(payload, encoded) if value is None else value, ref_id,
+          attempts, now, next_attempt_at))
+
+
+def notify_outbox():
+    """Wakes cloud_sync after new items were committed. Best effort: a no-op if it is not running."""
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(b"1", NOTIFY_SOCKET)
+    except OSError:
+        # No listener, or its buffer is full of pokes already; either way it will drain
+        pass
+
+
+def replay_dead_letter(conn, item_id=None):
+    """
+    Moves dead-lettered items (one, or all when item_id is None) back into the outbox with a
+    fresh retry budget. A last-writer-wins item is only replayed if it is the newest one for
+    its target and nothing newer is pending; otherwise it is superseded and dropped.
+    Returns (replayed, dropped). The caller commits.
+    """
+    where, params = ("", ()) if item_id is None else ("AND d.id = ?", (item_id,))
+    kinds = ", ".join("?" * len(COALESCED_KINDS))
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        INSERT INTO outbox (kind, target_path, payload, ref_id, attempts, created_at, next_attempt_at)
+        SELECT d.kind, d.target_path, d.payload, d.ref_id, 0, d.created_at, ?
+        FROM outbox_dead d
+        WHERE (d.kind NOT IN ({kinds}) OR (
+                  d.id = (SELECT max(id) FROM outbox_dead WHERE kind = d.kind AND target_path = d.target_path)
+                  AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.kind = d.kind AND o.target_path = d.target_path)
+              )) {where}
+        ORDER BY d.id
+    """, (datetime.utcnow().isoformat(), *COALESCED_KINDS, *params))
+    replayed = cursor.rowcount
+    cursor.execute("DELETE FROM outbox_dead" + ("" if item_id is None else " WHERE id = ?"), params)
+    return replayed, cursor.rowcount - replayed
@@ -0,0 +1,185 @@
+"""
+profiling.py
+Where the time goes inside the services, without restarting them.
+
+Spans: the listener times each step of a message (decode, registry lookup,
+insert_telemetry, outbox writes, rule evaluation...) with a Trace, and cloud_sync
+times each sync_* call with @timed. Every span is recorded in the
+aiot_span_seconds histogram (see /metrics), and a message or Firestore write slower
+than AIOT_SLOW_MESSAGE_MS / AIOT_SLOW_SYNC_MS is printed with its breakdown:
+
+    Slow message [c-017]: 412.6 ms (decode 0.1, registry 398.2, insert_telemetry 0.3, ...)
+
+Sampling profiler: `kill -USR1 <pid>` (listener or cloud_sync), or POST
+/api/admin/profile on the portal, samples every thread's stack AIOT_PROFILE_HZ
+times a second for AIOT_PROFILE_SECONDS and writes the counts in the folded format
+flamegraph.pl and speedscope read, to AIOT_PROFILE_DIR/<service>-<pid>-<time>.folded:
+
+    MainThread;mqtt_listener.py:flush_batch;mqtt_listener.py:process_telemetry 37
+"""
+
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from functools import wraps
+import metrics
+
+# Set to 0 to skip the per-step timings (the slow-message log then shows only the total)
+SPANS_ENABLED = os.environ.get("AIOT_PROFILE_SPANS", "1") != "0"
+SLOW_MESSAGE_S = float(os.environ.get("AIOT_SLOW_MESSAGE_MS", 200)) / 1000
+SLOW_SYNC_S = float(os.environ.get("AIOT_SLOW_SYNC_MS", 2000)) / 1000
+
+PROFILE_DIR = os.environ.get("AIOT_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "aiot_profiles"))
+PROFILE_SECONDS = float(os.environ.get("AIOT_PROFILE_SECONDS", 30))
+PROFILE_HZ = float(os.environ.get("AIOT_PROFILE_HZ", 100))
+
+SPAN_SECONDS = metrics.histogram("aiot_span_seconds", "Time per step of a message or sync call.", ("span",))
+
+# span name -> SPAN_SECONDS.bind(span=name)
+_span_observers = {}
+_profile_lock = threading.Lock()
+_profiling = False
+
+
+# ---------------------------
+# Spans
+# ---------------------------
+class Trace:
+    """
+    Step timings of one message. mark(name) closes the step that began at the previous
+    mark (or at creation); pause() drops the time since then, e.g. while the message
+    waits for the write lock or for other messages of its batch. mark() only records:
+    finish() adds the steps to aiot_span_seconds, once the write lock is released.
+    """
+    __slots__ = ("spans", "last")
+
+    def __init__(self):
+        self.spans = []
+        self.last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.spans.append((name, now - self.last))
+        self.last = now
+
+    def pause(self):
+        self.last = time.perf_counter()
+
+    def total(self):
+        return sum(seconds for _, seconds in self.spans)
+
+    def finish(self, label):
+        """Records the steps, and prints them if the message was slower than AIOT_SLOW_MESSAGE_MS."""
+        if SPANS_ENABLED:
+            for name, elapsed in self.spans:
+                observe = _span_observers.get(name)
+                if observe is None:
+                    observe = _span_observers[name] = SPAN_SECONDS.bind(span=name)
+                observe(elapsed)
+        total = self.total()
+        if total >= SLOW_MESSAGE_S:
+            steps = ", ".join(f"{name} {seconds * 1000:.1f}" for name, seconds in self.spans)
+            print(f"Slow message {label}: {total * 1000:.1f} ms ({steps})")
+
+
+def timed(name, slow_s=None):
+    """Decorator: records each call in aiot_span_seconds and prints calls slower than slow_s."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                SPAN_SECONDS.observe(elapsed, span=name)
+                if slow_s is not None and elapsed >= slow_s:
+                    print(f"Slow {name}: {elapsed * 1000:.1f} ms")
+        return wrapper
+    return decorator
+
+
+# ---------------------------
+# Sampling profiler
+# ---------------------------
+def frame_name(frame):
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def sample_stacks(seconds, hz=PROFILE_HZ):
+    """Counts of folded stacks ("thread;outer;...;inner") over `seconds` of sampling."""
+    counts = Counter()
+    me = threading.get_ident()
+    interval = 1.0 / hz
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def folded(counts):
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def write_profile(counts, service):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{service}-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}.folded")
+    with open(path, "w") as f:
+        f.write(folded(counts))
+    return path
+
+
+def profile(service, seconds=None):
+    """Samples this process for `seconds` and writes the dump. Returns (path, counts), or None if one is running."""
+    global _profiling
+    with _profile_lock:
+        if _profiling:
+            return None
+        _profiling = True
+    try:
+        counts = sample_stacks(PROFILE_SECONDS if seconds is None else seconds)
+        path = write_profile(counts, service)
+        print(f"Wrote {sum(counts.values())} stack samples to {path}")
+        return path, counts
+    finally:
+        with _profile_lock:
+            _profiling = False
+
+
+def start_profile(service, seconds=None):
+    """Profiles in a background thread, so a signal handler can return at once."""
+    threading.Thread(target=profile, args=(service, seconds), name="profiler", daemon=True).start()
+
+
+def install_signal_handler(service, forward_to=None):
+    """
+    SIGUSR1 starts a profile of this process. forward_to() returns the pids of child
+    processes (e.g. ingest workers) that are profiled along with it.
+    """
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(signum, frame):
+        print(f"SIGUSR1: profiling for {PROFILE_SECONDS:.0f}s")
+        start_profile(service)
+        for pid in forward_to() if forward_to else ():
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGUSR1, handler)
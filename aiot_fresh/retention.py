@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+retention.py
+Retention and compaction job for the local database.
+
+ - Deletes telemetry that cloud_sync has uploaded (synced = 1) and that is older than
+   TELEMETRY_RETENTION_DAYS. Unsynced rows are never deleted. The 1m/1h rollups are kept,
+   so history charts still cover the purged range.
+ - Deletes dead-lettered outbox items older than DEAD_LETTER_RETENTION_DAYS.
+ - Returns the freed pages to the filesystem with PRAGMA incremental_vacuum.
+
+Deletes run in transactions of RETENTION_BATCH_SIZE rows with a short pause in between,
+so the listener's write batches are never held up for long.
+
+    python3 retention.py                              # run every RETENTION_INTERVAL seconds
+    python3 retention.py --once                       # single run (e.g. from cron)
+    python3 retention.py --enable-incremental-vacuum  # one-off conversion of an existing DB
+
+Databases created by database.py already use incremental auto_vacuum. Older ones need the
+one-off conversion, which rewrites the whole file: stop the other services first.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+import database
+import init_db
+
+TELEMETRY_RETENTION_DAYS = float(os.environ.get("AIOT_TELEMETRY_RETENTION_DAYS", 30))
+DEAD_LETTER_RETENTION_DAYS = float(os.environ.get("AIOT_DEAD_LETTER_RETENTION_DAYS", 30))
+RETENTION_INTERVAL = int(os.environ.get("AIOT_RETENTION_INTERVAL", 3600))
+# Rows deleted (and pages vacuumed) per transaction
+RETENTION_BATCH_SIZE = int(os.environ.get("AIOT_RETENTION_BATCH_SIZE", 1000))
+VACUUM_BATCH_PAGES = 256
+# Seconds between batches, leaving the write lock free for the listener
+BATCH_PAUSE = 0.05
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+# ---------------------------
+# Deletion
+# ---------------------------
+def delete_in_batches(conn, table, where, params):
+    """Deletes matching rows RETENTION_BATCH_SIZE at a time. Returns the number deleted."""
+    deleted = 0
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table} WHERE {where} LIMIT ?
+                )
+            """, (*params, RETENTION_BATCH_SIZE))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        deleted += cursor.rowcount
+        if cursor.rowcount < RETENTION_BATCH_SIZE:
+            return deleted
+        time.sleep(BATCH_PAUSE)
+
+
+def purge_telemetry(conn, now):
+    cutoff = (now - timedelta(days=TELEMETRY_RETENTION_DAYS)).isoformat()
+    # synced = 1 lets the planner use the partial index idx_telemetry_synced_received
+    return delete_in_batches(conn, "telemetry", "synced = 1 AND received_at < ?", (cutoff,))
+
+
+def purge_dead_letter(conn, now):
+    cutoff = (now - timedelta(days=DEAD_LETTER_RETENTION_DAYS)).isoformat()
+    return delete_in_batches(conn, "outbox_dead", "failed_at < ?", (cutoff,))
+
+
+# ---------------------------
+# Compaction
+# ---------------------------
+def incremental_vacuum(conn):
+    """Releases free pages back to the filesystem in small steps. Returns pages released."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    released = 0
+    while True:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free_pages:
+            break
+        step = min(free_pages, VACUUM_BATCH_PAGES)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # incremental_vacuum returns a row per page; fetch them so the whole step runs
+            conn.execute(f"PRAGMA incremental_vacuum({step})").fetchall()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        released += free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        time.sleep(BATCH_PAUSE)
+    # Move the shrunken pages from the WAL into the main file without waiting on readers
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return released
+
+
+def enable_incremental_vacuum(conn):
+    """One-off conversion of a database created without auto_vacuum. Rewrites the whole file."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        print("Incremental auto_vacuum is already enabled.")
+        return
+    print("Rewriting the database to enable incremental auto_vacuum (this may take a while)...")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    print("Incremental auto_vacuum enabled.")
+
+
+# ---------------------------
+# Job
+# ---------------------------
+def run_retention(conn):
+    """One retention pass. Returns a dict of what was reclaimed."""
+    now = datetime.utcnow()
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    size_before = os.path.getsize(database.DB_PATH)
+
+    report = {
+        "telemetry_deleted": purge_telemetry(conn, now),
+        "dead_letter_deleted": purge_dead_letter(conn, now),
+    }
+    pages = incremental_vacuum(conn)
+    report["bytes_reclaimed"] = pages * page_size
+    report["db_size_before"] = size_before
+    report["db_size_after"] = os.path.getsize(database.DB_PATH)
+
+    print(f"Retention: deleted {report['telemetry_deleted']} telemetry rows and "
+          f"{report['dead_letter_deleted']} dead-letter items; reclaimed {report['bytes_reclaimed']} bytes "
+          f"(db file {size_before} -> {report['db_size_after']} bytes).")
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        print("Freed pages are reused but not returned to the filesystem; "
+              "run `retention.py --enable-incremental-vacuum` once to enable that.")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete old synced telemetry and compact the database.")
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="convert an existing database to incremental auto_vacuum (stop other services first)")
+    args = parser.parse_args()
+
+    conn = database.connect()
+    try:
+        init_db.migrate(conn)
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(conn)
+            return
+        print("Starting retention service...")
+        while True:
+            try:
+                run_retention(conn)
+            except sqlite3.Error as e:
+                print(f"Retention run failed: {e}")
+            if args.once:
+                break
+            time.sleep(RETENTION_INTERVAL)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
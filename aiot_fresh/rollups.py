@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+rollups.py
+Per-device telemetry aggregates in 1-minute and 1-hour buckets, so trend views and
+reports read one row per bucket instead of every raw reading.
+
+Each rollup row holds, for temperature_c, humidity_pct and mq4_ppm, the min, max,
+sum and count of non-null readings (mean = sum / count), plus the number of readings
+in the bucket. Buckets are keyed by their start time in UTC ("2024-05-01T13:07:00Z").
+
+mqtt_listener updates both tables for every reading it stores. For history stored
+before the rollups existed (or after restoring a backup), rebuild them with:
+
+    python3 rollups.py --backfill
+"""
+
+import argparse
+import sqlite3
+import database
+import init_db
+
+METRICS = ("temperature_c", "humidity_pct", "mq4_ppm")
+
+# resolution -> (table, strftime format of the bucket start, bucket length in seconds)
+ROLLUPS = {
+    "1m": ("telemetry_rollup_1m", "%Y-%m-%dT%H:%M:00Z", 60),
+    "1h": ("telemetry_rollup_1h", "%Y-%m-%dT%H:00:00Z", 3600),
+}
+
+
+def _upsert_sql(table, bucket_format):
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum, {m}_count" for m in METRICS)
+    values = ", ".join(f":{m}, :{m}, coalesce(:{m}, 0), :{m} IS NOT NULL" for m in METRICS)
+    # min()/max() with a NULL argument return NULL, so keep whichever side has a value
+    updates = ",\n            ".join(
+        f"{m}_min = coalesce(min({m}_min, excluded.{m}_min), {m}_min, excluded.{m}_min), "
+        f"{m}_max = coalesce(max({m}_max, excluded.{m}_max), {m}_max, excluded.{m}_max), "
+        f"{m}_sum = {m}_sum + excluded.{m}_sum, "
+        f"{m}_count = {m}_count + excluded.{m}_count"
+        for m in METRICS
+    )
+    return f"""
+        INSERT INTO {table} (device_id, bucket, count, {columns})
+        SELECT :device_id, bucket, 1, {values}
+        FROM (SELECT strftime('{bucket_format}', :timestamp) AS bucket)
+        WHERE bucket IS NOT NULL
+        ON CONFLICT(device_id, bucket) DO UPDATE SET
+            count = count + 1,
+            {updates}
+    """
+
+
+_UPSERT_SQL = [_upsert_sql(table, bucket_format) for table, bucket_format, _ in ROLLUPS.values()]
+
+
+def update_rollups(conn, device_id, telemetry, timestamp):
+    """Adds one reading to its 1m and 1h buckets on conn's open transaction (no commit)."""
+    params = {"device_id": device_id, "timestamp": timestamp}
+    for m in METRICS:
+        params[m] = telemetry.get(m)
+    for sql in _UPSERT_SQL:
+        conn.execute(sql, params)
+
+
+# ---------------------------
+# Backfill
+# ---------------------------
+# Aggregates of one bucket, from raw telemetry and from 1m rollup rows respectively
+_RAW_AGGREGATES = ", ".join(f"min({m}), max({m}), total({m}), count({m})" for m in METRICS)
+_ROLLUP_AGGREGATES = ", ".join(f"min({m}_min), max({m}_max), total({m}_sum), sum({m}_count)" for m in METRICS)
+
+
+def backfill_device(conn, device_id):
+    """
+    Rebuilds both rollups for one device from its raw telemetry, in one transaction.
+    The 1h buckets are built from the freshly rebuilt 1m buckets rather than the raw rows.
+    """
+    columns = ", ".join(f"{m}_min, {m}_max, {m}_sum, {m}_count" for m in METRICS)
+    table_1m, format_1m, _ = ROLLUPS["1m"]
+    table_1h, format_1h, _ = ROLLUPS["1h"]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {table_1m} (device_id, bucket, count, {columns})
+            SELECT device_id, strftime('{format_1m}', timestamp) AS bucket, count(*), {_RAW_AGGREGATES}
+            FROM telemetry
+            WHERE device_id = ? AND bucket IS NOT NULL
+            GROUP BY bucket
+        """, (device_id,))
+        conn.execute(f"""
+            INSERT OR REPLACE INTO {table_1h} (device_id, bucket, count, {columns})
+            SELECT device_id, strftime('{format_1h}', bucket) AS hour, sum(count), {_ROLLUP_AGGREGATES}
+            FROM {table_1m}
+            WHERE device_id = ?
+            GROUP BY hour
+        """, (device_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def backfill(conn):
+    """Rebuilds the rollups for every device. Safe to run while the listener is live."""
+    devices = [row[0] for row in conn.execute("SELECT DISTINCT device_id FROM telemetry")]
+    for device_id in devices:
+        # One transaction per device keeps each write-lock hold short for the listener
+        backfill_device(conn, device_id)
+        print(f"[{device_id}] Rollups rebuilt.")
+    print(f"Backfill complete: {len(devices)} devices.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the telemetry rollup tables.")
+    parser.add_argument("--backfill", action="store_true",
+                        help="rebuild the 1m/1h rollups from the raw telemetry table")
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.print_help()
+        return
+
+    conn = database.connect()
+    try:
+        init_db.migrate(conn)
+        backfill(conn)
+    except sqlite3.Error as e:
+        print(f"Backfill failed: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+rules.py
+Alert rules for mqtt_listener, compiled from a container's thresholds.
+
+Every threshold becomes a rule with
+ - a hysteresis band: an alert raised above `warn` clears only once the value is back
+   below warn - hysteresis, so a sensor hovering at the threshold does not flap
+ - a minimum duration: the condition must hold for `<level>_for_s` seconds of readings
+   before the alert is raised (critical alerts are immediate by default)
+and a metric can also get a rate-of-change rule, raised while the value rises faster
+than `max_rise_per_min` over the last `rate_window_s` seconds.
+
+Threshold keys per metric (only the levels are required):
+    "temperature": {"warn": 13.0, "critical": 20.0, "hysteresis": 0.5,
+                    "warn_for_s": 300, "critical_for_s": 0,
+                    "max_rise_per_min": 0.5, "rate_window_s": 600}
+    "humidity": {"warn_low": 50.0, "warn_high": 95.0, ...}
+
+Per-device state is two values per threshold rule plus a short window of readings per
+rate rule. mqtt_listener keeps it in its container registry.
+"""
+
+from collections import deque
+from datetime import datetime, timezone
+
+# Threshold section -> (telemetry field, unit, default hysteresis)
+METRICS = {
+    "temperature": ("temperature_c", "°C", 0.5),
+    "humidity": ("humidity_pct", "%", 2.0),
+    "mq4": ("mq4_ppm", " ppm", 20.0),
+}
+
+# Threshold key -> (alert level, raised when the value is above it)
+LEVEL_KEYS = {
+    "critical": ("critical", True),
+    "warn": ("warn", True),
+    "warn_high": ("warn", True),
+    "warn_low": ("warn", False),
+}
+
+# Seconds a condition must hold before its alert is raised, unless the thresholds say otherwise
+DEFAULT_FOR_S = {"critical": 0, "warn": 60}
+DEFAULT_RATE_WINDOW_S = 600
+# Readings kept per rate rule (a reading every few seconds over the default window)
+RATE_WINDOW_MAX_POINTS = 256
+
+MESSAGES = {
+    ("temperature", "critical"): "Critical temperature: {value}°C",
+    ("temperature", "warn"): "High temperature: {value}°C",
+    ("humidity", "warn_high"): "High humidity: {value}%",
+    ("humidity", "warn_low"): "Low humidity: {value}%",
+    ("mq4", "critical"): "Critical Gas Level: {value} ppm",
+    ("mq4", "warn"): "High Gas Level: {value} ppm",
+}
+
+
+class ThresholdRule:
+    def __init__(self, metric, key, limit, hysteresis, for_s):
+        field, unit, _ = METRICS[metric]
+        level, above = LEVEL_KEYS[key]
+        self.alert_type = metric
+        self.level = level
+        self.field = field
+        self.above = above
+        self.limit = limit
+        self.clear_limit = limit - hysteresis if above else limit + hysteresis
+        self.for_s = for_s
+        self.message = MESSAGES.get((metric, key), f"{metric} {'above' if above else 'below'} {key}: {{value}}{unit}")
+
+    def new_state(self, active):
+        # [active, time the condition started holding (None when it does not hold)]
+        return [active, None]
+
+    def check(self, state, value, t):
+        if state[0]:
+            # Clear only once the value has left the hysteresis band
+            if (value < self.clear_limit) if self.above else (value > self.clear_limit):
+                state[0] = False
+                state[1] = None
+        elif (value > self.limit) if self.above else (value < self.limit):
+            if state[1] is None:
+                state[1] = t
+            if t - state[1] >= self.for_s:
+                state[0] = True
+        else:
+            state[1] = None
+        return state[0]
+
+    def describe(self, state, value):
+        return self.message.format(value=value)
+
+
+class RateRule:
+    def __init__(self, metric, max_rise_per_min, window_s):
+        field, unit, _ = METRICS[metric]
+        self.alert_type = f"{metric}_rate"
+        self.level = "warn"
+        self.field = field
+        self.unit = unit
+        self.max_rise_per_min = max_rise_per_min
+        self.window_s = window_s
+        self.label = metric.capitalize()
+
+    def new_state(self, active):
+        # [active, deque of (t, value), last computed rate per minute]
+        return [active, deque(maxlen=RATE_WINDOW_MAX_POINTS), 0.0]
+
+    def check(self, state, value, t):
+        window = state[1]
+        window.append((t, value))
+        while window and window[0][0] < t - self.window_s:
+            window.popleft()
+        first_t, first_value = window[0]
+        # Wait for half a window of history; two close readings give a meaningless rate
+        if t - first_t < self.window_s / 2:
+            return state[0]
+        state[2] = rate = (value - first_value) / (t - first_t) * 60
+        # Hysteresis: once raised, the alert holds until the rise rate halves
+        state[0] = rate > (self.max_rise_per_min / 2 if state[0] else self.max_rise_per_min)
+        return state[0]
+
+    def describe(self, state, value):
+        return f"{self.label} rising fast: {state[2]:+.2f}{self.unit}/min (now {value}{self.unit})"
+
+
+def compile_rules(thresholds):
+    """Builds the rules for one container's thresholds dict (e.g. its threshold_overrides)."""
+    rules = []
+    for metric, config in (thresholds or {}).items():
+        if metric not in METRICS or not isinstance(config, dict):
+            continue
+        hysteresis = config.get("hysteresis", METRICS[metric][2])
+        for key, (level, _) in LEVEL_KEYS.items():
+            if config.get(key) is not None:
+                for_s = config.get(f"{level}_for_s", DEFAULT_FOR_S[level])
+                rules.append(ThresholdRule(metric, key, config[key], hysteresis, for_s))
+        if config.get("max_rise_per_min") is not None:
+            rules.append(RateRule(metric, config["max_rise_per_min"], config.get("rate_window_s", DEFAULT_RATE_WINDOW_S)))
+    return tuple(rules)
+
+
+def new_rule_state(rules, active_alerts):
+    """Fresh per-device state; rules whose alert is already open in the DB start out active."""
+    return [rule.new_state((rule.alert_type, rule.level) in active_alerts) for rule in rules]
+
+
+def reading_time(telemetry, received_at):
+    """Epoch seconds of a reading: the device timestamp, or the time the listener received it."""
+    for value in (telemetry.get("timestamp"), received_at):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except (AttributeError, ValueError):
+            continue
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    return datetime.now(timezone.utc).timestamp()
+
+
+def evaluate(rules, rule_state, telemetry, t):
+    """
+    Feeds one reading through the rules and returns the alerts that are active after it,
+    as {"type", "level", "message"} dicts. A critical alert hides the warn alert of the same type.
+    """
+    active = {}
+    for rule, state in zip(rules, rule_state):
+        value = telemetry.get(rule.field)
+        if value is None:
+            if state[0]:
+                active.setdefault((rule.alert_type, rule.level), rule.describe(state, "n/a"))
+            continue
+        if rule.check(state, value, t):
+            active.setdefault((rule.alert_type, rule.level), rule.describe(state, value))
+    return [
+        {"type": alert_type, "level": level, "message": message}
+        for (alert_type, level), message in active.items()
+        if level != "warn" or (alert_type, "critical") not in active
+    ]
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+shelf_life.py
+Remaining shelf life per container, accumulated from the temperature of its load.
+
+A food type may carry a Q10 model in food_types.shelf_life (JSON):
+
+    {"ref_temp_c": 4.0, "ref_hours": 120, "q10": 3.0}
+
+i.e. the food keeps ref_hours of quality life at ref_temp_c, and spoils q10 times
+faster for every 10 °C warmer. At temperature T it uses up
+
+    rate(T) = q10 ** ((T - ref_temp_c) / 10) / ref_hours
+
+of its life per hour. For every reading the listener adds the life used since the
+previous reading (the mean of the two readings' rates times the hours between them)
+to container_state.shelf_life_consumed, and sets shelf_life_remaining_h to the hours
+left if the container stays at its current temperature. Nothing is recomputed from
+history. Consumption restarts at zero when the container's food type changes.
+
+To rebuild the figures from the stored history (after changing a food type's model,
+or for containers that predate it), or to start a new load:
+
+    python3 shelf_life.py --recompute [--device DEVICE_ID]
+    python3 shelf_life.py --reset --device DEVICE_ID
+
+--recompute replays the 1-minute rollups, which outlive the raw telemetry.
+"""
+
+import argparse
+import json
+import sqlite3
+from datetime import datetime, timezone
+from functools import lru_cache
+import database
+import init_db
+
+
+# ---------------------------
+# Model
+# ---------------------------
+@lru_cache(maxsize=256)
+def parse_model(raw):
+    """(ref_temp_c, ref_hours, q10) from a food_types.shelf_life JSON text, or None."""
+    if not raw:
+        return None
+    try:
+        model = json.loads(raw)
+        return float(model["ref_temp_c"]), float(model["ref_hours"]), float(model["q10"])
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring invalid shelf_life model {raw!r}: {e}")
+        return None
+
+
+def consumption_rate(model, temp_c):
+    """Fraction of the shelf life used per hour at temp_c."""
+    ref_temp_c, ref_hours, q10 = model
+    return q10 ** ((temp_c - ref_temp_c) / 10) / ref_hours
+
+
+def consumed_between(model, t0, temp0, t1, temp1):
+    """Fraction used between two readings (epoch seconds, °C)."""
+    if t1 <= t0:
+        return 0.0
+    return (consumption_rate(model, temp0) + consumption_rate(model, temp1)) / 2 * (t1 - t0) / 3600
+
+
+def remaining_hours(model, consumed, temp_c):
+    return max(0.0, 1.0 - consumed) / consumption_rate(model, temp_c)
+
+
+def parse_time(value):
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def load_model(conn, food_type):
+    """The model of a food type, matched on its id or display name (the UI takes free text)."""
+    row = conn.execute("""
+        SELECT shelf_life FROM food_types
+        WHERE id = ? COLLATE NOCASE OR display_name = ? COLLATE NOCASE
+        ORDER BY id = ? DESC LIMIT 1
+    """, (food_type, food_type, food_type)).fetchone()
+    return parse_model(row[0]) if row else None
+
+
+# ---------------------------
+# Incremental update (mqtt_listener)
+# ---------------------------
+def new_state(conn, device_id):
+    """
+    Per-device tracker for the listener's registry: the container's food type and model,
+    and the previous reading, which the first update continues from.
+    """
+    row = conn.execute("""
+        SELECT c.selected_food_type, s.shelf_life_food_type, s.timestamp, s.temperature_c
+        FROM containers c LEFT JOIN container_state s ON s.device_id = c.device_id
+        WHERE c.device_id = ?
+    """, (device_id,)).fetchone()
+    food_type = row[0] if row else None
+    state = {"food_type": food_type, "model": load_model(conn, food_type) if food_type else None,
+             "t": None, "temp_c": None}
+    if row and row[1] == food_type and row[2] and row[3] is not None:
+        try:
+            state["t"], state["temp_c"] = parse_time(row[2]), row[3]
+        except ValueError:
+            pass
+    return state
+
+
+def update(state, t, temp_c):
+    """
+    Advances the tracker to a new reading. Returns (food_type, consumed since the previous
+    reading, remaining hours at full life and this temperature) for update_container_state,
+    or None when there is nothing to record (no model for the food type, or an
+    out-of-order reading).
+    """
+    model = state["model"]
+    if model is None:
+        return None
+    if temp_c is None:
+        if state["temp_c"] is None:
+            return None
+        # Reading without a temperature: keep counting at the last known one
+        temp_c = state["temp_c"]
+    consumed = 0.0
+    if state["t"] is not None:
+        if t < state["t"]:
+            # Out-of-order reading: container_state keeps the newer one, and so do we
+            return None
+        consumed = consumed_between(model, state["t"], state["temp_c"], t, temp_c)
+    state["t"], state["temp_c"] = t, temp_c
+    return state["food_type"], consumed, 1.0 / consumption_rate(model, temp_c)
+
+
+# ---------------------------
+# Bulk recompute
+# ---------------------------
+def recompute_device(conn, device_id, reset=False):
+    """
+    Rebuilds a container's consumption from its 1-minute rollups since its load started
+    (or restarts the load at its latest reading when reset is set), in one transaction.
+    Returns the remaining hours, or None when its food type has no model.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("""
+            SELECT c.selected_food_type, s.shelf_life_food_type, s.shelf_life_started, s.timestamp, s.temperature_c
+            FROM containers c JOIN container_state s ON s.device_id = c.device_id
+            WHERE c.device_id = ?
+        """, (device_id,)).fetchone()
+        model = load_model(conn, row[0]) if row and row[0] else None
+        if model is None or row[4] is None:
+            conn.execute("""
+                UPDATE container_state SET shelf_life_food_type = NULL, shelf_life_started = NULL,
+                    shelf_life_consumed = NULL, shelf_life_remaining_h = NULL, shelf_life_recomputed_at = ?
+                WHERE device_id = ?
+            """, (datetime.utcnow().isoformat(), device_id))
+            conn.commit()
+            return None
+
+        food_type, tracked_food_type, started, latest, temp_c = row
+        if reset:
+            started = latest
+        elif not started or tracked_food_type != food_type:
+            # Load start unknown: count the whole stored history
+            first = conn.execute("SELECT min(bucket) FROM telemetry_rollup_1m WHERE device_id = ?",
+                                 (device_id,)).fetchone()[0]
+            started = first or latest
+
+        consumed = 0.0
+        if not reset:
+            previous = None
+            for bucket, mean in conn.execute("""
+                SELECT bucket, temperature_c_sum / temperature_c_count FROM telemetry_rollup_1m
+                WHERE device_id = ? AND bucket >= strftime('%Y-%m-%dT%H:%M:00Z', ?) AND temperature_c_count > 0
+                ORDER BY bucket
+            """, (device_id, started)):
+                point = (parse_time(bucket) + 30, mean)
+                if previous is not None:
+                    consumed += consumed_between(model, *previous, *point)
+                previous = point
+
+        conn.execute("""
+            UPDATE container_state SET shelf_life_food_type = ?, shelf_life_started = ?,
+                shelf_life_consumed = ?, shelf_life_remaining_h = ?, shelf_life_recomputed_at = ?
+            WHERE device_id = ?
+        """, (food_type, started, consumed, remaining_hours(model, consumed, temp_c), datetime.utcnow().isoformat(),
+              device_id))
+        conn.commit()
+        return remaining_hours(model, consumed, temp_c)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def recompute(conn, device_id=None, reset=False):
+    if device_id is None:
+        devices = [row[0] for row in conn.execute("SELECT device_id FROM container_state")]
+    else:
+        devices = [device_id]
+    for device in devices:
+        # One transaction per device keeps each write-lock hold short for the listener
+        remaining = recompute_device(conn, device, reset)
+        if remaining is None:
+            print(f"[{device}] No shelf-life model for this food type.")
+        else:
+            print(f"[{device}] {remaining:.1f} h of shelf life remaining.")
+    print(f"Shelf life {'reset' if reset else 'recomputed'} for {len(devices)} containers.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the per-container shelf-life estimates.")
+    parser.add_argument("--recompute", action="store_true",
+                        help="rebuild consumption from the 1-minute rollups since each load started")
+    parser.add_argument("--reset", action="store_true",
+                        help="start a new load at the latest reading (requires --device)")
+    parser.add_argument("--device", help="only this container")
+    args = parser.parse_args()
+    if args.recompute == args.reset or (args.reset and not args.device):
+        parser.print_help()
+        return
+
+    conn = database.connect()
+    try:
+        init_db.migrate(conn)
+        recompute(conn, args.device, reset=args.reset)
+    except sqlite3.Error as e:
+        print(f"Shelf-life recompute failed: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,12 @@ document.addEventListener('DOMContentLoaded', function() {
     const modalCloseButton = document.querySelector('.close-button');
     const thresholdForm = document.getElementById('threshold-form');
     let currentEditingDeviceId = null;
+    // Overrides of the device being edited, including rule keys the form has no fields for
+    let currentEditingOverrides = {};
 
     const API_BASE_URL = window.location.origin;
+    // Latest known state per device, updated by polling and by the event stream
+    const devicesById = {};
 
     // --- Main function to fetch and render devices ---
     async function loadDevices() {
@@ -31,6 +35,8 @@ document.addEventListener('DOMContentLoaded', function() {
         }
 
         devices.forEach(device => {
+            devicesById[device.device_id] = device;
+            device.lastEventAt = Date.now();
             let card = document.getElementById(`device-${device.device_id}`);
             if (!card) {
                 card = document.createElement('div');
@@ -43,6 +49,16 @@ document.addEventListener('DOMContentLoaded', function() {
         
         attachEventListeners();
     }
+
+    // --- Re-render one card, keeping its already loaded alerts ---
+    function updateDeviceCard(device) {
+        const card = document.getElementById(`device-${device.device_id}`);
+        if (!card) return;
+        const alertsHTML = document.getElementById(`alerts-${device.device_id}`).innerHTML;
+        card.innerHTML = createDeviceCardHTML(device);
+        document.getElementById(`alerts-${device.device_id}`).innerHTML = alertsHTML;
+        attachEventListeners();
+    }
     
     // --- Generate HTML for a single device card ---
     function createDeviceCardHTML(device) {
@@ -145,6 +161,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // Populate form
             document.getElementById('food-type').value = device.selected_food_type || '';
             const overrides = device.threshold_overrides || {};
+            currentEditingOverrides = overrides;
             document.getElementById('temp-warn').value = overrides.temperature?.warn || '';
             document.getElementById('temp-crit').value = overrides.temperature?.critical || '';
             document.getElementById('hum-low').value = overrides.humidity?.warn_low || '';
@@ -214,22 +231,22 @@ document.addEventListener('DOMContentLoaded', function() {
     thresholdForm.onsubmit = async (e) => {
         e.preventDefault();
         
+        // Start from the current overrides so hysteresis, durations and rate limits are kept
+        const overrides = { ...currentEditingOverrides };
+        const formFields = {
+            temperature: { warn: 'temp-warn', critical: 'temp-crit' },
+            humidity: { warn_low: 'hum-low', warn_high: 'hum-high' },
+            mq4: { warn: 'mq4-warn', critical: 'mq4-crit' },
+        };
+        for (const [section, fields] of Object.entries(formFields)) {
+            overrides[section] = { ...(overrides[section] || {}) };
+            for (const [key, inputId] of Object.entries(fields)) {
+                overrides[section][key] = parseFloat(document.getElementById(inputId).value) || null;
+            }
+        }
         const payload = {
             selected_food_type: document.getElementById('food-type').value,
-            threshold_overrides: {
-                temperature: {
-                    warn: parseFloat(document.getElementById('temp-warn').value) || null,
-                    critical: parseFloat(document.getElementById('temp-crit').value) || null,
-                },
-                humidity: {
-                    warn_low: parseFloat(document.getElementById('hum-low').value) || null,
-                    warn_high: parseFloat(document.getElementById('hum-high').value) || null,
-                },
-                mq4: {
-                    warn: parseFloat(document.getElementById('mq4-warn').value) || null,
-                    critical: parseFloat(document.getElementById('mq4-crit').value) || null,
-                }
-            }
+            threshold_overrides: overrides,
         };
 
         try {
@@ -253,6 +270,44 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     };
 
+    // --- Sync status in the header (pending + dead-letter items) ---
+    const syncStatusElement = document.getElementById('sync-status');
+
+    async function loadSyncStatus() {
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/sync/status`);
+            const data = await response.json();
+            let html = `Sync queue: ${data.pending_items}`;
+            if (data.dead_letter_items > 0) {
+                html += ` | Failed: ${data.dead_letter_items} <button id="replay-dead-letter-btn">Retry failed</button>`;
+            }
+            syncStatusElement.innerHTML = html;
+            const replayButton = document.getElementById('replay-dead-letter-btn');
+            if (replayButton) {
+                replayButton.onclick = handleReplayDeadLetter;
+            }
+        } catch (error) {
+            console.error("Failed to load sync status:", error);
+        }
+    }
+
+    async function handleReplayDeadLetter() {
+        if (!confirm('Re-queue all failed sync items?')) return;
+
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/sync/dead-letter/replay`, { method: 'POST' });
+            if (!response.ok) {
+                throw new Error('Server responded with an error.');
+            }
+            const data = await response.json();
+            alert(`Re-queued ${data.replayed} items (${data.superseded} superseded by newer data).`);
+            loadSyncStatus();
+        } catch (error) {
+            console.error("Failed to replay dead-letter items:", error);
+            alert('Failed to re-queue items.');
+        }
+    }
+
     // --- Function to update the UTC clock ---
     function updateUtcClock() {
         const utcClockElement = document.getElementById('utc-clock');
@@ -272,9 +327,73 @@ document.addEventListener('DOMContentLoaded', function() {
     async function initialLoad() {
         await loadDevices();
         await loadAllAlerts();
+        await loadSyncStatus();
+    }
+
+    // --- Live updates: /api/stream (Server-Sent Events), polling only while it is down ---
+    const ONLINE_TIMEOUT_MS = 30000; // same as ONLINE_TIMEOUT_S in app.py
+    let pollTimer = null;
+
+    function startPolling() {
+        if (!pollTimer) {
+            pollTimer = setInterval(initialLoad, 10000); // Refresh every 10 seconds
+        }
+    }
+
+    function stopPolling() {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+
+    function handleTelemetryEvent(event) {
+        const device = devicesById[event.device_id];
+        if (!device) {
+            // New container: fetch it (and its alerts) the normal way
+            loadDevices().then(() => loadAlertsForDevice(event.device_id));
+            return;
+        }
+        device.last_seen = event.last_seen;
+        device.last_telemetry = event.last_telemetry;
+        device.status = 'online';
+        device.lastEventAt = Date.now();
+        updateDeviceCard(device);
+    }
+
+    // No event is sent when a container goes quiet, so age out online status locally
+    function markSilentDevicesOffline() {
+        if (pollTimer) return; // polling already reports status
+        Object.values(devicesById).forEach(device => {
+            if (device.status === 'online' && Date.now() - device.lastEventAt > ONLINE_TIMEOUT_MS) {
+                device.status = 'offline';
+                updateDeviceCard(device);
+            }
+        });
+    }
+
+    function connectEventStream() {
+        if (!window.EventSource) {
+            startPolling();
+            return;
+        }
+        const source = new EventSource(`${API_BASE_URL}/api/stream`);
+        source.onopen = () => {
+            if (pollTimer) {
+                // Back from polling: catch up on anything missed, then rely on the stream
+                stopPolling();
+                initialLoad();
+            }
+        };
+        // EventSource reconnects by itself; poll until it does
+        source.onerror = () => startPolling();
+        source.addEventListener('telemetry', e => handleTelemetryEvent(JSON.parse(e.data)));
+        source.addEventListener('alert', e => loadAlertsForDevice(JSON.parse(e.data).device_id));
+        source.addEventListener('alerts_resolved', e => loadAlertsForDevice(JSON.parse(e.data).device_id));
+        source.addEventListener('resync', () => initialLoad());
     }
 
     initialLoad();
-    setInterval(initialLoad, 10000); // Refresh every 10 seconds
+    connectEventStream();
+    setInterval(markSilentDevicesOffline, 5000);
+    setInterval(loadSyncStatus, 30000); // Queue depth is not streamed
     setInterval(updateUtcClock, 1000); // Update UTC clock every second
 });
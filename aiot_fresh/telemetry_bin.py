@@ -0,0 +1,76 @@
+"""
+telemetry_bin.py
+Packed binary telemetry, for firmware built with TELEMETRY_BINARY (telemetry_v3.ino).
+
+Published on containers/<device_id>/telemetry/bin instead of the JSON topic; the
+device id comes from the topic. Little-endian, first byte is the format version:
+
+    version 1 (27 bytes, struct "<BBIfffiiB")
+      u8   version      1
+      u8   flags        bit 0: GPS fix
+      u32  timestamp    Unix seconds (UTC)
+      f32  temperature_c, humidity_pct, mq4_ppm   (NaN: sensor read failed)
+      i32  lat, lon     microdegrees
+      u8   satellites
+
+A new layout gets a new version number and an entry in FORMATS; old firmware keeps
+publishing the old one. decode() unpacks straight into the telemetry row that
+mqtt_listener.insert_telemetry writes, and builds the reading in the same shape as
+the JSON firmware's for the rules, outbox and dashboard.
+"""
+
+import math
+import struct
+import time
+
+FLAG_GPS_FIX = 0x01
+
+FORMATS = {
+    1: struct.Struct("<BBIfffiiB"),
+}
+VERSION = 1
+
+
+def _value(x):
+    # float32 -> the 2 decimals the JSON firmware prints; NaN -> missing
+    return None if math.isnan(x) else round(x, 2)
+
+
+def decode(device_id, data, received_at):
+    """
+    (telemetry row, payload) for a binary message, where the row matches insert_telemetry's
+    columns. Raises ValueError for an unknown version or a truncated message.
+    """
+    data = bytes(data)
+    if not data:
+        raise ValueError("empty binary telemetry")
+    layout = FORMATS.get(data[0])
+    if layout is None:
+        raise ValueError(f"unknown binary telemetry version {data[0]}")
+    if len(data) < layout.size:
+        raise ValueError(f"binary telemetry v{data[0]} needs {layout.size} bytes, got {len(data)}")
+    _, flags, seconds, temperature, humidity, mq4, lat, lon, satellites = layout.unpack_from(data)
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+    fix = bool(flags & FLAG_GPS_FIX)
+    row = (device_id, timestamp, _value(temperature), _value(humidity), _value(mq4),
+           lat / 1e6, lon / 1e6, fix, satellites, received_at)
+    payload = {
+        "device_id": device_id,
+        "timestamp": timestamp,
+        "temperature_c": row[2],
+        "humidity_pct": row[3],
+        "mq4_ppm": row[4],
+        "gps": {"lat": row[5], "lon": row[6], "fix": fix, "satellites": satellites},
+    }
+    return row, payload
+
+
+def encode(timestamp, temperature_c, humidity_pct, mq4_ppm, lat, lon, fix, satellites):
+    """The current version's bytes for a reading (what the firmware sends); None values become NaN."""
+    nan = float("nan")
+    return FORMATS[VERSION].pack(
+        VERSION, FLAG_GPS_FIX if fix else 0, int(timestamp),
+        nan if temperature_c is None else temperature_c,
+        nan if humidity_pct is None else humidity_pct,
+        nan if mq4_ppm is None else mq4_ppm,
+        round(lat * 1e6), round(lon * 1e6), satellites)
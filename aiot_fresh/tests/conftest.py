@@ -0,0 +1,31 @@
+"""
+Shared setup for the service tests.
+
+    cd aiot_fresh && python -m pytest tests
+
+database, outbox and metrics read their paths once at import, so the scratch
+environment is set here, before any test module imports a service.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+scratch = tempfile.mkdtemp(prefix="aiot-test-")
+os.environ["AIOT_DB_PATH"] = os.path.join(scratch, "aiot.db")
+os.environ["AIOT_OUTBOX_SOCKET"] = os.path.join(scratch, "outbox.sock")
+os.environ["AIOT_METRICS_DIR"] = os.path.join(scratch, "metrics")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def conn():
+    """The scratch database, migrated; the test's uncommitted writes are rolled back."""
+    import database
+    import init_db
+    conn = database.get_connection()
+    init_db.migrate(conn)
+    yield conn
+    conn.rollback()
@@ -0,0 +1,109 @@
+"""
+anomaly.py: EWMA baselines, hourly seasonal offsets and priming from rollups.
+"""
+
+import copy
+import math
+import random
+
+import pytest
+
+import anomaly
+
+DAY = 24 * 3600
+STEP = 60
+
+
+def temperature(t, rng):
+    """A cold room with a 1 °C daily cycle (defrost, door openings) and sensor noise."""
+    return 4.0 + 1.0 * math.sin(2 * math.pi * t / DAY) + rng.gauss(0, 0.1)
+
+
+def feed(state, readings):
+    """Runs (t, temperature) readings through the detector; returns the alerts after each."""
+    return [anomaly.evaluate(state, {"temperature_c": value}, t) for t, value in readings]
+
+
+def steady(seconds, rng, start=0):
+    return [(t, temperature(t, rng)) for t in range(start, start + seconds, STEP)]
+
+
+def test_not_scored_during_warmup():
+    state = anomaly.new_state()
+    rng = random.Random(1)
+    first = steady(DAY - 3600, rng)
+    feed(state, first)
+    assert anomaly.update(state["metrics"]["temperature_c"], first[-1][0] + STEP, 50.0, 0.2) is None
+
+
+def test_steady_seasonal_series_does_not_flag():
+    state = anomaly.new_state()
+    alerts = feed(state, steady(3 * DAY, random.Random(2)))
+    assert not any(alerts)
+
+
+def test_hourly_offsets_learn_the_daily_cycle():
+    state = anomaly.new_state()
+    feed(state, steady(3 * DAY, random.Random(3)))
+    offsets = state["metrics"]["temperature_c"][anomaly.OFFSETS]
+    # Warmest around 06:00 UTC, coldest around 18:00
+    assert offsets[6] - offsets[18] == pytest.approx(2.0, abs=0.5)
+
+
+def test_slow_drift_flags_and_clears():
+    state = anomaly.new_state()
+    rng = random.Random(4)
+    feed(state, steady(2 * DAY, rng))
+    # The compressor loses ground: +1 °C per hour, well below any fixed threshold at first
+    start = 2 * DAY
+    drifting = [(t, temperature(t, rng) + (t - start) / 3600) for t in range(start, start + 3 * 3600, STEP)]
+    alerts = feed(state, drifting)
+    assert not any(alerts[:5])
+    raised = next(i for i, active in enumerate(alerts) if active)
+    assert raised * STEP < 2 * 3600
+    assert "drifting up" in alerts[raised][0]["message"]
+
+    # Back to normal: the alert clears once the baseline has let go of the drift
+    back = steady(12 * 3600, rng, start=start + 3 * 3600)
+    assert not feed(state, back)[-1]
+    assert state["active"] is False
+
+
+def test_single_spike_flags():
+    state = anomaly.new_state()
+    rng = random.Random(5)
+    feed(state, steady(2 * DAY, rng))
+    t = 2 * DAY
+    [alert] = anomaly.evaluate(state, {"temperature_c": temperature(t, rng) + 3.0}, t)
+    assert alert["type"] == "anomaly"
+    assert "above its usual level" in alert["message"]
+
+
+def rollup_rows(days, rng):
+    """1-minute rollups as load_history returns them: (t, {field: (mean, max - min)})."""
+    return [(t, {"temperature_c": (temperature(t, rng), 0.3)}) for t in range(0, days * DAY, STEP)]
+
+
+def test_primed_state_scores_at_once():
+    state = anomaly.prime(anomaly.new_state(), rollup_rows(1, random.Random(6)))
+    metric_state = state["metrics"]["temperature_c"]
+    assert metric_state[anomaly.MEAN] == pytest.approx(4.0, abs=0.3)
+    assert metric_state[anomaly.OFFSETS][6] - metric_state[anomaly.OFFSETS][18] == pytest.approx(2.0, abs=0.5)
+    # A day of history counts as the warmup
+    assert anomaly.update(copy.deepcopy(metric_state), DAY, 4.0, 0.2) is not None
+
+    rng = random.Random(7)
+    assert not any(feed(state, steady(DAY, rng, start=DAY)))
+    t = 2 * DAY
+    assert anomaly.evaluate(state, {"temperature_c": temperature(t, rng) + 3.0}, t)
+
+
+def test_prime_without_numpy_matches(monkeypatch):
+    if anomaly.np is None:
+        pytest.skip("numpy is not installed")
+    rows = rollup_rows(1, random.Random(8))
+    with_numpy = anomaly.prime(anomaly.new_state(), rows)["metrics"]["temperature_c"]
+    monkeypatch.setattr(anomaly, "np", None)
+    without = anomaly.prime(anomaly.new_state(), rows)["metrics"]["temperature_c"]
+    assert without[:anomaly.OFFSETS] == pytest.approx(with_numpy[:anomaly.OFFSETS])
+    assert without[anomaly.OFFSETS] == pytest.approx(with_numpy[anomaly.OFFSETS])
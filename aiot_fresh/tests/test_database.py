@@ -0,0 +1,67 @@
+"""
+database.py: per-thread connections, and the pool request threads hand them back to.
+"""
+
+import threading
+
+import database
+
+
+def in_thread(target):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(target()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def request():
+    """What one portal request thread does: use the connections, then return them."""
+    conns = database.get_connection(), database.get_readonly_connection()
+    conns[0].execute("SELECT 1").fetchone()
+    conns[1].execute("SELECT 1").fetchone()
+    database.return_connections()
+    return conns
+
+
+def test_request_threads_reuse_pooled_connections(conn):
+    first = in_thread(request)
+    assert in_thread(request) == first
+
+
+def test_thread_keeps_its_connection_until_it_returns_it(conn):
+    def use_twice():
+        same = database.get_connection() is database.get_connection()
+        database.return_connections()
+        return same
+
+    assert in_thread(use_twice)
+
+
+def test_returned_connection_is_rolled_back(conn):
+    def leave_open():
+        c = database.get_connection()
+        c.execute("INSERT INTO food_types (id, display_name) VALUES ('test-pool', 'left open')")
+        database.return_connections()
+        return c.in_transaction
+
+    assert in_thread(leave_open) is False
+    assert conn.execute("SELECT 1 FROM food_types WHERE id = 'test-pool'").fetchone() is None
+
+
+def test_pool_keeps_at_most_pool_size_idle(conn, monkeypatch):
+    monkeypatch.setattr(database, "POOL_SIZE", 1)
+    barrier = threading.Barrier(2)
+
+    def concurrent():
+        c = database.get_connection()
+        barrier.wait()
+        database.return_connections()
+        return c
+
+    threads = [threading.Thread(target=concurrent) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(database._pool["rw"]) <= 1
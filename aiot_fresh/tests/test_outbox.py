@@ -0,0 +1,68 @@
+"""
+outbox.add_to_outbox: coalesced kinds keep one pending row per target, with its retry state.
+outbox_counts (kept by triggers) and the /metrics outbox gauges built from it.
+"""
+
+from datetime import datetime, timedelta
+
+import app as portal
+import codec
+import outbox
+
+
+def pending(conn, target_path):
+    return conn.execute("SELECT payload, attempts, next_attempt_at FROM outbox WHERE target_path = ?",
+                        (target_path,)).fetchall()
+
+
+def test_coalesced_item_keeps_retry_state(conn):
+    outbox.add_to_outbox(conn, "config", "containers/C1", {"v": 1})
+    conn.execute("UPDATE outbox SET attempts = 3, next_attempt_at = '2999-01-01T00:00:00' "
+                 "WHERE target_path = 'containers/C1'")
+    outbox.add_to_outbox(conn, "config", "containers/C1", {"v": 2})
+    [row] = pending(conn, "containers/C1")
+    assert codec.decode_payload(row["payload"]) == {"v": 2}
+    assert (row["attempts"], row["next_attempt_at"]) == (3, "2999-01-01T00:00:00")
+
+
+def test_first_coalesced_item_is_due_now(conn):
+    outbox.add_to_outbox(conn, "config", "containers/C2", {"v": 1})
+    [row] = pending(conn, "containers/C2")
+    assert row["attempts"] == 0
+    assert row["next_attempt_at"] < "2999"
+
+
+def test_telemetry_is_not_coalesced(conn):
+    outbox.add_to_outbox(conn, "telemetry", "containers/C3/telemetry/1", {"v": 1})
+    outbox.add_to_outbox(conn, "telemetry", "containers/C3/telemetry/1", {"v": 2})
+    assert len(pending(conn, "containers/C3/telemetry/1")) == 2
+
+
+def test_counts_follow_enqueue_ack_and_dead_letter(conn):
+    def counts():
+        return {row["kind"]: (row["pending"], row["dead"])
+                for row in conn.execute("SELECT kind, pending, dead FROM outbox_counts WHERE kind LIKE 'count_%'")}
+
+    for n in range(3):
+        outbox.add_to_outbox(conn, "count_t", f"containers/C4/telemetry/{n}", {"n": n})
+    assert counts() == {"count_t": (3, 0)}
+
+    first = conn.execute("SELECT min(id) FROM outbox WHERE kind = 'count_t'").fetchone()[0]
+    conn.execute("INSERT INTO outbox_dead (id, kind, target_path, payload) "
+                 "SELECT id, kind, target_path, payload FROM outbox WHERE id = ?", (first,))
+    conn.execute("DELETE FROM outbox WHERE id = ?", (first,))
+    assert counts() == {"count_t": (2, 1)}
+
+    conn.execute("DELETE FROM outbox WHERE kind = 'count_t'")
+    conn.execute("DELETE FROM outbox_dead WHERE kind = 'count_t'")
+    assert counts() == {"count_t": (0, 0)}
+
+
+def test_outbox_metrics(conn):
+    outbox.add_to_outbox(conn, "count_m", "containers/C5/telemetry/1", {})
+    outbox.add_to_outbox(conn, "count_m", "containers/C5/telemetry/2", {})
+    conn.execute("UPDATE outbox SET created_at = ? WHERE kind = 'count_m' AND target_path LIKE '%/1'",
+                 ((datetime.utcnow() - timedelta(minutes=5)).isoformat(),))
+    depth, oldest, _ = portal.outbox_metrics(conn)
+    assert depth.values[("count_m",)] == 2
+    assert 295 < oldest.values[("count_m",)] < 305
@@ -0,0 +1,121 @@
+"""
+cloud_sync.drain_outbox: a failed item backs off and holds its container's newer
+items, the loop waits for it rather than re-reading them, and it is dead-lettered
+after MAX_RETRIES attempts. Firestore is replaced by a stand-in sync_outbox_chunk.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("firebase_admin")
+
+import cloud_sync
+import outbox
+
+
+@pytest.fixture
+def firestore(conn, monkeypatch):
+    """Records the ids sent, in order; items whose target_path is in `failing` fail."""
+    class Firestore:
+        sent = []
+        failing = set()
+
+    def sync_outbox_chunk(items):
+        acked = []
+        for item in items:
+            if item["target_path"] in Firestore.failing:
+                return acked, [(item["id"], "boom")]
+            Firestore.sent.append(item["id"])
+            acked.append(item["id"])
+        return acked, []
+
+    monkeypatch.setattr(cloud_sync, "db", object())
+    monkeypatch.setattr(cloud_sync, "sync_outbox_chunk", sync_outbox_chunk)
+    conn.execute("DELETE FROM outbox")
+    conn.execute("DELETE FROM outbox_dead")
+    conn.commit()
+    return Firestore
+
+
+def enqueue(conn, container_id, n):
+    outbox.add_to_outbox(conn, "telemetry", f"containers/{container_id}/telemetry/{n}", {"n": n})
+    conn.commit()
+    return conn.execute("SELECT max(id) FROM outbox").fetchone()[0]
+
+
+def outbox_row(conn, item_id):
+    return conn.execute("SELECT attempts, next_attempt_at FROM outbox WHERE id = ?", (item_id,)).fetchone()
+
+
+def make_due(conn, item_id):
+    conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                 ((datetime.utcnow() - timedelta(seconds=1)).isoformat(), item_id))
+    conn.commit()
+
+
+def test_failed_item_holds_newer_items_until_it_is_sent(conn, firestore):
+    a1, b1, a2 = enqueue(conn, "A", 1), enqueue(conn, "B", 1), enqueue(conn, "A", 2)
+    firestore.failing = {"containers/A/telemetry/1"}
+
+    sent, resume = cloud_sync.drain_outbox(conn)
+    assert sent == 3
+    assert resume is None
+    assert firestore.sent == [b1]
+    attempts, next_attempt_at = outbox_row(conn, a1)
+    assert attempts == 1
+    assert next_attempt_at > datetime.utcnow().isoformat()
+    assert outbox_row(conn, a2)["attempts"] == 0
+
+    # A2 is due but waits behind A1, even once Firestore is back
+    firestore.failing = set()
+    sent, resume = cloud_sync.drain_outbox(conn)
+    assert sent == 0
+    assert firestore.sent == [b1]
+    assert 0 < cloud_sync.seconds_until_next_due(conn, resume["now"]) <= cloud_sync.RETRY_BASE_DELAY
+
+    make_due(conn, a1)
+    sent, resume = cloud_sync.drain_outbox(conn, resume)
+    assert sent == 2
+    assert firestore.sent == [b1, a1, a2]
+    assert conn.execute("SELECT count(*) FROM outbox").fetchone()[0] == 0
+
+
+def test_held_backlog_is_not_read_again(conn, firestore, monkeypatch):
+    enqueue(conn, "A", 1)
+    firestore.failing = {"containers/A/telemetry/1"}
+    cloud_sync.drain_outbox(conn)
+    enqueue(conn, "A", 2)
+    sent, resume = cloud_sync.drain_outbox(conn)
+    assert sent == 0
+
+    read = []
+    get_outbox_items = cloud_sync.get_outbox_items
+
+    def spy(conn, now, after=None, limit=cloud_sync.OUTBOX_CHUNK_SIZE):
+        items = get_outbox_items(conn, now, after, limit)
+        read.extend(item["id"] for item in items)
+        return items
+
+    monkeypatch.setattr(cloud_sync, "get_outbox_items", spy)
+    b1 = enqueue(conn, "B", 1)
+    sent, resume = cloud_sync.drain_outbox(conn, resume)
+    assert sent == 1
+    assert read == [b1]
+
+
+def test_item_is_dead_lettered_after_max_retries(conn, firestore):
+    a1, a2 = enqueue(conn, "A", 1), enqueue(conn, "A", 2)
+    conn.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (cloud_sync.MAX_RETRIES - 1, a1))
+    conn.commit()
+    firestore.failing = {"containers/A/telemetry/1"}
+
+    cloud_sync.drain_outbox(conn)
+    dead = conn.execute("SELECT id, attempts, last_error FROM outbox_dead").fetchall()
+    assert [tuple(row) for row in dead] == [(a1, cloud_sync.MAX_RETRIES, "boom")]
+    assert outbox_row(conn, a1) is None
+
+    # Nothing is backed off any more, so A2 is no longer held
+    sent, _ = cloud_sync.drain_outbox(conn)
+    assert sent == 1
+    assert firestore.sent == [a2]
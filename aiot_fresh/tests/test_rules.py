@@ -0,0 +1,76 @@
+"""
+rules.py: hysteresis bands, minimum durations and rate-of-change rules.
+"""
+
+import rules
+
+
+def run(thresholds, readings, field="temperature_c", active_alerts=()):
+    """Feeds (t, value) readings through fresh rules; returns the active (type, level) pairs after each."""
+    compiled = rules.compile_rules(thresholds)
+    state = rules.new_rule_state(compiled, set(active_alerts))
+    return [
+        {(alert["type"], alert["level"]) for alert in rules.evaluate(compiled, state, {field: value}, t)}
+        for t, value in readings
+    ]
+
+
+def test_alert_clears_only_below_the_hysteresis_band():
+    thresholds = {"temperature": {"warn": 10.0, "hysteresis": 1.0, "warn_for_s": 0}}
+    active = run(thresholds, [(0, 10.5), (1, 9.5), (2, 10.2), (3, 8.9), (4, 9.5)])
+    assert active == [{("temperature", "warn")}] * 3 + [set(), set()]
+
+
+def test_warn_waits_for_its_duration():
+    thresholds = {"temperature": {"warn": 10.0, "warn_for_s": 60}}
+    active = run(thresholds, [(0, 11.0), (30, 11.0), (59, 11.0), (60, 11.0)])
+    assert active == [set(), set(), set(), {("temperature", "warn")}]
+
+
+def test_duration_restarts_when_the_condition_breaks():
+    thresholds = {"temperature": {"warn": 10.0, "warn_for_s": 60}}
+    active = run(thresholds, [(0, 11.0), (50, 9.0), (60, 11.0), (100, 11.0), (120, 11.0)])
+    assert active == [set()] * 4 + [{("temperature", "warn")}]
+
+
+def test_critical_is_immediate_and_hides_warn():
+    thresholds = {"temperature": {"warn": 10.0, "critical": 20.0, "warn_for_s": 0}}
+    active = run(thresholds, [(0, 21.0), (1, 15.0)])
+    assert active == [{("temperature", "critical")}, {("temperature", "warn")}]
+
+
+def test_low_threshold_with_hysteresis():
+    thresholds = {"humidity": {"warn_low": 50.0, "hysteresis": 2.0, "warn_for_s": 0}}
+    active = run(thresholds, [(0, 49.0), (1, 51.0), (2, 52.5)], field="humidity_pct")
+    assert active == [{("humidity", "warn")}] * 2 + [set()]
+
+
+def test_open_alert_starts_active():
+    thresholds = {"temperature": {"warn": 10.0, "hysteresis": 1.0}}
+    active = run(thresholds, [(0, 9.5)], active_alerts={("temperature", "warn")})
+    assert active == [{("temperature", "warn")}]
+
+
+def test_rate_rule_flags_a_fast_rise():
+    thresholds = {"temperature": {"max_rise_per_min": 0.5, "rate_window_s": 600}}
+    # 1 °C per minute, one reading every 10 s; needs half a window of history first
+    readings = [(t, 4.0 + t / 60) for t in range(0, 601, 10)]
+    active = run(thresholds, readings)
+    assert active[29] == set()
+    assert active[30] == {("temperature_rate", "warn")}
+    assert active[-1] == {("temperature_rate", "warn")}
+
+
+def test_rate_rule_ignores_a_slow_rise_and_clears_at_half_the_limit():
+    thresholds = {"temperature": {"max_rise_per_min": 0.5, "rate_window_s": 600}}
+    slow = [(t, 4.0 + 0.2 * t / 60) for t in range(0, 601, 10)]
+    assert not any(run(thresholds, slow))
+
+    # Raised at 1 °C/min, still held at 0.3 °C/min (above half the limit), cleared once flat
+    rise = [(t, 4.0 + t / 60) for t in range(0, 301, 10)]
+    slower = [(t, 9.0 + 0.3 * (t - 300) / 60) for t in range(310, 1501, 10)]
+    flat = [(t, 15.0) for t in range(1510, 2201, 10)]
+    active = run(thresholds, rise + slower + flat)
+    assert active[len(rise) - 1] == {("temperature_rate", "warn")}
+    assert active[len(rise) + len(slower) - 1] == {("temperature_rate", "warn")}
+    assert active[-1] == set()
@@ -0,0 +1,76 @@
+"""
+telemetry_bin.py: packed binary telemetry round trips and malformed frames.
+"""
+
+import struct
+
+import pytest
+
+import telemetry_bin
+
+RECEIVED_AT = "2025-01-01T00:00:01Z"
+# 2025-01-01T00:00:00Z
+TIMESTAMP = 1735689600
+
+
+def test_round_trip():
+    data = telemetry_bin.encode(TIMESTAMP, 4.25, 85.5, 120.0, 3.139003, 101.686855, True, 7)
+    assert len(data) == 27
+    row, payload = telemetry_bin.decode("cont-0001", data, RECEIVED_AT)
+    assert row == ("cont-0001", "2025-01-01T00:00:00Z", 4.25, 85.5, 120.0,
+                   3.139003, 101.686855, True, 7, RECEIVED_AT)
+    assert payload == {
+        "device_id": "cont-0001",
+        "timestamp": "2025-01-01T00:00:00Z",
+        "temperature_c": 4.25,
+        "humidity_pct": 85.5,
+        "mq4_ppm": 120.0,
+        "gps": {"lat": 3.139003, "lon": 101.686855, "fix": True, "satellites": 7},
+    }
+
+
+def test_float32_values_come_back_at_two_decimals():
+    row, _ = telemetry_bin.decode("cont-0001", telemetry_bin.encode(TIMESTAMP, 3.14159, 60.1, 99.99, 0, 0, False, 0), RECEIVED_AT)
+    assert row[2:5] == (3.14, 60.1, 99.99)
+
+
+def test_failed_sensor_reads_come_back_as_none():
+    data = telemetry_bin.encode(TIMESTAMP, None, None, 150.0, -33.8688, 151.2093, False, 0)
+    row, payload = telemetry_bin.decode("cont-0001", data, RECEIVED_AT)
+    assert row[2:5] == (None, None, 150.0)
+    assert (payload["temperature_c"], payload["humidity_pct"]) == (None, None)
+    assert payload["gps"] == {"lat": -33.8688, "lon": 151.2093, "fix": False, "satellites": 0}
+
+
+def test_trailing_bytes_are_ignored():
+    data = telemetry_bin.encode(TIMESTAMP, 4.0, 80.0, 100.0, 0, 0, True, 5)
+    assert telemetry_bin.decode("cont-0001", data + b"\x00\x00", RECEIVED_AT) == \
+        telemetry_bin.decode("cont-0001", data, RECEIVED_AT)
+
+
+def test_accepts_bytearray_and_memoryview():
+    data = telemetry_bin.encode(TIMESTAMP, 4.0, 80.0, 100.0, 0, 0, True, 5)
+    expected = telemetry_bin.decode("cont-0001", data, RECEIVED_AT)
+    assert telemetry_bin.decode("cont-0001", bytearray(data), RECEIVED_AT) == expected
+    assert telemetry_bin.decode("cont-0001", memoryview(data), RECEIVED_AT) == expected
+
+
+@pytest.mark.parametrize("data, error", [
+    (b"", "empty binary telemetry"),
+    (b"\x01", "needs 27 bytes, got 1"),
+    (telemetry_bin.encode(TIMESTAMP, 4.0, 80.0, 100.0, 0, 0, True, 5)[:-1], "needs 27 bytes, got 26"),
+    (b"\x00" + bytes(26), "unknown binary telemetry version 0"),
+    (b"\x02" + bytes(26), "unknown binary telemetry version 2"),
+    (b"{\"device_id\": \"cont-0001\"}", "unknown binary telemetry version 123"),
+])
+def test_malformed_frames_are_rejected(data, error):
+    with pytest.raises(ValueError, match=error):
+        telemetry_bin.decode("cont-0001", data, RECEIVED_AT)
+
+
+def test_encode_rejects_out_of_range_fields():
+    # A satellite count or coordinate that does not fit its field is a firmware bug, not a reading
+    with pytest.raises(struct.error):
+        telemetry_bin.encode(TIMESTAMP, 4.0, 80.0, 100.0, 0, 0, True, 256)
+    with pytest.raises(struct.error):
+        telemetry_bin.encode(-1, 4.0, 80.0, 100.0, 0, 0, True, 5)
@@ -0,0 +1,65 @@
+"""
+/api/devices/<id>/telemetry with max_points: the response covers the whole requested range.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as portal
+import database
+import init_db
+import rollups
+
+DEVICE_ID = "test-0001"
+START = datetime(2025, 1, 1)
+INTERVAL_S = 5
+
+
+@pytest.fixture(scope="module")
+def client():
+    conn = database.get_connection()
+    init_db.migrate(conn)
+    conn.execute("INSERT INTO containers (device_id, selected_food_type, last_seen, threshold_overrides) "
+                 "VALUES (?, 'chicken', ?, '{}')", (DEVICE_ID, START.isoformat()))
+    # One hour of readings every 5 seconds, written like the listener does (raw row and rollups)
+    for k in range(3600 // INTERVAL_S):
+        timestamp = (START + timedelta(seconds=k * INTERVAL_S)).strftime(portal.TIMESTAMP_FORMAT)
+        reading = {"temperature_c": 2.0 + k / 100, "humidity_pct": 85.0, "mq4_ppm": 100.0}
+        conn.execute("INSERT INTO telemetry (device_id, timestamp, temperature_c, humidity_pct, mq4_ppm, received_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", (DEVICE_ID, timestamp, *reading.values(), timestamp))
+        rollups.update_rollups(conn, DEVICE_ID, reading, timestamp)
+    conn.commit()
+    database.release_connections()
+
+    portal.app.config["TESTING"] = True
+    with portal.app.test_client() as client:
+        with client.session_transaction() as session:
+            session["username"] = "test"
+        yield client
+
+
+def history(client, max_points, end=START + timedelta(hours=1)):
+    response = client.get(f"/api/devices/{DEVICE_ID}/telemetry", query_string={
+        "start": START.isoformat() + "Z", "end": end.isoformat() + "Z", "max_points": max_points})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_downsampled_series_covers_whole_range(client):
+    # 720 readings, and 36 s per point is below the one-minute rollup resolution
+    body = history(client, 100)
+    assert body["mode"] == "downsampled"
+    assert len(body["points"]) <= 100
+    assert body["points"][0]["timestamp"] == "2025-01-01T00:00:00Z"
+    assert body["points"][-1]["timestamp"] == "2025-01-01T00:59:00Z"
+    assert sum(point["count"] for point in body["points"]) == 3600 // INTERVAL_S
+
+
+def test_raw_when_range_fits_in_max_points(client):
+    body = history(client, 100, end=START + timedelta(minutes=5))
+    assert body["mode"] == "raw"
+    assert body["next_cursor"] is None
+    assert len(body["points"]) == 5 * 60 // INTERVAL_S
+    assert body["points"][0]["timestamp"] == "2025-01-01T00:00:00Z"
+    assert body["points"][-1]["timestamp"] == "2025-01-01T00:04:55Z"
@@ -0,0 +1,102 @@
+"""
+thresholds.py: food type thresholds with the container's overrides on top, and the
+device endpoint revalidating (304 -> 200) once a food type edit changes them.
+"""
+
+import json
+
+import pytest
+
+import app as portal
+import database
+import init_db
+import thresholds
+
+DEVICE_ID = "test-thresholds-0001"
+FOOD_TYPE = {"temperature": {"warn": 2.0, "critical": 4.0}, "humidity": {"warn_low": 60.0, "warn_high": 95.0}}
+OVERRIDES = {"temperature": {"warn": 3.0, "critical": None, "warn_for_s": 300}, "mq4": {"warn": 400.0}}
+
+
+def test_overrides_merge_key_by_key():
+    merged = thresholds.merge(FOOD_TYPE, OVERRIDES)
+    assert merged == {
+        # critical is null in the overrides, so the food type's value is kept
+        "temperature": {"warn": 3.0, "critical": 4.0, "warn_for_s": 300},
+        "humidity": {"warn_low": 60.0, "warn_high": 95.0},
+        "mq4": {"warn": 400.0},
+    }
+    # The food type's dict is shared through the cache and must not change
+    assert FOOD_TYPE["temperature"] == {"warn": 2.0, "critical": 4.0}
+
+
+def test_merge_ignores_sections_that_are_not_objects():
+    assert thresholds.merge({"temperature": 5, "humidity": {"warn_low": 50.0}},
+                            {"humidity": None, "mq4": [1]}) == {"humidity": {"warn_low": 50.0}}
+
+
+def test_compiled_per_pair_of_texts():
+    food_raw, overrides_raw = json.dumps(FOOD_TYPE), json.dumps(OVERRIDES)
+    merged, compiled = thresholds.compile_thresholds(food_raw, overrides_raw)
+    assert thresholds.compile_thresholds(food_raw, overrides_raw)[1] is compiled
+    assert {(rule.alert_type, rule.level) for rule in compiled} == {
+        ("temperature", "warn"), ("temperature", "critical"), ("humidity", "warn"), ("mq4", "warn")}
+    # An edit is a different text, so a fresh merge
+    assert thresholds.compile_thresholds(json.dumps({}), overrides_raw)[0]["temperature"] == \
+        {"warn": 3.0, "warn_for_s": 300}
+
+
+def test_invalid_json_is_ignored():
+    assert thresholds.compile_thresholds("not json", json.dumps(OVERRIDES))[0] == \
+        thresholds.merge({}, OVERRIDES)
+
+
+@pytest.fixture(scope="module")
+def client():
+    conn = database.get_connection()
+    init_db.migrate(conn)
+    conn.execute("INSERT OR REPLACE INTO food_types (id, display_name, thresholds, last_modified) "
+                 "VALUES ('test-fish', 'Test Fish', ?, '2025-01-01T00:00:00')", (json.dumps(FOOD_TYPE),))
+    # Matched on the display name, as the dashboard's free-text field allows
+    conn.execute("INSERT OR REPLACE INTO containers (device_id, selected_food_type, last_seen, last_modified, "
+                 "threshold_overrides) VALUES (?, 'test fish', '2025-01-01T00:00:00', '2025-01-01T00:00:00', ?)",
+                 (DEVICE_ID, json.dumps(OVERRIDES)))
+    conn.commit()
+    database.release_connections()
+
+    portal.app.config["TESTING"] = True
+    with portal.app.test_client() as client:
+        with client.session_transaction() as session:
+            session["username"] = "test"
+        yield client
+
+
+def test_load_matches_the_food_type_by_display_name(client):
+    merged, _ = thresholds.load(database.get_connection(), DEVICE_ID)
+    assert merged == thresholds.merge(FOOD_TYPE, OVERRIDES)
+    assert thresholds.load(database.get_connection(), "no-such-device") == ({}, ())
+
+
+def test_food_type_edit_revalidates_the_device(client, monkeypatch):
+    published = []
+    monkeypatch.setattr(portal.publish, "single", lambda topic, **kwargs: published.append(topic))
+    url = f"/api/devices/{DEVICE_ID}"
+
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.get_json()["device"]["thresholds"]["temperature"]["critical"] == 4.0
+    etag, last_modified = first.headers["ETag"], first.headers["Last-Modified"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(url, headers={"If-Modified-Since": last_modified}).status_code == 304
+
+    edited = {"temperature": {"warn": 2.0, "critical": 5.0}}
+    response = client.post("/api/food-types/test-fish", json={"thresholds": edited})
+    assert response.status_code == 200
+    assert published == ["food_types/test-fish/config"]
+
+    # Both validators move, so clients that send either one get the new thresholds
+    for headers in ({"If-None-Match": etag}, {"If-Modified-Since": last_modified}):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert response.get_json()["device"]["thresholds"]["temperature"] == {
+            "warn": 3.0, "critical": 5.0, "warn_for_s": 300}
+    assert response.headers["ETag"] != etag
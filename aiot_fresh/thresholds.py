@@ -0,0 +1,69 @@
+"""
+thresholds.py
+Effective alert thresholds of a container: the thresholds of its food type
+(food_types.thresholds) with the container's threshold_overrides on top.
+
+    food type: {"temperature": {"warn": 2.0, "critical": 4.0}, "humidity": {"warn_low": 60.0}}
+    overrides: {"temperature": {"warn": 3.0, "critical": null, "warn_for_s": 300}}
+    effective: {"temperature": {"warn": 3.0, "critical": 4.0, "warn_for_s": 300},
+                "humidity": {"warn_low": 60.0}}
+
+Overrides merge key by key within each metric. A null override (what the dashboard
+form sends for an empty field) inherits the food type's value.
+
+Merging and compiling (rules.compile_rules) are cached on the two JSON texts, which
+change whenever the food type or the overrides are edited: every container with
+the same food type and overrides shares one compiled object, and an edit is a cache
+miss rather than something to invalidate.
+"""
+
+import json
+from functools import lru_cache
+import rules
+
+# Containers are matched to food types on the id or, since the dashboard takes free
+# text, the display name (see shelf_life.load_model)
+THRESHOLDS_QUERY = """
+    SELECT c.threshold_overrides, f.thresholds AS food_thresholds
+    FROM containers c
+    LEFT JOIN food_types f
+        ON f.id = c.selected_food_type COLLATE NOCASE OR f.display_name = c.selected_food_type COLLATE NOCASE
+    WHERE c.device_id = ?
+    ORDER BY f.id = c.selected_food_type DESC
+    LIMIT 1
+"""
+
+
+def _decode(raw, source):
+    try:
+        value = json.loads(raw) if raw else {}
+    except ValueError as e:
+        print(f"Ignoring invalid {source} thresholds {raw!r}: {e}")
+        return {}
+    return value if isinstance(value, dict) else {}
+
+
+def merge(defaults, overrides):
+    """Overlays overrides on defaults, metric by metric; None values inherit."""
+    merged = {metric: dict(config) for metric, config in defaults.items() if isinstance(config, dict)}
+    for metric, config in overrides.items():
+        if not isinstance(config, dict):
+            continue
+        target = merged.setdefault(metric, {})
+        target.update((key, value) for key, value in config.items() if value is not None)
+    return merged
+
+
+@lru_cache(maxsize=256)
+def compile_thresholds(food_thresholds_raw, overrides_raw):
+    """(effective thresholds, compiled rules) for a pair of JSON texts. Treat the result as read-only."""
+    merged = merge(_decode(food_thresholds_raw, "food type"), _decode(overrides_raw, "override"))
+    return merged, rules.compile_rules(merged)
+
+
+def load(conn, device_id):
+    """The container's (effective thresholds, compiled rules); ({}, ()) for an unknown container."""
+    row = conn.execute(THRESHOLDS_QUERY, (device_id,)).fetchone()
+    if row is None:
+        return compile_thresholds(None, None)
+    return compile_thresholds(row[1], row[0])